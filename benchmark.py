@@ -0,0 +1,276 @@
+'''
+Benchmarks for the most time-consuming parts of the drift analysis, run on
+synthetic drifting pulsestacks of various sizes.
+
+Usage:
+
+    python benchmark.py <results.json> [<npulses>x<nbins> ...]
+    python benchmark.py compare <old_results.json> <new_results.json>
+    python benchmark.py synthetic <npulses>x<nbins> <prefix>
+
+The first form times each operation on pulsestacks of the given sizes (or a
+default set of sizes) and writes the times and peak memory usage, together
+with the git commit, to results.json. The second form compares two such files,
+e.g. from before and after a change. The third just writes a synthetic
+pulsestack to <prefix>.pdv and a session with its subpulses to <prefix>.json.
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import contextlib
+
+import numpy as np
+
+import matplotlib
+matplotlib.use("Agg") # No windows are needed here
+
+import pulsestack
+import drift_analysis
+
+DEFAULT_SIZES = [(500, 256), (2000, 512), (5000, 1024)]
+
+def make_drifting_pulsestack(npulses=1000, nbins=1024, P2=15.0, P3=12.0, null_fraction=0.1,
+        null_length=20, onpulse=(140, 220), width=3.0, noise=0.2, seed=None):
+    '''
+    Make a synthetic pulsestack of Gaussian subpulses drifting along straight driftbands,
+    with P2 in deg and P3 in pulses (so the drift rate is P2/P3 deg/pulse), inside
+    an on-pulse window onpulse (deg) with a Gaussian envelope. Runs of null_length pulses
+    are nulled, until about null_fraction of all pulses are nulls.
+
+    Returns the (npulses, nbins) values and a dictionary describing the "true" subpulses
+    (phases, pulses, driftbands), the nulled pulses, and the corresponding quadratic
+    model parameters (see ModelFit).
+    '''
+    rng = np.random.default_rng(seed)
+
+    phases = np.arange(nbins)*360/nbins
+    pulses = np.arange(npulses)
+    driftrate = P2/P3
+    phi0 = onpulse[0]
+
+    # The phase of each bin relative to the nearest driftband
+    offsets = phases[np.newaxis,:] - phi0 - driftrate*pulses[:,np.newaxis]
+    residuals = (offsets + P2/2) % P2 - P2/2
+
+    centre = 0.5*(onpulse[0] + onpulse[1])
+    halfwidth = 0.5*(onpulse[1] - onpulse[0])
+    envelope = np.exp(-0.5*((phases - centre)/(0.5*halfwidth))**2)
+    envelope[np.abs(phases - centre) > halfwidth] = 0
+
+    values = envelope[np.newaxis,:]*np.exp(-0.5*(residuals/width)**2)
+
+    # Null whole runs of pulses at random
+    nulled = np.zeros(npulses, dtype=bool)
+    nnulls = int(null_fraction*npulses/null_length)
+    for start in rng.integers(npulses, size=nnulls):
+        nulled[start:start+null_length] = True
+    values[nulled,:] = 0
+
+    values += noise*rng.standard_normal(values.shape)
+
+    # The true subpulse positions: every driftband crossing within the on-pulse window
+    dmin = int(np.floor((onpulse[0] - phi0 - driftrate*(npulses - 1))/P2))
+    dmax = int(np.ceil((onpulse[1] - phi0)/P2))
+    driftbands = np.arange(dmin, dmax + 1)
+    subpulse_phases = phi0 + driftrate*pulses[:,np.newaxis] + P2*driftbands[np.newaxis,:]
+    inside = np.logical_and(subpulse_phases >= onpulse[0], subpulse_phases <= onpulse[1])
+    inside[nulled,:] = False
+    p, d = np.where(inside)
+
+    truth = {
+            "phases":     subpulse_phases[p, d],
+            "pulses":     pulses[p].astype(float),
+            "driftbands": driftbands[d].astype(float),
+            "nulled":     nulled,
+            "parameters": [0.0, driftrate, phi0, P2], # Quadratic model: a1*p**2 + a2*p + a3 + a4*d
+            }
+
+    return values.astype(np.float32), truth
+
+def write_pdv(pdvfile, values):
+    '''
+    Write a pulsestack to a text file in the same format as PSRCHIVE's pdv
+    (one subintegration per pulse, one frequency channel)
+    '''
+    npulses, nbins = values.shape
+    isub, ibin = np.meshgrid(np.arange(npulses), np.arange(nbins), indexing='ij')
+    table = np.column_stack([isub.ravel(), np.zeros(npulses*nbins, dtype=int), ibin.ravel(), values.ravel()])
+
+    header = "File: {} Src: synthetic Nsub: {} Nch: 1 Npol: 1 Nbin: {}".format(os.path.basename(pdvfile), npulses, nbins)
+    np.savetxt(pdvfile, table, fmt=["%d", "%d", "%d", "%.6g"], header=header)
+
+def make_session(pdvfile, truth, stokes="I"):
+    '''
+    Make a DriftAnalysis session from a synthetic pdv file, with the true subpulses
+    and a single quadratic model fit covering the whole pulsestack
+    '''
+    da = drift_analysis.DriftAnalysis()
+    da.load_from_pdv(pdvfile, stokes)
+
+    da.subpulses.add_subpulses(truth["phases"], truth["pulses"], driftbands=truth["driftbands"])
+
+    model_fit = drift_analysis.ModelFit()
+    model_fit.model_name = "quadratic"
+    model_fit.parameters = list(truth["parameters"])
+    model_fit.set_pulse_bounds(0, da.npulses - 1)
+    da.model_fits[0] = model_fit
+
+    return da
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def measure(function, setup=None, repeat=5):
+    '''
+    Time function(*setup()) repeat times, and then measure its peak memory usage
+    (with tracemalloc, which slows things down, so this is done in a separate run).
+    setup (if given) is called afresh before every run, and is not included in the timing.
+    Anything the function prints is swallowed.
+    Returns a dictionary of the best and median times (s) and the peak memory (bytes).
+    '''
+    times = []
+    for i in range(repeat + 1):
+        args = setup() if setup is not None else ()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if i < repeat:
+                start = time.perf_counter()
+                function(*args)
+                times.append(time.perf_counter() - start)
+            else:
+                tracemalloc.start()
+                function(*args)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+    return {"best_time": min(times), "median_time": float(np.median(times)), "peak_memory": peak}
+
+def get_benchmarks(workdir, npulses, nbins, seed=0):
+    '''
+    Returns a list of (name, function, setup) for all the benchmarked operations,
+    on a synthetic pulsestack of the given size (see measure())
+    '''
+    values, truth = make_drifting_pulsestack(npulses=npulses, nbins=nbins, seed=seed)
+
+    pdvfile  = os.path.join(workdir, "synthetic_{}x{}.pdv".format(npulses, nbins))
+    jsonfile = os.path.join(workdir, "synthetic_{}x{}.json".format(npulses, nbins))
+    write_pdv(pdvfile, values)
+
+    da = make_session(pdvfile, truth)
+    da.save_json(jsonfile)
+
+    def load_from_pdv():
+        ps = pulsestack.Pulsestack()
+        ps.load_from_pdv(pdvfile, "I", cache=False)
+
+    def load_json():
+        loaded = drift_analysis.DriftAnalysis()
+        loaded.load_json(jsonfile)
+
+    def save_json():
+        da.save_json(jsonfile)
+
+    def clear_smoothing_cache():
+        # Otherwise only the first run would actually do any smoothing
+        da.values_changed()
+        return ()
+
+    def fresh_copy():
+        # For the operations that change the pulsestack or model in place
+        return (make_session(pdvfile, truth),)
+
+    def optimise_fit(session):
+        subpulses = session.subpulses
+        session.model_fits[0].optimise_fit_to_subpulses(subpulses.get_phases(), subpulses.get_pulses(), subpulses.get_driftbands())
+
+    return [
+            ("load_from_pdv",                   load_from_pdv, None),
+            ("load_json",                       load_json, None),
+            ("save_json",                       save_json, None),
+            ("smooth_with_gaussian",            lambda: da.smooth_with_gaussian(2.0, inplace=False), clear_smoothing_cache),
+            ("get_local_maxima",                lambda: da.get_local_maxima(maxima_threshold=0.5), None),
+            ("LRFS",                            da.LRFS, None),
+            ("cross_correlate_successive_pulses", da.cross_correlate_successive_pulses, None),
+            ("auto_correlate_pulses",           da.auto_correlate_pulses, None),
+            ("optimise_fit_to_subpulses",       optimise_fit, fresh_copy),
+            ("assign_driftbands_to_subpulses",  lambda session: session.subpulses.assign_driftbands_to_subpulses(session.model_fits[0]), fresh_copy),
+            ("add_subpulses",                   lambda subpulses: subpulses.add_subpulses(truth["phases"], truth["pulses"]), lambda: (drift_analysis.Subpulses(),)),
+            ]
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=5, seed=0):
+    '''
+    Run all benchmarks for all the given (npulses, nbins) sizes.
+    Returns a dictionary suitable for saving as JSON.
+    '''
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for npulses, nbins in sizes:
+            for name, function, setup in get_benchmarks(workdir, npulses, nbins, seed=seed):
+                result = measure(function, setup=setup, repeat=repeat)
+                result.update({"name": name, "npulses": npulses, "nbins": nbins})
+                results.append(result)
+
+                print("{:>36s} {:5d} x {:4d}: {:9.4f} s, {:8.1f} MB".format(name, npulses, nbins,
+                    result["best_time"], result["peak_memory"]/1024**2))
+
+    return {
+            "commit":    get_git_commit(),
+            "date":      time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python":    platform.python_version(),
+            "numpy":     np.__version__,
+            "machine":   platform.platform(),
+            "repeat":    repeat,
+            "results":   results,
+            }
+
+def compare_results(old, new):
+    '''
+    Print the ratios (new/old) of the best times and peak memory of every benchmark
+    that appears in both sets of results
+    '''
+    old_results = {(r["name"], r["npulses"], r["nbins"]): r for r in old["results"]}
+
+    print("Comparing {} (old) with {} (new)".format(old["commit"], new["commit"]))
+    for r in new["results"]:
+        key = (r["name"], r["npulses"], r["nbins"])
+        if key not in old_results:
+            continue
+        o = old_results[key]
+        print("{:>36s} {:5d} x {:4d}: time {:9.4f} -> {:9.4f} s ({:5.2f}x), memory {:8.1f} -> {:8.1f} MB ({:5.2f}x)".format(
+            *key, o["best_time"], r["best_time"], r["best_time"]/o["best_time"],
+            o["peak_memory"]/1024**2, r["peak_memory"]/1024**2, r["peak_memory"]/max(o["peak_memory"], 1)))
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == "compare":
+        with open(sys.argv[2], "r") as f:
+            old = json.load(f)
+        with open(sys.argv[3], "r") as f:
+            new = json.load(f)
+        compare_results(old, new)
+
+    elif len(sys.argv) == 4 and sys.argv[1] == "synthetic":
+        npulses, nbins = [int(n) for n in sys.argv[2].split("x")]
+        values, truth = make_drifting_pulsestack(npulses=npulses, nbins=nbins)
+        write_pdv(sys.argv[3] + ".pdv", values)
+        da = make_session(sys.argv[3] + ".pdv", truth)
+        da.save_json(sys.argv[3] + ".json")
+
+    elif len(sys.argv) >= 2:
+        sizes = [tuple(int(n) for n in size.split("x")) for size in sys.argv[2:]]
+        results = run_benchmarks(sizes=sizes if len(sizes) > 0 else DEFAULT_SIZES)
+        with open(sys.argv[1], "w") as f:
+            json.dump(results, f, indent=1)
+
+    else:
+        print(__doc__)
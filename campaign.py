@@ -0,0 +1,197 @@
+'''
+A campaign is a collection of drift analysis sessions of different observations,
+kept together in one directory so that they can be searched as a whole:
+
+    <directory>/manifest.json                   - what observations there are, and where their files are
+    <directory>/sessions/<obsid>.json           - each session, minus the pulsestack values...
+    <directory>/sessions/<obsid>.values.npy     - ...which are stored in binary (and memory-mapped when loaded)
+    <directory>/index/<obsid>.subpulses.npz     - a table (one array per column) of every subpulse
+    <directory>/index/<obsid>.sequences.npz     - a table of every drift sequence
+
+Queries only need the (small) index tables, so questions like "all subpulses with drift
+rate < x" or "all sequences of mode N" can be answered across all the observations
+without loading any of the pulsestacks. For example:
+
+    c = campaign.Campaign("campaign")
+    subpulses = c.query("subpulses", lambda t: t["driftrate"] < -0.3)
+    sequences = c.query("sequences", lambda t: t["mode"] == "N")
+
+Usage:
+
+    python campaign.py <directory> add <json_file> [<json_file> ...]
+    python campaign.py <directory> list
+'''
+
+import os
+import sys
+import json
+import time
+
+import numpy as np
+
+import drift_analysis
+
+MANIFEST_VERSION = 1
+
+TABLE_NAMES = ["subpulses", "sequences"]
+
+class Campaign:
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest  = {"version": MANIFEST_VERSION, "observations": {}}
+        self.tables    = {} # Index tables already read in, keyed by table name
+
+        if os.path.exists(self.get_manifest_filename()):
+            with open(self.get_manifest_filename(), "r") as f:
+                self.manifest = json.load(f)
+
+    def get_manifest_filename(self):
+        return os.path.join(self.directory, "manifest.json")
+
+    def get_obsids(self):
+        return list(self.manifest["observations"].keys())
+
+    def get_path(self, relative_path):
+        return os.path.join(self.directory, relative_path)
+
+    def save_manifest(self):
+        # As with session files, write to a temporary file first so that a crash
+        # doesn't leave a broken manifest behind
+        manifest_filename = self.get_manifest_filename()
+        with open(manifest_filename + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(manifest_filename + ".tmp", manifest_filename)
+
+    def add_session(self, session, obsid):
+        '''
+        Add (or replace) an observation, given as a DriftAnalysis session
+        '''
+        obsid = str(obsid)
+        os.makedirs(self.get_path("sessions"), exist_ok=True)
+        os.makedirs(self.get_path("index"), exist_ok=True)
+
+        entry = {
+                "session":  os.path.join("sessions", obsid + ".json"),
+                "values":   os.path.join("sessions", obsid + ".values.npy"),
+                "tables":   {name: os.path.join("index", "{}.{}.npz".format(obsid, name)) for name in TABLE_NAMES},
+                "source":   session.jsonfile,
+                "added":    time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "npulses":  int(session.npulses),
+                "nbins":    int(session.nbins),
+                "nsubpulses": int(session.subpulses.get_nsubpulses()),
+                "nsequences": int(session.drift_sequences.number_of_sequences()),
+                }
+
+        # The session itself, with the values stored separately in binary (concatenated
+        # observations don't serialize their values, but they are stored all the same)
+        drift_dict = session.serialize_session()
+        drift_dict["pulsestack"].pop("values", None)
+        drift_dict["pulsestack"].pop("concatenation", None)
+        with open(self.get_path(entry["session"]), "w") as f:
+            json.dump(drift_dict, f)
+        np.save(self.get_path(entry["values"]), np.asarray(session.values))
+
+        # The index tables
+        tables = {"subpulses": session.get_subpulse_table(), "sequences": session.get_sequence_table()}
+        for name in TABLE_NAMES:
+            columns = {column: np.asarray(tables[name][column]) for column in tables[name]}
+            columns["mode"] = columns["mode"].astype(str)
+            np.savez(self.get_path(entry["tables"][name]), **columns)
+
+        self.manifest["observations"][obsid] = entry
+        self.save_manifest()
+
+        # Any tables already read in are now out of date
+        self.tables = {}
+
+    def add_json(self, jsonfile, obsid=None):
+        '''
+        Add (or replace) an observation from a session (json) file. obsid defaults
+        to the name of the file, minus any extension.
+        '''
+        if obsid is None:
+            obsid = os.path.basename(jsonfile).split(".")[0]
+
+        session = drift_analysis.DriftAnalysis()
+        session.load_json(jsonfile)
+
+        self.add_session(session, obsid)
+
+    def remove(self, obsid):
+        entry = self.manifest["observations"].pop(str(obsid))
+        for path in [entry["session"], entry["values"]] + list(entry["tables"].values()):
+            if os.path.exists(self.get_path(path)):
+                os.remove(self.get_path(path))
+        self.save_manifest()
+        self.tables = {}
+
+    def load_session(self, obsid):
+        '''
+        Returns the DriftAnalysis session of the given observation. Its values are
+        memory-mapped, so this is quick even for large pulsestacks.
+        '''
+        entry = self.manifest["observations"][str(obsid)]
+
+        with open(self.get_path(entry["session"]), "r") as f:
+            drift_dict = json.load(f)
+
+        session = drift_analysis.DriftAnalysis()
+        session.unserialize_session(drift_dict)
+        session.values = np.load(self.get_path(entry["values"]), mmap_mode='r')
+        session.values_changed()
+        session.jsonfile = entry["source"]
+
+        return session
+
+    def get_table(self, name):
+        '''
+        Returns one of the index tables (see TABLE_NAMES) of all observations together,
+        as a dictionary of column arrays, with an extra "obsid" column.
+        '''
+        if name not in TABLE_NAMES:
+            raise ValueError("Unrecognised table '{}'".format(name))
+
+        if name not in self.tables.keys():
+            parts = []
+            for obsid in self.get_obsids():
+                with np.load(self.get_path(self.manifest["observations"][obsid]["tables"][name])) as npz:
+                    part = {column: npz[column] for column in npz.files}
+                part["obsid"] = np.full(len(part["mode"]), obsid)
+                parts.append(part)
+
+            if len(parts) == 0:
+                self.tables[name] = {}
+            else:
+                self.tables[name] = {column: np.concatenate([part[column] for part in parts]) for column in parts[0]}
+
+        return self.tables[name]
+
+    def query(self, name, condition=None):
+        '''
+        Returns the rows of an index table (see get_table()) for which condition is True.
+        condition is a function that is given the whole table (a dictionary of column
+        arrays) and returns a boolean array, e.g. lambda t: t["driftrate"] < -0.3
+        '''
+        table = self.get_table(name)
+        if condition is None or len(table) == 0:
+            return table
+
+        selected = condition(table)
+        return {column: table[column][selected] for column in table}
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[2] == "add":
+        c = Campaign(sys.argv[1])
+        for jsonfile in sys.argv[3:]:
+            print("Adding", jsonfile)
+            c.add_json(jsonfile)
+
+    elif len(sys.argv) == 3 and sys.argv[2] == "list":
+        c = Campaign(sys.argv[1])
+        for obsid in c.get_obsids():
+            entry = c.manifest["observations"][obsid]
+            print("{}: {} pulses x {} bins, {} subpulses, {} sequences (from {})".format(
+                obsid, entry["npulses"], entry["nbins"], entry["nsubpulses"], entry["nsequences"], entry["source"]))
+
+    else:
+        print(__doc__)
@@ -0,0 +1,179 @@
+'''
+Several observations (pdv files with the same number of phase bins) treated as one
+pulsestack, by joining them end to end along the pulse axis, without copying any of
+their data. Each observation (a "segment") is only read in when some part of it is
+actually needed, and then only through load_stokes_cube(), i.e. memory-mapped from
+its <pdvfile>.stokes.npy cache after the first time.
+
+The rows of all the segments follow on from each other without gaps, and every join
+between two segments has a gap record saying how many pulses are missing there (if
+known), which the pulse numbering of the joined stack skips over (see
+Pulsestack.set_pulse_numbers()). Any row can be traced back to its own observation (see
+Concatenation.get_source_pulses()).
+
+For example, from the command line:
+
+    python drift_analysis.py 1274143152.pdv 1275094456.pdv 1275172216.pdv I
+'''
+
+import os
+
+import numpy as np
+
+import pulsestack
+
+def read_pdv_shape(pdvfile):
+    '''
+    Returns the (npulses, nbins) of a pdv file without reading all of it: from the
+    header of its Stokes cache, if there is an up-to-date one, or otherwise from its
+    last line (whose first three columns are the last subint, channel and bin)
+    '''
+    cachefile = pdvfile + ".stokes.npy"
+    if os.path.exists(cachefile) and os.path.getmtime(cachefile) >= os.path.getmtime(pdvfile):
+        columns = np.load(cachefile, mmap_mode='r')
+        return columns.shape[1], columns.shape[-1]
+
+    with open(pdvfile, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b""
+        while position > 0 and tail.strip().count(b"\n") < 1:
+            step = min(4096, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+
+    last_line = tail.strip().split(b"\n")[-1].split()
+    return int(float(last_line[0])) + 1, int(float(last_line[2])) + 1
+
+class Concatenation:
+    '''
+    pdvfiles - the observations, in the order they are to be joined
+    gaps     - the number of pulses missing at each join (one fewer than there are
+               files), or None where that isn't known. If gaps is None, none are known.
+    '''
+    def __init__(self, pdvfiles, gaps=None):
+        self.pdvfiles = list(pdvfiles)
+        if len(self.pdvfiles) == 0:
+            raise ValueError("No pdv files to concatenate")
+
+        shapes = [read_pdv_shape(pdvfile) for pdvfile in self.pdvfiles]
+        self.npulses = np.array([shape[0] for shape in shapes])
+        self.nbins   = shapes[0][1]
+        if any([shape[1] != self.nbins for shape in shapes]):
+            raise ValueError("Only pdv files with the same number of phase bins can be concatenated ({})".format(
+                ", ".join(["{}: {}".format(pdvfile, shape[1]) for pdvfile, shape in zip(self.pdvfiles, shapes)])))
+
+        # The row of the joined stack at which each segment starts (plus the total number of rows)
+        self.first_rows = np.concatenate([[0], np.cumsum(self.npulses)]).astype(int)
+
+        if gaps is None:
+            gaps = [None]*(len(self.pdvfiles) - 1)
+        elif len(gaps) != len(self.pdvfiles) - 1:
+            raise ValueError("There must be one gap for each of the {} joins".format(len(self.pdvfiles) - 1))
+        self.gaps = [None if gap is None else int(gap) for gap in gaps]
+
+        # Stokes cubes are only loaded when needed
+        self.stokes_cubes = [None]*len(self.pdvfiles)
+
+    def get_shape(self):
+        return int(self.first_rows[-1]), self.nbins
+
+    def get_gap_records(self):
+        '''
+        Returns one dictionary per join: the "row" of the joined stack where the later
+        segment starts, the pdvfiles "before" and "after" it, and the number of pulses
+        missing there ("npulses", or None if not known)
+        '''
+        return [{"row": int(self.first_rows[i+1]), "before": self.pdvfiles[i], "after": self.pdvfiles[i+1], "npulses": gap}
+                for i, gap in enumerate(self.gaps)]
+
+    def get_stokes_cube(self, segment):
+        if self.stokes_cubes[segment] is None:
+            self.stokes_cubes[segment] = pulsestack.load_stokes_cube(self.pdvfiles[segment])
+        return self.stokes_cubes[segment]
+
+    def get_values(self, stokes):
+        # All of the joined stack, in the given Stokes (see ConcatenatedValues)
+        return ConcatenatedValues(self, stokes)
+
+    def get_source_pulses(self, rows):
+        '''
+        Returns, for each row of the joined stack, the index (into pdvfiles) of the
+        observation it comes from, and its pulse number within that observation
+        '''
+        rows = np.asarray(rows)
+        segments = np.clip(np.searchsorted(self.first_rows, rows, side='right') - 1, 0, len(self.pdvfiles) - 1)
+        return segments, rows - self.first_rows[segments]
+
+    def serialize(self):
+        return {"pdvfiles": self.pdvfiles, "gaps": self.gaps}
+
+class ConcatenatedValues:
+    '''
+    A read-only (npulses, nbins) array-like view of (a rectangle of) the joined stack,
+    for one Stokes parameter. Slicing it with plain slices (as crop() does) gives
+    another view, without reading anything. Anything else (e.g. np.asarray(), fancy
+    indexing, or astype()) reads in just the parts of the segments that are covered.
+    '''
+    def __init__(self, concatenation, stokes, row_range=None, col_range=None):
+        self.concatenation = concatenation
+        self.stokes        = stokes
+
+        npulses, nbins = concatenation.get_shape()
+        self.row_range = [0, npulses] if row_range is None else list(row_range)
+        self.col_range = [0, nbins] if col_range is None else list(col_range)
+
+        self.shape = (self.row_range[1] - self.row_range[0], self.col_range[1] - self.col_range[0])
+        self.ndim  = 2
+        self.dtype = np.dtype(np.float32) # (as load_stokes_cube() stores them)
+        self.size  = self.shape[0]*self.shape[1]
+        self.nbytes = self.size*self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if len(key) <= 2 and all([isinstance(k, slice) and k.step in [None, 1] for k in key]):
+            row_start, row_stop, _ = key[0].indices(self.shape[0])
+            if len(key) == 2:
+                col_start, col_stop, _ = key[1].indices(self.shape[1])
+            else:
+                col_start, col_stop = 0, self.shape[1]
+
+            return ConcatenatedValues(self.concatenation, self.stokes,
+                    row_range=[self.row_range[0] + row_start, self.row_range[0] + max(row_start, row_stop)],
+                    col_range=[self.col_range[0] + col_start, self.col_range[0] + max(col_start, col_stop)])
+
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        values = np.empty(self.shape, dtype=self.dtype)
+        c0, c1 = self.col_range
+
+        # Copy in the part of each segment that overlaps the view
+        first_rows = self.concatenation.first_rows
+        for segment in range(len(self.concatenation.pdvfiles)):
+            r0 = max(self.row_range[0], first_rows[segment])
+            r1 = min(self.row_range[1], first_rows[segment+1])
+            if r0 >= r1:
+                continue
+
+            segment_values = self.concatenation.get_stokes_cube(segment).get(self.stokes)
+            values[r0-self.row_range[0]:r1-self.row_range[0]] = segment_values[r0-first_rows[segment]:r1-first_rows[segment], c0:c1]
+
+        if dtype is not None:
+            values = values.astype(dtype, copy=False)
+        return values
+
+    def astype(self, dtype):
+        return np.asarray(self, dtype=dtype)
+
+    def copy(self):
+        return np.asarray(self)
+
+    def flatten(self):
+        return np.asarray(self).flatten()
@@ -1,7 +1,9 @@
 __version__ = "0.9.7"
 
+import os
 import sys
 import copy
+import time
 
 import numpy as np
 from numpy.polynomial.polynomial import polyfit, polyval
@@ -11,7 +13,8 @@ import matplotlib.pyplot as plt
 
 from scipy.interpolate import interp1d
 from scipy.ndimage import gaussian_filter1d
-from scipy.optimize import curve_fit
+from scipy.optimize import leastsq
+from scipy.linalg import solve_triangular
 
 import tkinter
 import tkinter.filedialog
@@ -20,6 +23,10 @@ import tkinter.simpledialog
 import json
 import bisect
 import pulsestack
+import history
+import journal
+import tasks
+import instrumentation
 
 class Subpulses:
 
@@ -84,6 +91,11 @@ class Subpulses:
             serialized["widths"]     = list(self.get_widths().astype(float))
             serialized["driftbands"] = list(self.get_driftbands().astype(float))
 
+            # (Only the indexes of the few rejected subpulses, if there are any)
+            rejected = np.flatnonzero(self.get_rejected())
+            if len(rejected) > 0:
+                serialized["rejected"] = [int(i) for i in rejected]
+
         return serialized
 
     def unserialize(self, serialized):
@@ -93,11 +105,15 @@ class Subpulses:
             widths       = serialized["widths"]
             driftbands   = serialized["driftbands"]
 
-            self.add_subpulses(phases, pulses, widths=widths, driftbands=driftbands)
+            rejected = np.zeros(len(pulses), dtype=bool)
+            if "rejected" in serialized.keys():
+                rejected[serialized["rejected"]] = True
+
+            self.add_subpulses(phases, pulses, widths=widths, driftbands=driftbands, rejected=rejected)
         else:
             self.data = None
 
-    def add_subpulses(self, phases, pulses, widths=None, driftbands=None):
+    def add_subpulses(self, phases, pulses, widths=None, driftbands=None, rejected=None):
         if len(phases) != len(pulses):
             print("Lengths of phases and pulses don't match. No subpulses added.")
             return
@@ -120,7 +136,15 @@ class Subpulses:
             print("Length of driftbands doesn't match phases and pulses. No subpulses added.")
             return
 
-        newsubpulses = np.transpose([phases, pulses, widths, driftbands])
+        # Whether each subpulse has been rejected as an outlier (see
+        # DriftAnalysis.calc_clipped_driftbands()), stored as 0 or 1
+        if rejected is None:
+            rejected = np.zeros((nnewsubpulses))
+        elif len(rejected) != nnewsubpulses:
+            print("Length of rejected doesn't match phases and pulses. No subpulses added.")
+            return
+
+        newsubpulses = np.transpose([phases, pulses, widths, driftbands, np.asarray(rejected, dtype=float)])
 
         if self.data is None:
             self.data = newsubpulses
@@ -163,6 +187,12 @@ class Subpulses:
         else:
             return self.data[subset, 3]
 
+    def get_rejected(self, subset=None):
+        if subset is None:
+            return self.data[:,4] != 0
+        else:
+            return self.data[subset, 4] != 0
+
     def get_positions(self):
         '''
         Returns an Nx2 numpy array of subpulse positions (phase, pulse)
@@ -193,6 +223,12 @@ class Subpulses:
         else:
             self.data[subset,3] = driftbands
 
+    def set_rejected(self, rejected, subset=None):
+        if subset is None:
+            self.data[:,4] = rejected
+        else:
+            self.data[subset,4] = rejected
+
     def shift_all_subpulses(self, dphase=None, dpulse=None):
         if dphase is not None:
             self.data[:,0] += dphase
@@ -230,8 +266,9 @@ class Subpulses:
             is_in_range = np.ones(p.shape).astype(bool) # Should be an array of all True
 
         if with_valid_driftband:
+            # (Rejected subpulses never count as having a driftband, see assign_driftbands_to_subpulses())
             d = self.get_driftbands()
-            is_valid_driftband = np.logical_not(np.isnan(d))
+            is_valid_driftband = np.logical_and(np.logical_not(np.isnan(d)), np.logical_not(self.get_rejected()))
             return np.logical_and(is_in_range, is_valid_driftband)
         else:
             return is_in_range
@@ -240,11 +277,12 @@ class Subpulses:
         '''
         model_fit - an object of ModelFit
         This will classify each subpulse in the appropriate pulse range
-        into a driftband according to the given model.
+        into a driftband according to the given model. Subpulses that have been
+        rejected as outliers are left as they are (i.e. without a driftband).
         '''
         # Get only those subpulses within the valid range of the quadratic fit
         pulse_range = np.array(model_fit.get_pulse_bounds())
-        subset = self.in_pulse_range(pulse_range)
+        subset = np.logical_and(self.in_pulse_range(pulse_range), np.logical_not(self.get_rejected()))
 
         ph = self.get_phases(subset=subset)
         p  = self.get_pulses(subset=subset)
@@ -256,6 +294,8 @@ class Subpulses:
         return subset
 
 class DriftSequences:
+    # Boundaries are row (pulse bin) indexes of the pulsestack, not pulse numbers, so they
+    # stay put whatever gaps there are in the pulse numbers (see Pulsestack.get_pulse_from_bin())
     def __init__(self):
         self.boundaries = []
 
@@ -325,6 +365,24 @@ class DriftSequences:
         else:
             return np.array(self.boundaries)[boundary_idxs] + 0.5
 
+    def get_sequence_numbers(self, pulse_idxs):
+        '''
+        Like get_sequence_number(), but for an array of pulse indexes all at once.
+        Pulses outside the pulsestack are NOT given None, but are counted as part
+        of the first or last sequence.
+        '''
+        return np.searchsorted(np.array(self.boundaries), np.array(pulse_idxs) - 0.5, side='left')
+
+    def get_all_bounding_pulse_idxs(self, npulses):
+        '''
+        Returns arrays of the first and last pulse indexes of every sequence
+        (see get_bounding_pulse_idxs())
+        '''
+        boundaries = np.array(self.boundaries, dtype=int)
+        first_idxs = np.concatenate([[0], boundaries + 1])
+        last_idxs  = np.concatenate([boundaries, [npulses - 1]])
+        return first_idxs, last_idxs
+
     def get_sequence_number(self, pulse_idx, npulses):
         # There are lots of corner cases!
         # Remember, the first boundary sits between sequences 0 and 1,
@@ -348,10 +406,73 @@ class DriftSequences:
 
         return sequence_number
 
+class IncrementalLeastSquares:
+    '''
+    A linear least squares fit that is updated one point at a time, by keeping the
+    R factor of the QR decomposition of the design matrix (and Q^T y), and updating it
+    with Givens rotations as each new row comes in. Each update and each solution only
+    costs O(nparameters^2), however many points there are, and (unlike updating the
+    normal equations) the conditioning of the problem isn't squared.
+    '''
+    def __init__(self, nparameters):
+        self.nparameters = nparameters
+        self.R       = np.zeros((nparameters, nparameters))
+        self.qty     = np.zeros(nparameters)
+        self.rss     = 0.0 # The sum of the squared residuals of the current solution
+        self.npoints = 0
+
+    def add_point(self, row, y):
+        '''
+        Add one point, whose row of the design matrix is row, and whose value is y
+        '''
+        row = np.array(row, dtype=float)
+        for i in range(self.nparameters):
+            if row[i] == 0:
+                continue
+
+            # Rotate the new row into row i of R, zeroing its i'th element
+            r = np.hypot(self.R[i,i], row[i])
+            c = self.R[i,i]/r
+            s = row[i]/r
+
+            R_i = self.R[i,i:].copy()
+            self.R[i,i:] = c*R_i + s*row[i:]
+            row[i:]      = -s*R_i + c*row[i:]
+
+            qty_i = self.qty[i]
+            self.qty[i] = c*qty_i + s*y
+            y           = -s*qty_i + c*y
+
+        # Whatever is left of y can't be fitted by any parameters
+        self.rss += y**2
+        self.npoints += 1
+
+    def solve(self):
+        '''
+        Returns the parameters and their covariance (scaled by the reduced chi-squared,
+        as curve_fit does, so infinite if there are no more points than parameters),
+        or (None, None) if the points don't (yet) determine all the parameters
+        '''
+        if self.npoints < self.nparameters or np.any(np.abs(np.diag(self.R)) <= 1e-12*np.max(np.abs(self.R))):
+            return None, None
+
+        parameters = solve_triangular(self.R, self.qty)
+
+        dof = self.npoints - self.nparameters
+        if dof > 0:
+            R_inv = solve_triangular(self.R, np.eye(self.nparameters))
+            pcov = (R_inv @ R_inv.T)*self.rss/dof
+        else:
+            pcov = np.full((self.nparameters, self.nparameters), np.inf)
+
+        return parameters, pcov
+
 class ModelFit(pulsestack.Pulsestack):
     def __init__(self):
         self.parameters  = None
         self.pcov        = None
+        self.intervals   = None # Resampled confidence intervals (see resampling.py)
+        self.mcmc        = None # Where this model's MCMC chain is, and a summary of it (see mcmc.py)
 
         self.first_pulse = None
         self.last_pulse  = None
@@ -379,8 +500,13 @@ class ModelFit(pulsestack.Pulsestack):
                 return ["D_0", "k", "\\varphi_0", "P_2"]
             else:
                 return ["D0", "k", "phi0", "P2"]
+        elif self.model_name == "exponential_linear":
+            if display_type == "latex":
+                return ["\\tau_r", "D_0", "D_f", "\\varphi_0", "P_2"]
+            else:
+                return ["tau_r", "D0", "Df", "phi0", "P2"]
         else:
-            self.print_unecognised_model_error()
+            self.print_unrecognised_model_error()
 
     def get_parameter_by_name(self, parameter_name):
         try:
@@ -395,6 +521,8 @@ class ModelFit(pulsestack.Pulsestack):
             equation_string = "phi = a1*p^2 + a2*p + a3 + a4*d"
         elif self.model_name == "exponential":
             equation_string = "phi = (D0/k)*(1 - exp(-k*(p - p0)) + phi0 + P2*d)"
+        elif self.model_name == "exponential_linear":
+            equation_string = "phi = Df*(p - p0) + (D0 - Df)*tau_r*(1 - exp(-(p - p0)/tau_r)) + phi0 + P2*d"
         else:
             return "Unrecognised model '{}'".format(self.model)
 
@@ -405,8 +533,20 @@ class ModelFit(pulsestack.Pulsestack):
             model_string += "  {:4} = {}".format(parameter_names[i], self.parameters[i])
             if self.pcov is not None:
                 model_string += " +- {}".format(np.sqrt(self.pcov[i,i]))
+            if self.intervals is not None:
+                model_string += "  [{}, {}]".format(self.intervals["lower"][i], self.intervals["upper"][i])
             model_string += "\n"
 
+        if self.intervals is not None:
+            model_string += "  ({:.0f}% {} intervals from {} resamples; P3 at middle of sequence in [{}, {}])\n".format(
+                    100*self.intervals["confidence"], self.intervals["method"], self.intervals["nresamples"], *self.intervals["P3_mid"])
+
+        if self.mcmc is not None:
+            model_string += "MCMC posterior ({} walkers x {} steps, acceptance {:.2f}; median [16%, 84%]):\n".format(
+                    self.mcmc["nwalkers"], self.mcmc["nsteps"], self.mcmc["acceptance"])
+            for name, median, lower, upper in zip(self.mcmc["parameter_names"], self.mcmc["median"], self.mcmc["lower"], self.mcmc["upper"]):
+                model_string += "  {:4} = {} [{}, {}]\n".format(name, median, lower, upper)
+
         return model_string
 
     def print_unrecognised_model_error(self):
@@ -427,6 +567,10 @@ class ModelFit(pulsestack.Pulsestack):
         if new_model_name == self.model_name:
             return
 
+        # Any resampled intervals or MCMC chains were for the old model
+        self.intervals = None
+        self.mcmc      = None
+
         p0, pf = self.get_pulse_bounds()
 
         if new_model_name == "exponential":
@@ -443,6 +587,38 @@ class ModelFit(pulsestack.Pulsestack):
             self.parameters = [D0, k, phi0, P2]
             self.model_name = new_model_name
 
+        if new_model_name == "exponential_linear":
+            # This conversion keeps the phase and P2 of the driftbands at the beginning of the drift
+            # sequence the same. An exponential model converts exactly (with Df = 0). Otherwise,
+            # the drift rate is matched at the beginning, middle, and end of the sequence, which
+            # is only possible if it changes monotonically and ever more slowly. If it doesn't
+            # (e.g. a quadratic model, whose drift rate changes linearly), tau_r is set to the
+            # length of the sequence, and only the beginning and end drift rates are matched.
+            # It is NOT guaranteed that the phase of the driftbands match at the end of the drift
+            # sequence
+            P2   = self.calc_P2()
+            phi0 = self.calc_phase(p0, 0)
+
+            if self.model_name == "exponential":
+                D0, k, _, _ = self.parameters
+                tau_r = 1/k
+                Df    = 0.0
+            else:
+                D0 = self.calc_driftrate(p0)
+                Dm = self.calc_driftrate(0.5*(p0 + pf))
+                De = self.calc_driftrate(pf)
+
+                r = (De - Dm)/(Dm - D0) if Dm != D0 else 1.0
+                if r > 0 and r < 1:
+                    tau_r = -(pf - p0)/(2*np.log(r))
+                    Df    = D0 - (Dm - D0)/(r - 1)
+                else:
+                    tau_r = pf - p0
+                    Df    = (De - D0*np.exp(-1))/(1 - np.exp(-1))
+
+            self.parameters = [tau_r, D0, Df, phi0, P2]
+            self.model_name = new_model_name
+
         if new_model_name == "quadratic":
             # This conversion keeps the phase and P2 of the driftbands at the beginning of the drift
             # sequence the same, and chooses the quadratic model which matches the drift rate at
@@ -461,13 +637,21 @@ class ModelFit(pulsestack.Pulsestack):
             self.parameters = [a1, a2, a3, a4]
             self.model_name = new_model_name
 
-    def optimise_fit_to_subpulses(self, phases, pulses, driftbands):
+    def optimise_fit_to_subpulses(self, phases, pulses, driftbands, verbose=True):
+        '''
+        Least squares fit of the model to the subpulses (with the covariance scaled as
+        curve_fit does). If verbose is False, the fit isn't announced, and the covariance
+        not being estimable isn't reported; this is decided here, rather than by catching
+        curve_fit's warning, because the warning filters belong to the whole process, and
+        fits are also made in background threads.
+        '''
         # A valid model must be specified in self.model_name
         if self.model_name is None:
             print("Unspecified model. Cannot optimise model fit. Aborting")
             return
 
-        print("Fitting points to mode \"" + self.model_name + "\"")
+        if verbose == True:
+            print("Fitting points to mode \"" + self.model_name + "\"")
 
         # phases, pulses, and driftbands must be vectors with the same length
         npoints = len(phases)
@@ -480,9 +664,9 @@ class ModelFit(pulsestack.Pulsestack):
         p  = np.array(pulses)
         d  = np.array(driftbands)
 
-        # Get things in a form that curve_fit needs
-        xdata = np.array([p, d])
-        ydata = np.array(ph)
+        # Get things in the form that calc_phase_for_curvefit() needs
+        xdata = np.asarray_chkfinite(np.array([p, d]), dtype=float)
+        ydata = np.asarray_chkfinite(ph, dtype=float)
 
         # Use the existing model as the initial guess
         p0 = self.parameters
@@ -492,14 +676,35 @@ class ModelFit(pulsestack.Pulsestack):
                 p0 = np.ones((4,))
             elif self.model_name == "exponential":
                 p0 = np.ones((4,))
+            elif self.model_name == "exponential_linear":
+                p0 = np.ones((5,))
+
+        p0 = np.array(p0, dtype=float)
 
-        # Call curve_fit
-        popt, pcov = curve_fit(self.calc_phase_for_curvefit, xdata, ydata, p0=p0)
-        # TO DO: Include Jacobian in the above call to curve_fit
+        # Fit with the analytic Jacobian, as curve_fit would (i.e. with leastsq)
+        def residuals(params):
+            return self.calc_phase_for_curvefit(xdata, *params) - ydata
 
-        # Set these parameters!
+        def jacobian(params):
+            return self.calc_phase_jacobian_for_curvefit(xdata, *params)
+
+        popt, pcov, infodict, errmsg, ier = leastsq(residuals, p0, Dfun=jacobian, full_output=True)
+        if ier not in [1, 2, 3, 4]:
+            raise RuntimeError("Optimal parameters not found: " + errmsg)
+
+        # Scale the covariance by the reduced chi-squared
+        if pcov is None or np.any(np.isnan(pcov)) or npoints <= len(popt):
+            pcov = np.full((len(popt), len(popt)), np.inf)
+            if verbose == True:
+                print("Covariance of the parameters could not be estimated")
+        else:
+            pcov = pcov*np.sum(infodict["fvec"]**2)/(npoints - len(popt))
+
+        # Set these parameters! (Any resampled intervals or MCMC chains are now out of date)
         self.parameters = popt
         self.pcov       = pcov
+        self.intervals  = None
+        self.mcmc       = None
 
     def serialize(self):
         serialized = {}
@@ -516,6 +721,12 @@ class ModelFit(pulsestack.Pulsestack):
         if self.pcov is not None:
             serialized["pcov"] = list(self.pcov.flatten())
 
+        if self.intervals is not None:
+            serialized["intervals"] = copy.deepcopy(self.intervals)
+
+        if self.mcmc is not None:
+            serialized["mcmc"] = copy.deepcopy(self.mcmc)
+
         return serialized
 
     def unserialize(self, data):
@@ -537,8 +748,20 @@ class ModelFit(pulsestack.Pulsestack):
                     self.pcov = None
             else:
                 self.pcov = None
+
+            if "intervals" in data.keys():
+                self.intervals = copy.deepcopy(data["intervals"])
+            else:
+                self.intervals = None
+
+            if "mcmc" in data.keys():
+                self.mcmc = copy.deepcopy(data["mcmc"])
+            else:
+                self.mcmc = None
         else:
             self.parameters = None
+            self.intervals  = None
+            self.mcmc       = None
 
         if "pulse_range" in data.keys():
             self.first_pulse, self.last_pulse = data["pulse_range"]
@@ -561,6 +784,47 @@ class ModelFit(pulsestack.Pulsestack):
             D0, k, phi0, P2 = self.parameters
             return (D0/k)*(1 - np.exp(-k*(p - p0))) + phi0 + P2*d
 
+        elif self.model_name == "exponential_linear":
+            # The drift rate decays exponentially (with timescale tau_r) from D0 to Df
+            tau_r, D0, Df, phi0, P2 = self.parameters
+            t = p - p0
+            return Df*t + (D0 - Df)*tau_r*(1 - np.exp(-t/tau_r)) + phi0 + P2*d
+
+        else:
+            self.print_unrecognised_model_error()
+            return
+
+    def calc_phase_jacobian(self, pulse, driftband):
+        '''
+        Returns the derivatives of calc_phase() with respect to each of the model
+        parameters, as an array with shape (number of points, number of parameters).
+        As with calc_phase(), the parameters (and first_pulse) can also be arrays,
+        one element per point.
+        '''
+        p, d = np.broadcast_arrays(np.array(pulse, dtype=float), np.array(driftband, dtype=float))
+        p0 = self.first_pulse
+        ones = np.ones(p.shape)
+
+        if self.model_name == "quadratic":
+            return np.stack([p**2, p, ones, d], axis=-1)
+
+        elif self.model_name == "exponential":
+            D0, k, _, _ = self.parameters
+            t = p - p0
+            decay = np.exp(-k*t)
+            dphi_dD0 = (1 - decay)/k
+            dphi_dk  = -(D0/k**2)*(1 - decay) + (D0/k)*t*decay
+            return np.stack([dphi_dD0*ones, dphi_dk*ones, ones, d], axis=-1)
+
+        elif self.model_name == "exponential_linear":
+            tau_r, D0, Df, _, _ = self.parameters
+            t = p - p0
+            decay = np.exp(-t/tau_r)
+            dphi_dtau_r = (D0 - Df)*((1 - decay) - (t/tau_r)*decay)
+            dphi_dD0    = tau_r*(1 - decay)
+            dphi_dDf    = t - tau_r*(1 - decay)
+            return np.stack([dphi_dtau_r*ones, dphi_dD0*ones, dphi_dDf*ones, ones, d], axis=-1)
+
         else:
             self.print_unrecognised_model_error()
             return
@@ -578,6 +842,19 @@ class ModelFit(pulsestack.Pulsestack):
 
         return model.calc_phase(p, d)
 
+    def calc_phase_jacobian_for_curvefit(self, xdata, *params):
+        '''
+        A wrapper for calc_phase_jacobian(), so that it can be used with scipy's curvefit
+        '''
+
+        p = xdata[0,:]
+        d = xdata[1,:]
+
+        model = copy.copy(self)
+        model.parameters = np.array([*params])
+
+        return model.calc_phase_jacobian(p, d)
+
     def calc_driftrate(self, pulse):
         p  = pulse
         p0 = self.first_pulse
@@ -590,6 +867,10 @@ class ModelFit(pulsestack.Pulsestack):
             D0, k, _, _ = self.parameters
             return D0*np.exp(-k*(p - p0))
 
+        elif self.model_name == "exponential_linear":
+            tau_r, D0, Df, _, _ = self.parameters
+            return Df + (D0 - Df)*np.exp(-(p - p0)/tau_r)
+
         else:
             self.print_unrecognised_model_error()
             return
@@ -609,6 +890,10 @@ class ModelFit(pulsestack.Pulsestack):
             D0, k, _, _ = self.parameters
             return -k*D0*np.exp(-k*(p - p0))  # also could write -k*self.calc_driftrate(p)
 
+        elif self.model_name == "exponential_linear":
+            tau_r, D0, Df, _, _ = self.parameters
+            return -((D0 - Df)/tau_r)*np.exp(-(p - p0)/tau_r)
+
         else:
             self.print_unrecognised_model_error()
             return
@@ -630,10 +915,31 @@ class ModelFit(pulsestack.Pulsestack):
         This calculation is model-dependent, so in principle has to be done for each
         model separately (even though they may turn out to look the same in some cases)
         '''
+        idx = self.get_phase_parameter_idx()
+        if idx is None:
+            return
+
+        self.parameters[idx] += phase_shift
+
+        # Resampled intervals and MCMC summaries move with the parameter. The chain
+        # itself isn't rewritten; instead, the offset is applied when it is loaded
+        if self.intervals is not None:
+            self.intervals["lower"][idx] += phase_shift
+            self.intervals["upper"][idx] += phase_shift
+
+        if self.mcmc is not None:
+            for summary in ["median", "lower", "upper"]:
+                self.mcmc[summary][idx] += phase_shift
+            self.mcmc["phase_offset"] = self.mcmc.get("phase_offset", 0.0) + phase_shift
+
+    def get_phase_parameter_idx(self):
+        # Which parameter is the phase of the model at the first pulse (see shift_phase())
         if self.model_name == "quadratic":
-            self.parameters[2] += phase_shift
+            return 2
         elif self.model_name == "exponential":
-            self.parameters[2] += phase_shift
+            return 2
+        elif self.model_name == "exponential_linear":
+            return 3
         else:
             self.print_unrecognised_model_error()
             return
@@ -641,6 +947,7 @@ class ModelFit(pulsestack.Pulsestack):
     def get_nearest_driftband(self, pulse, phase):
         p  = pulse
         ph = phase
+        p0 = self.first_pulse
 
         if self.model_name == "quadratic":
             a1, a2, a3, a4 = self.parameters
@@ -650,6 +957,10 @@ class ModelFit(pulsestack.Pulsestack):
             D0, k, phi0, P2 = self.parameters
             return np.round((ph - (D0/k)*(1 - np.exp(-k*(p - p0))) - phi0)/P2)
 
+        elif self.model_name == "exponential_linear":
+            _, _, _, _, P2 = self.parameters
+            return np.round((ph - self.calc_phase(p, 0))/P2)
+
         else:
             self.print_unrecognised_model_error()
             return
@@ -664,6 +975,10 @@ class ModelFit(pulsestack.Pulsestack):
             _, _, _, P2 = self.parameters
             return P2
 
+        elif self.model_name == "exponential_linear":
+            _, _, _, _, P2 = self.parameters
+            return P2
+
         else:
             self.print_unrecognised_model_error()
             return
@@ -694,11 +1009,16 @@ class ModelFit(pulsestack.Pulsestack):
             D0, k, phi0, P2 = self.parameters
             d0 = np.ceil((ph0 - phi0)/P2)
             df = np.floor((phf - (D0/k)*(1 - np.exp(-k*(pf - p0))) - phi0)/P2)
+        elif self.model_name == "exponential_linear":
+            _, _, _, phi0, P2 = self.parameters
+            d0 = np.ceil((ph0 - phi0)/P2)
+            df = np.floor((phf - self.calc_phase(pf, 0))/P2)
         else:
             self.print_unrecognised_model_error()
             return
 
-        return [int(d0), int(df)]
+        # (For positive drift rates, the limits come out the other way around)
+        return [int(min(d0, df)), int(max(d0, df))]
 
     def plot_driftband(self, ax, driftband, phlim=None, pstep=1, **kwargs):
         '''
@@ -716,10 +1036,10 @@ class ModelFit(pulsestack.Pulsestack):
             ph = ph[in_phase_range]
 
         # If there's no part of this driftband that falls inside the phase range
-        # (and pulse range), then do nothing
+        # (and pulse range), then do nothing (except remove any previous plot of it)
         if len(p) == 0:
             if d in self.driftband_plts.keys():
-                self.driftband_plts.pop(d)
+                self.driftband_plts.pop(d)[0].set_data([], [])
             return
 
         if d in self.driftband_plts.keys():
@@ -732,6 +1052,37 @@ class ModelFit(pulsestack.Pulsestack):
         for d in range(first_d, last_d+1):
             self.plot_driftband(ax, d, phlim=phlim, pstep=pstep, **kwargs)
 
+    def update_all_driftbands(self, ax, phlim, pstep=1, **kwargs):
+        '''
+        Like plot_all_driftbands(), but for a model that is already plotted and has just
+        changed: the existing lines are moved (rather than cleared and plotted again), new
+        lines are only made for driftbands that have come into range, and lines are only
+        removed for those that have gone out of range. All the driftbands are calculated
+        in one go.
+        '''
+        first_d, last_d = self.get_driftband_range(phlim)
+        driftbands = np.arange(first_d, last_d+1)
+
+        # Remove the driftbands that are no longer in range
+        for d in list(self.driftband_plts.keys()):
+            if d < first_d or d > last_d:
+                self.driftband_plts.pop(d)[0].set_data([], [])
+
+        p  = np.arange(self.first_pulse, self.last_pulse + pstep, pstep)
+        phs = self.calc_phase(p[:,np.newaxis], driftbands[np.newaxis,:])
+        in_phase_range = np.logical_and(phs >= phlim[0], phs <= phlim[1])
+
+        for i, d in enumerate(driftbands):
+            d = int(d)
+            ph = phs[in_phase_range[:,i],i]
+            if len(ph) == 0:
+                if d in self.driftband_plts.keys():
+                    self.driftband_plts.pop(d)[0].set_data([], [])
+            elif d in self.driftband_plts.keys():
+                self.driftband_plts[d][0].set_data(ph, p[in_phase_range[:,i]])
+            else:
+                self.driftband_plts[d] = ax.plot(ph, p[in_phase_range[:,i]], **kwargs)
+
     def clear_all_plots(self):
         for d in self.driftband_plts:
             self.driftband_plts[d][0].set_data([], [])
@@ -747,35 +1098,64 @@ class DriftAnalysis(pulsestack.Pulsestack):
         self.maxima_threshold          = 0.0
         self.drift_sequences           = DriftSequences()
         self.dm_boundary_plt           = None
+        self.join_plts                 = []  # Lines marking the joins between concatenated observations
         self.jsonfile                  = None
         self.candidate_quadratic_model = ModelFit()
         self.candidate_quadratic_model.model_name = "quadratic"
         self.onpulse                   = None
         self.model_fits            = {}  # Keys = drift sequence numbers
+        self.drift_mode_labels     = {}  # Keys = drift sequence numbers, values = mode labels (e.g. "A", "B", "N")
+        self.model_time_series     = None  # See get_model_time_series()
+        self.model_time_series_key = None
         self.quadratic_visible         = True
+        self.history                   = history.EditHistory()
+        self.journal                   = None
+        self.journal_pending           = None # The (jsonfile, nentries) of a journal to be started (or continued) by the next edit
+        self.journal_generation        = 0
+        self.journal_compact_every     = 500 # Number of journal entries before the session file is rewritten in full
 
-    def get_local_maxima(self, maxima_threshold=None):
+    def get_local_maxima(self, maxima_threshold=None, pulses_per_block=4096):
         if maxima_threshold is None:
             maxima_threshold = self.maxima_threshold
         else:
             self.maxima_threshold = maxima_threshold
 
-        is_bigger_than_left  = self.values[:,1:-1] >= self.values[:,:-2]
-        is_bigger_than_right = self.values[:,1:-1] >= self.values[:,2:]
-        is_local_max = np.logical_and(is_bigger_than_left, is_bigger_than_right)
+        # Go through the pulses a block at a time, so that (e.g.) concatenated
+        # observations are only read in a piece at a time
+        max_locations = []
+        for i in range(0, self.npulses, pulses_per_block):
+            values = np.asarray(self.values[i:i+pulses_per_block])
+
+            is_bigger_than_left  = values[:,1:-1] >= values[:,:-2]
+            is_bigger_than_right = values[:,1:-1] >= values[:,2:]
+            is_local_max = np.logical_and(is_bigger_than_left, is_bigger_than_right)
 
-        if maxima_threshold is not None:
-            is_local_max = np.logical_and(is_local_max, self.values[:,1:-1] > maxima_threshold)
+            if maxima_threshold is not None:
+                is_local_max = np.logical_and(is_local_max, values[:,1:-1] > maxima_threshold)
 
-        self.max_locations = np.array(np.where(is_local_max)).astype(float)
+            block_max_locations = np.array(np.where(is_local_max)).astype(float)
+            block_max_locations[0,:] += i
+            max_locations.append(block_max_locations)
+
+        self.max_locations = np.concatenate(max_locations, axis=1) if len(max_locations) > 0 else np.empty((2, 0))
 
         # Add one to phase (bin) locations because of previous splicing
         self.max_locations[1,:] += 1
 
         # Convert locations to data coordinates (pulse and phase)
-        self.max_locations[0,:] = self.max_locations[0,:]*self.dpulse + self.first_pulse
+        self.max_locations[0,:] = self.get_pulse_from_bin(self.max_locations[0,:])
         self.max_locations[1,:] = self.max_locations[1,:]*self.dphase_deg + self.first_phase
 
+    def load_concatenated(self, pdvfiles, stokes, gaps=None):
+        '''
+        Load several observations as one pulsestack (see Pulsestack.load_concatenated()),
+        with a drift mode boundary at each join, so that no drift sequence spans two
+        observations
+        '''
+        super().load_concatenated(pdvfiles, stokes, gaps=gaps)
+        for gap in self.concatenation.get_gap_records():
+            self.drift_sequences.add_boundary(gap["row"] - 1)
+
     def save_json(self, jsonfile=None):
 
         if jsonfile is None:
@@ -791,48 +1171,1210 @@ class DriftAnalysis(pulsestack.Pulsestack):
         if not jsonfile:
             return
 
-        drift_dict = {
+        # Anything still queued for the journal (e.g. a compaction) is written first, so
+        # that it can't overwrite this save. If this save fails, the journal is carried on
+        # with by the next edit (unless it can't be written either).
+        if self.journal is not None:
+            self.journal.close()
+            self.journal_generation = self.journal.generation
+            if self.journal.error is None:
+                self.journal_pending = (self.journal.jsonfile, self.journal.nentries)
+            else:
+                self.journal_pending = None
+            self.journal = None
+
+        drift_dict = self.serialize_session()
+        drift_dict["journal_generation"] = self.journal_generation + 1
+
+        try:
+            journal.write_session_file(jsonfile, drift_dict)
+            self.jsonfile = jsonfile
+
+        except (TypeError, OSError) as err:
+            print("Could not save out json file:", err)
+            return False
+
+        # Everything in the journal is now in the session file, so a new one is started
+        # with the next edit. (When saving as a different file, the old journal still
+        # belongs with the old file.)
+        if os.path.exists(journal.journal_filename(jsonfile)):
+            os.remove(journal.journal_filename(jsonfile))
+        self.journal_generation += 1
+        self.journal_pending = (jsonfile, 0)
+        return True
+
+    def serialize_session(self):
+        '''
+        Returns the whole session as a (JSON-serializable) dictionary
+        '''
+        return {
                 "version":             __version__,
                 "pulsestack":          self.serialize(),
                 "subpulses":           self.subpulses.serialize(),
                 "model_fits":          [[int(i), self.model_fits[i].serialize()] for i in self.model_fits],
+                "drift_mode_labels":   [[int(i), self.drift_mode_labels[i]] for i in self.drift_mode_labels],
 
                 "maxima_threshold":    self.maxima_threshold,
-                "drift_mode_boundaries": self.drift_sequences.serialize()
+                "drift_mode_boundaries": self.drift_sequences.serialize(),
                 }
 
-        try:
-            with open(jsonfile, "w") as f:
-                json.dump(drift_dict, f)
+    def unserialize_session(self, drift_dict):
+        '''
+        The reverse of serialize_session()
+        '''
+        if drift_dict["version"] != __version__:
+            print("Warning: version mismatch, File = {}, Software = {}".format(drift_dict["version"], __version__))
 
-            self.jsonfile = jsonfile
+        # Load the pulsestack data
+        self.unserialize(drift_dict["pulsestack"])
+        self.subpulses.unserialize(drift_dict["subpulses"])
 
-        except TypeError as err:
-            print("Could not save out json file:", err)
+        self.model_fits = {}
+        for item in drift_dict["model_fits"]:
+            self.model_fits[item[0]] = ModelFit()
+            self.model_fits[item[0]].unserialize(item[1])
+
+        # (Older files don't have any mode labels)
+        self.drift_mode_labels = {}
+        if "drift_mode_labels" in drift_dict.keys():
+            for item in drift_dict["drift_mode_labels"]:
+                self.drift_mode_labels[item[0]] = item[1]
+
+        self.maxima_threshold = drift_dict["maxima_threshold"]
+        self.drift_sequences.unserialize(drift_dict["drift_mode_boundaries"])
+
+    def save_journal(self):
+        '''
+        Make sure all edits made so far are safely on disk. This only costs as much
+        as the edits made since the last call; if there is no journal yet (i.e. the
+        session has never been saved), or it can't be written, the whole session is saved
+        instead. Returns whether everything is now on disk.
+        '''
+        if self.journal is not None:
+            self.journal.flush()
+            if self.journal.error is None:
+                return True
+            print("The journal could not be written, so saving the whole session instead")
+        elif self.journal_pending is not None:
+            return True
+
+        return self.save_json() == True
+
+    def record_in_journal(self, entry):
+        '''
+        Add an entry to the journal, compacting the journal into the session file
+        if it has grown too long. The journal is only started (or, after loading, continued)
+        here, so that sessions that are only read leave no journal behind.
+        '''
+        if self.journal is None:
+            if self.journal_pending is None:
+                return
+            jsonfile, nentries = self.journal_pending
+            self.journal_pending = None
+            try:
+                self.journal = journal.Journal(jsonfile, self.journal_generation, nentries=nentries)
+            except OSError as err:
+                print("Could not start the journal {}: {}".format(journal.journal_filename(jsonfile), err))
+                return
+
+        self.journal.append(entry)
+
+        if self.journal.nentries >= self.journal_compact_every and self.journal.compaction is None and self.journal.error is None:
+            self.compact_journal()
+
+    def compact_journal(self):
+        '''
+        Fold the journal into the session file. Only the serialization is done here;
+        the file is written (and the new journal started) by the journal's own thread,
+        after the entries already in the journal (see Journal.compact())
+        '''
+        drift_dict = self.serialize_session()
+        drift_dict["journal_generation"] = self.journal.generation + 1
+        self.journal.compact(drift_dict, self.journal.generation + 1)
 
     def load_json(self, jsonfile=None):
 
         if jsonfile is None:
             jsonfile = self.jsonfile
 
-        with open(jsonfile, "r") as f:
-            drift_dict = json.load(f)
+        with open(jsonfile, "r") as f:
+            drift_dict = json.load(f)
+
+        self.unserialize_session(drift_dict)
+
+        if "journal_generation" in drift_dict.keys():
+            self.journal_generation = drift_dict["journal_generation"]
+        else:
+            self.journal_generation = 0
+
+        self.jsonfile = jsonfile
+
+        # Nothing from before loading can be undone
+        self.history.clear()
+
+        # Recover any edits that were made since the file was last saved in full
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.journal_pending = None
+
+        entries = journal.read_journal(jsonfile, self.journal_generation)
+        if len(entries) > 0:
+            print("Replaying {} edit(s) from {}".format(len(entries), journal.journal_filename(jsonfile)))
+            for entry in entries:
+                self.replay_journal_entry(entry)
+
+        self.journal_pending = (jsonfile, len(entries))
+
+    def replay_journal_entry(self, entry):
+        '''
+        Redo whatever a journal entry (see journal.make_entry()) records. Undos and redos
+        go through the history if the edit they refer to is in it; otherwise (i.e. the edit
+        was made before the journal was started), the edit is rebuilt from the entry.
+        '''
+        if entry["kind"] not in ["undo", "redo"]:
+            self.perform_edit(history.Edit(entry["kind"], **entry["forward"]))
+            return
+
+        stack = self.history.undo_stack if entry["kind"] == "undo" else self.history.redo_stack
+        if len(stack) > 0 and journal.is_same_edit(stack[-1], entry["edit"]):
+            if entry["kind"] == "undo":
+                self.undo()
+            else:
+                self.redo()
+            return
+
+        edit = history.Edit(entry["edit"]["kind"], **entry["edit"]["forward"])
+        if entry["kind"] == "undo":
+            edit.backward = entry["edit"]["backward"]
+            self.apply_edit(edit, undo=True)
+            self.history.push_redo(edit)
+        else:
+            self.apply_edit(edit)
+            self.history.push_undo(edit)
+
+    def set_model_fit(self, seq, serialized_model_fit):
+        '''
+        Replace (or remove, if serialized_model_fit is None) the model fit for
+        drift sequence seq
+        '''
+        if seq in self.model_fits.keys():
+            self.model_fits[seq].clear_all_plots()
+            self.model_fits.pop(seq)
+
+        if serialized_model_fit is not None:
+            self.model_fits[seq] = ModelFit()
+            self.model_fits[seq].unserialize(serialized_model_fit)
+
+    def set_drift_mode_label(self, seq, label):
+        '''
+        Label drift sequence seq as belonging to a particular drift mode (e.g. "A", "B",
+        or "N" for nulls). A label of None removes the sequence's label.
+        '''
+        if label is None:
+            if seq in self.drift_mode_labels.keys():
+                del self.drift_mode_labels[seq]
+        else:
+            self.drift_mode_labels[seq] = label
+
+    def add_drift_mode_boundary(self, pulse_idx):
+        '''
+        Adds a drift mode boundary after pulse_idx, splitting the drift sequence it
+        falls in. Returns the (original) sequence number of the split sequence.
+        '''
+        # Before actually adding the boundary, we have to consider how adding it
+        # will affect the model fits. Only two changes have to be made:
+        #   1) all model fits to later sequences have to be assigned a new
+        #      (higher) sequence number
+        #   2) the fit for the selected sequence should be copied to the two "new"
+        #      sequences, with the appropriate adjustments to the pulse ranges
+        seq = self.drift_sequences.get_sequence_number(pulse_idx, self.npulses)
+        nseq = self.drift_sequences.number_of_sequences()
+
+        # 1.
+        # Start from the last sequence and work down, bumping each one up by 1 as we go
+        for i in range(nseq, seq, -1):
+            if i in self.model_fits.keys():
+                self.model_fits[i+1] = self.model_fits.pop(i)
+            if i in self.drift_mode_labels.keys():
+                self.drift_mode_labels[i+1] = self.drift_mode_labels.pop(i)
+
+        # 2.
+        if seq in self.model_fits.keys():
+            self.model_fits[seq+1] = copy.copy(self.model_fits[seq])
+            self.model_fits[seq+1].parameters = copy.copy(self.model_fits[seq].parameters)
+            # (shift_phase() changes these in place, so the two halves can't share them)
+            self.model_fits[seq+1].intervals = copy.deepcopy(self.model_fits[seq].intervals)
+            self.model_fits[seq+1].mcmc = copy.deepcopy(self.model_fits[seq].mcmc)
+            self.model_fits[seq+1].driftband_plts = {}
+            self.model_fits[seq].last_pulse = self.get_pulse_from_bin(pulse_idx)
+            self.model_fits[seq+1].first_pulse = self.get_pulse_from_bin(pulse_idx + 1)
+
+        # Both halves of a split sequence keep its mode label
+        if seq in self.drift_mode_labels.keys():
+            self.drift_mode_labels[seq+1] = self.drift_mode_labels[seq]
+
+        # Now actually add the boundary
+        self.drift_sequences.add_boundary(pulse_idx)
+
+        return seq
+
+    def delete_drift_mode_boundary(self, boundary_idx):
+        '''
+        Deletes the boundary_idx'th drift mode boundary, merging the two drift
+        sequences on either side of it
+        '''
+        # Before actually deleting the boundary, we have to consider how deleting
+        # it will affect the model fits. Only two changes have to be made:
+        #   1) the fits for the immediately affected sequences should be deleted,
+        #      as there's no (easy) way to decide which of the two surrounding
+        #      sequences should take precedence
+        #   2) all model fits to later sequences have to be assigned a new
+        #      (lower) sequence number
+        seq = boundary_idx
+        nseq = self.drift_sequences.number_of_sequences()
+
+        # 1.
+        self.set_model_fit(seq, None)
+        self.set_model_fit(seq+1, None)
+
+        # (The merged sequence only keeps a mode label if both sides agree on it)
+        if self.drift_mode_labels.get(seq) != self.drift_mode_labels.get(seq+1):
+            self.set_drift_mode_label(seq, None)
+        self.set_drift_mode_label(seq+1, None)
+
+        # 2.
+        # Start from the next sequence and work up, bumping each one down by 1 as we go
+        for i in range(seq+2, nseq):
+            if i in self.model_fits.keys():
+                self.model_fits[i-1] = self.model_fits.pop(i)
+            if i in self.drift_mode_labels.keys():
+                self.drift_mode_labels[i-1] = self.drift_mode_labels.pop(i)
+
+        # Now, actually delete the selected boundary
+        self.drift_sequences.delete_boundaries([boundary_idx])
+
+    def perform_edit(self, edit):
+        '''
+        Apply an edit (a history.Edit object) to this session, and record it
+        so that it can be undone later
+        '''
+        self.apply_edit(edit)
+        self.history.record(edit)
+        self.record_in_journal(journal.make_entry(edit))
+        return edit
+
+    def undo(self):
+        '''
+        Undo the most recent edit. Returns the edit that was undone, or None
+        if there was nothing to undo
+        '''
+        edit = self.history.pop_undo()
+        if edit is None:
+            return None
+
+        self.apply_edit(edit, undo=True)
+        self.history.push_redo(edit)
+        self.record_in_journal(journal.make_entry(edit, "undo"))
+        return edit
+
+    def redo(self):
+        '''
+        Redo the most recently undone edit. Returns the edit that was redone,
+        or None if there was nothing to redo
+        '''
+        edit = self.history.pop_redo()
+        if edit is None:
+            return None
+
+        self.apply_edit(edit)
+        self.history.push_undo(edit)
+        self.record_in_journal(journal.make_entry(edit, "redo"))
+        return edit
+
+    def apply_edit(self, edit, undo=False):
+        '''
+        Apply (or, if undo is True, reverse) an edit.
+        When applying, edit.backward is (re)filled with only those parts of the
+        session that the edit is about to change.
+        '''
+        f = edit.forward
+
+        if not undo:
+            edit.discard()
+            edit.backward = {}
+        b = edit.backward
+
+        if edit.kind == "add_subpulses":
+            if undo:
+                nsubpulses = self.subpulses.get_nsubpulses()
+                self.subpulses.delete_subpulses(np.arange(nsubpulses - b["nrows"], nsubpulses))
+            else:
+                rows = np.reshape(f["rows"], (-1, 4)).astype(float)
+                b["nrows"] = len(rows)
+                self.subpulses.add_subpulses(rows[:,0], rows[:,1], widths=rows[:,2], driftbands=rows[:,3])
+
+        elif edit.kind == "delete_subpulses":
+            if undo:
+                # Indices of deleted rows are sorted, so each one is shifted down by the
+                # number of deleted rows before it
+                idxs = np.atleast_1d(b["idxs"]).astype(int)
+                rows = np.reshape(b["rows"], (len(idxs), -1)).astype(float)
+                if self.subpulses.data is None:
+                    self.subpulses.data = np.empty((0, rows.shape[1]))
+                self.subpulses.data = np.insert(self.subpulses.data, idxs - np.arange(len(idxs)), rows, axis=0)
+            else:
+                idxs = np.unique(np.atleast_1d(f["idxs"]).astype(int))
+                b["idxs"] = idxs
+                b["rows"] = self.subpulses.data[idxs,:].copy()
+                self.subpulses.delete_subpulses(idxs)
+
+        elif edit.kind == "replace_subpulses":
+            if undo:
+                self.subpulses.data = None if b["rows"] is None else np.array(b["rows"], dtype=float)
+            else:
+                b["rows"] = None if self.subpulses.data is None else self.subpulses.data.copy()
+                rows = np.reshape(f["rows"], (-1, 4)).astype(float)
+                self.subpulses.delete_all_subpulses()
+                self.subpulses.add_subpulses(rows[:,0], rows[:,1], widths=rows[:,2], driftbands=rows[:,3])
+
+        elif edit.kind == "assign_driftbands":
+            if undo:
+                self.subpulses.set_driftbands(np.asarray(b["driftbands"], dtype=float), subset=np.atleast_1d(b["idxs"]).astype(int))
+            else:
+                model_fit = self.model_fits[f["seq"]]
+                subset = self.subpulses.in_pulse_range(np.array(model_fit.get_pulse_bounds()))
+                b["idxs"] = np.flatnonzero(subset)
+                b["driftbands"] = self.subpulses.get_driftbands(subset=subset).copy()
+                self.subpulses.assign_driftbands_to_subpulses(model_fit)
+
+        elif edit.kind == "set_subpulse_widths":
+            if undo:
+                idxs = np.atleast_1d(b["idxs"]).astype(int)
+                self.subpulses.set_phases(np.asarray(b["phases"], dtype=float), subset=idxs)
+                self.subpulses.set_widths(np.asarray(b["widths"], dtype=float), subset=idxs)
+            else:
+                idxs = np.atleast_1d(f["idxs"]).astype(int)
+                b["idxs"]   = idxs
+                b["phases"] = self.subpulses.get_phases(subset=idxs).copy()
+                b["widths"] = self.subpulses.get_widths(subset=idxs).copy()
+                self.subpulses.set_phases(np.asarray(f["phases"], dtype=float), subset=idxs)
+                self.subpulses.set_widths(np.asarray(f["widths"], dtype=float), subset=idxs)
+
+        elif edit.kind == "clip_driftbands":
+            if undo:
+                idxs = np.atleast_1d(b["idxs"]).astype(int)
+                self.subpulses.set_driftbands(np.asarray(b["driftbands"], dtype=float), subset=idxs)
+                self.subpulses.set_rejected(np.asarray(b["rejected"], dtype=bool), subset=idxs)
+                for seq, model_fit in zip(f["seqs"], b["model_fits"]):
+                    self.set_model_fit(seq, model_fit)
+            else:
+                idxs = np.atleast_1d(f["idxs"]).astype(int)
+                b["idxs"]       = idxs
+                b["driftbands"] = self.subpulses.get_driftbands(subset=idxs).copy()
+                b["rejected"]   = self.subpulses.get_rejected(subset=idxs).copy()
+                b["model_fits"] = [self.model_fits[seq].serialize() for seq in f["seqs"]]
+                self.subpulses.set_driftbands(np.asarray(f["driftbands"], dtype=float), subset=idxs)
+                self.subpulses.set_rejected(np.asarray(f["rejected"], dtype=bool), subset=idxs)
+                for seq, model_fit in zip(f["seqs"], f["model_fits"]):
+                    self.set_model_fit(seq, model_fit)
+
+        elif edit.kind == "add_boundary":
+            if undo:
+                boundary_idx = self.drift_sequences.boundaries.index(f["pulse_idx"])
+                self.delete_drift_mode_boundary(boundary_idx)
+                self.set_model_fit(b["seq"], b["model_fit"])
+                self.set_drift_mode_label(b["seq"], b.get("label"))
+            else:
+                seq = self.drift_sequences.get_sequence_number(f["pulse_idx"], self.npulses)
+                b["seq"] = seq
+                b["model_fit"] = self.model_fits[seq].serialize() if seq in self.model_fits.keys() else None
+                b["label"] = self.drift_mode_labels.get(seq)
+                self.add_drift_mode_boundary(f["pulse_idx"])
+
+        elif edit.kind == "delete_boundary":
+            seq = f["boundary_idx"]
+            if undo:
+                self.add_drift_mode_boundary(b["pulse_idx"])
+                self.set_model_fit(seq, b["model_fits"][0])
+                self.set_model_fit(seq+1, b["model_fits"][1])
+                self.set_drift_mode_label(seq, b["labels"][0])
+                self.set_drift_mode_label(seq+1, b["labels"][1])
+            else:
+                b["pulse_idx"] = self.drift_sequences.boundaries[seq]
+                b["model_fits"] = [self.model_fits[i].serialize() if i in self.model_fits.keys() else None for i in [seq, seq+1]]
+                b["labels"] = [self.drift_mode_labels.get(i) for i in [seq, seq+1]]
+                self.delete_drift_mode_boundary(seq)
+
+        elif edit.kind == "set_model_fit":
+            if undo:
+                self.set_model_fit(f["seq"], b["model_fit"])
+            else:
+                b["model_fit"] = self.model_fits[f["seq"]].serialize() if f["seq"] in self.model_fits.keys() else None
+                self.set_model_fit(f["seq"], f["model_fit"])
+
+        elif edit.kind == "set_model_fits":
+            # (As "set_model_fit", but for several drift sequences at once)
+            if undo:
+                for seq, model_fit in zip(f["seqs"], b["model_fits"]):
+                    self.set_model_fit(seq, model_fit)
+            else:
+                b["model_fits"] = [self.model_fits[seq].serialize() if seq in self.model_fits.keys() else None for seq in f["seqs"]]
+                for seq, model_fit in zip(f["seqs"], f["model_fits"]):
+                    self.set_model_fit(seq, model_fit)
+
+        elif edit.kind == "set_mode_label":
+            if undo:
+                self.set_drift_mode_label(f["seq"], b["label"])
+            else:
+                b["label"] = self.drift_mode_labels.get(f["seq"])
+                self.set_drift_mode_label(f["seq"], f["label"])
+
+        elif edit.kind == "set_fiducial":
+            phase_deg = -f["phase_deg"] if undo else f["phase_deg"]
+
+            self.set_fiducial_phase(phase_deg)
+
+            if self.subpulses.get_nsubpulses() > 0:
+                self.subpulses.shift_all_subpulses(dphase=-phase_deg)
+
+            for i in self.model_fits:
+                self.model_fits[i].shift_phase(-phase_deg)
+
+        elif edit.kind == "set_onpulse":
+            if undo:
+                self.onpulse = b["onpulse"]
+            else:
+                b["onpulse"] = self.onpulse
+                self.set_onpulse(*f["onpulse"])
+
+        elif edit.kind == "set_stokes":
+            if undo:
+                self.set_stokes(b["stokes"])
+            else:
+                b["stokes"] = self.stokes
+                self.set_stokes(f["stokes"])
+
+        elif edit.kind == "crop":
+            if undo and b.get("concatenated") == True:
+                # The pre-crop view of concatenated observations is just made again
+                r, c = b["source_bin_offset"]
+                self.values = self.concatenation.get_values(self.values.stokes)[r:r+b["shape"][0], c:c+b["shape"][1]]
+                self.npulses, self.nbins = self.values.shape
+                self.values_changed()
+                self.first_pulse, self.first_phase, pulse_numbers = b["geometry"]
+                self.pulse_numbers = None if pulse_numbers is None else np.array(pulse_numbers, dtype=float)
+                self.source_bin_offset = b["source_bin_offset"]
+            elif undo:
+                # Reassemble the pre-crop pulsestack from the cropped one and the
+                # margins that were cut away
+                # (Margins that were spilled to disk come back as a dictionary, either
+                # from the spill file, or from a journal entry if the edit was replayed)
+                if edit.spillfile is not None or "spilled" in b.keys():
+                    margins = edit.unspill() if edit.spillfile is not None else b["spilled"]
+                    top, bottom, left, right = margins["top"], margins["bottom"], margins["left"], margins["right"]
+                else:
+                    top, bottom, left, right = b["margins"]
+
+                r0, r1, c0, c1 = b["bin_ranges"]
+                nrows, ncols = b["shape"]
+                values = np.empty((nrows, ncols), dtype=self.values.dtype)
+                values[:r0,:]      = np.reshape(top, (r0, ncols))
+                values[r1:,:]      = np.reshape(bottom, (nrows - r1, ncols))
+                values[r0:r1,:c0]  = np.reshape(left, (r1 - r0, c0))
+                values[r0:r1,c1:]  = np.reshape(right, (r1 - r0, ncols - c1))
+                values[r0:r1,c0:c1] = self.values
+
+                self.values = values
+                self.npulses, self.nbins = values.shape
+                self.values_changed()
+                self.first_pulse, self.first_phase, pulse_numbers = b["geometry"]
+                self.pulse_numbers = None if pulse_numbers is None else np.array(pulse_numbers, dtype=float)
+                self.source_bin_offset = b["source_bin_offset"]
+            else:
+                pulse_bin_range, phase_bin_range = self.get_crop_bin_ranges(f["pulse_range"], f["phase_deg_range"])
+                r0, r1 = pulse_bin_range
+                c0, c1 = phase_bin_range
+
+                b["bin_ranges"] = [r0, r1, c0, c1]
+                b["shape"]      = list(self.values.shape)
+                b["geometry"]   = [self.first_pulse, self.first_phase, None if self.pulse_numbers is None else self.pulse_numbers.tolist()]
+                b["source_bin_offset"] = self.source_bin_offset
+
+                if self.is_concatenated():
+                    # (Cropping these only makes a smaller view of them, see concatenation.py,
+                    # so undoing it only needs the shape and offset of the view)
+                    b["concatenated"] = True
+                else:
+                    # Only the parts that are cut away need to be kept. (Copies are
+                    # needed, because views would keep the whole stack alive.)
+                    margins = [self.values[:r0,:].copy(),
+                               self.values[r1:,:].copy(),
+                               self.values[r0:r1,:c0].copy(),
+                               self.values[r0:r1,c1:].copy()]
+
+                    if self.history.keep_in_memory(sum([m.nbytes for m in margins])):
+                        b["margins"] = margins
+                    else:
+                        edit.spill(top=margins[0], bottom=margins[1], left=margins[2], right=margins[3])
+
+                self.crop(pulse_range=f["pulse_range"], phase_deg_range=f["phase_deg_range"])
+
+        else:
+            print("Unrecognised edit '{}'".format(edit.kind))
+
+    def get_subpulse_table(self):
+        '''
+        Returns a dictionary of arrays describing every subpulse, as written to .subpulses files:
+          mode           - the mode label of the subpulse's drift sequence (or "None")
+          sequence       - the drift sequence number
+          phase          - phase (deg)
+          pulse_in_seq   - pulse number, counted from the start of the sequence
+          pulse          - pulse number
+          pulse_from_end - pulse number, counted (negatively) from the end of the sequence
+          driftrate      - the drift rate (deg/pulse) of the sequence's model fit at that
+                           pulse (NaN if the sequence has no model fit)
+          rejected       - whether the subpulse was rejected as an outlier (see calc_clipped_driftbands())
+        '''
+        if self.subpulses.get_nsubpulses() == 0:
+            phases = np.empty((0,))
+            pulses = np.empty((0,))
+            rejected = np.empty((0,), dtype=bool)
+        else:
+            phases = self.subpulses.get_phases()
+            pulses = self.subpulses.get_pulses()
+            rejected = self.subpulses.get_rejected()
+
+        pulse_idxs = self.get_pulse_bin(pulses, inrange=False)
+        seqs = self.drift_sequences.get_sequence_numbers(pulse_idxs)
+        first_idxs, last_idxs = self.drift_sequences.get_all_bounding_pulse_idxs(self.npulses)
+
+        driftrates = np.full(pulses.shape, np.nan)
+        for seq in self.model_fits:
+            in_seq = seqs == seq
+            driftrates[in_seq] = self.model_fits[seq].calc_driftrate(pulses[in_seq])
+
+        labels = np.array([str(self.drift_mode_labels.get(i)) for i in range(len(first_idxs))], dtype=object)
+
+        return {
+                "mode":           labels[seqs],
+                "sequence":       seqs,
+                "phase":          phases,
+                "pulse_in_seq":   pulses - self.get_pulse_from_bin(first_idxs[seqs]),
+                "pulse":          pulses,
+                "pulse_from_end": pulses - self.get_pulse_from_bin(last_idxs[seqs]),
+                "driftrate":      driftrates,
+                "rejected":       rejected,
+                }
+
+    def get_model_fits_key(self):
+        '''
+        A summary of everything about the model fits (and pulse geometry) that
+        get_model_time_series() depends on. Model parameters are changed in place
+        in several places, so this is cheaper and safer than tracking every change.
+        '''
+        return (self.first_pulse, self.dpulse, self.npulses,
+                None if self.pulse_numbers is None else self.pulse_numbers.tobytes(),
+                tuple((seq, self.model_fits[seq].model_name, tuple(np.ravel(self.model_fits[seq].parameters)),
+                    self.model_fits[seq].first_pulse, self.model_fits[seq].last_pulse,
+                    None if self.model_fits[seq].pcov is None else np.asarray(self.model_fits[seq].pcov).tobytes())
+                    for seq in sorted(self.model_fits.keys()) if self.model_fits[seq].parameters is not None))
+
+    def get_model_time_series(self):
+        '''
+        Evaluate the drift rate, its derivative, the drift rate decay rate, and P3 at every
+        pulse of every drift sequence that has a model fit, into contiguous arrays (ordered
+        by sequence). Each kind of model is evaluated in one go for all of its sequences.
+        The result is cached until any model fit changes.
+
+        Returns a dictionary with the per-pulse arrays "seqs", "pulses", "driftrate",
+        "driftrate_derivative", "decay_rate", and "P3", the indexes at which each new
+        sequence starts ("breaks", not including 0), and "models", a dictionary (keyed
+        by model name) of per-sequence arrays: "seqs", "pmid" and "perr" (the middle
+        and half-width of each sequence's pulse range), "parameters", "parameter_errors"
+        (NaN if there is no pcov), and "driftrate_mid" and "driftrate_derivative_mid"
+        (evaluated at pmid).
+        '''
+        key = self.get_model_fits_key()
+        if self.model_time_series is not None and self.model_time_series_key == key:
+            return self.model_time_series
+
+        seqs = [seq for seq in sorted(self.model_fits.keys()) if self.model_fits[seq].parameters is not None]
+
+        # The (inclusive) range of pulse bins covered by each model
+        pulse_ranges = np.array([self.model_fits[seq].get_pulse_bounds() for seq in seqs], dtype=float).reshape(-1, 2)
+        idx_ranges = np.round(self.get_pulse_bin(pulse_ranges)).astype(int).reshape(-1, 2)
+        lengths = idx_ranges[:,1] - idx_ranges[:,0] + 1
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(int)
+
+        # Lay all the pulses of all the sequences end to end
+        nall = np.sum(lengths)
+        which = np.repeat(np.arange(len(seqs)), lengths) # Index into seqs of each pulse
+        pulse_idxs = np.arange(nall) - starts[which] + idx_ranges[which,0]
+        pulses = self.get_pulse_from_bin(pulse_idxs)
+
+        series = {
+                "seqs":                 np.array(seqs, dtype=int)[which],
+                "pulses":               pulses,
+                "driftrate":            np.full(nall, np.nan),
+                "driftrate_derivative": np.full(nall, np.nan),
+                "decay_rate":           np.full(nall, np.nan),
+                "P3":                   np.full(nall, np.nan),
+                "breaks":               starts[1:],
+                "models":               {},
+                }
+
+        model_names = [self.model_fits[seq].model_name for seq in seqs]
+        for model_name in sorted(set(model_names)):
+            in_model = np.array([name == model_name for name in model_names])
+            model_idxs = np.flatnonzero(in_model)
+            nparameters = len(self.model_fits[seqs[model_idxs[0]]].parameters)
+
+            parameters = np.array([self.model_fits[seqs[i]].parameters for i in model_idxs], dtype=float)
+            parameter_errors = np.array([np.sqrt(np.diag(self.model_fits[seqs[i]].pcov)) if self.model_fits[seqs[i]].pcov is not None
+                else np.full(nparameters, np.nan) for i in model_idxs])
+            first_pulses = np.array([self.model_fits[seqs[i]].first_pulse for i in model_idxs], dtype=float)
+
+            # A stand-in model whose parameters (and first pulse) are arrays, one
+            # element per pulse, so that the model's own formulas can be used for
+            # all the pulses at once
+            on_pulses = in_model[which]
+            model_of_pulse = np.cumsum(in_model)[which[on_pulses]] - 1
+            model = ModelFit()
+            model.model_name  = model_name
+            model.parameters  = parameters[model_of_pulse].T
+            model.first_pulse = first_pulses[model_of_pulse]
+
+            p = pulses[on_pulses]
+            series["driftrate"][on_pulses]            = model.calc_driftrate(p)
+            series["driftrate_derivative"][on_pulses] = model.calc_driftrate_derivative(p)
+            series["decay_rate"][on_pulses]           = model.calc_driftrate_decay_rate(p)
+            series["P3"][on_pulses]                   = model.calc_P3(p)
+
+            # The same, once per sequence, at the middle of each sequence
+            model.parameters  = parameters.T
+            model.first_pulse = first_pulses
+            pmid = np.mean(pulse_ranges[model_idxs], axis=1)
+            series["models"][model_name] = {
+                    "seqs":             np.array(seqs, dtype=int)[model_idxs],
+                    "pmid":             pmid,
+                    "perr":             0.5*(pulse_ranges[model_idxs,1] - pulse_ranges[model_idxs,0]),
+                    "parameters":       parameters,
+                    "parameter_errors": parameter_errors,
+                    "driftrate_mid":    model.calc_driftrate(pmid),
+                    "driftrate_derivative_mid": model.calc_driftrate_derivative(pmid)*np.ones(pmid.shape),
+                    }
+
+        self.model_time_series = series
+        self.model_time_series_key = key
+        return series
+
+    def break_time_series(self, series, quantity):
+        '''
+        Returns the pulses and the given quantity from get_model_time_series(), with NaNs
+        inserted between sequences, so that all sequences can be plotted as one line
+        '''
+        pulses = np.insert(series["pulses"].astype(float), series["breaks"], np.nan)
+        values = np.insert(series[quantity], series["breaks"], np.nan)
+        return pulses, values
+
+    def get_pulse_labels(self):
+        '''
+        Labels every pulse (row) of the pulsestack with its drift sequence and drift mode.
+        Returns
+          seqs        - the sequence number of each pulse
+          mode_idxs   - the index (into mode_labels) of each pulse's mode, or -1 if its
+                        sequence hasn't been labelled
+          mode_labels - the sorted list of distinct mode labels
+        '''
+        first_idxs, last_idxs = self.drift_sequences.get_all_bounding_pulse_idxs(self.npulses)
+        seqs = np.repeat(np.arange(len(first_idxs)), last_idxs - first_idxs + 1)
+
+        mode_labels = sorted(set(self.drift_mode_labels.values()))
+        seq_mode_idxs = np.array([mode_labels.index(self.drift_mode_labels[i]) if i in self.drift_mode_labels.keys() else -1
+            for i in range(len(first_idxs))], dtype=int)
+
+        return seqs, seq_mode_idxs[seqs], mode_labels
+
+    def aggregate_profiles(self, group_by="mode", pulse_mask=None):
+        '''
+        Sums, averages, and calculates the variance of the pulses in each group (in one
+        pass over the pulsestack), where group_by is one of
+          "mode"     - one group per mode label (unlabelled sequences are left out)
+          "sequence" - one group per drift sequence
+          "mode_and_sequence" - one group per (mode label, sequence) pair
+        pulse_mask (a boolean array, one per pulse) can be used to leave out pulses.
+        Returns a dictionary with the list of "groups" (labels, sequence numbers, or
+        (label, sequence) pairs), and the corresponding (ngroups, nbins) "summed", "mean",
+        and "variance" profiles, and the number of pulses ("npulses") in each group.
+        '''
+        seqs, mode_idxs, mode_labels = self.get_pulse_labels()
+
+        if group_by == "mode":
+            group_idxs = mode_idxs
+            groups = mode_labels
+        elif group_by == "sequence":
+            group_idxs = seqs
+            groups = list(range(self.drift_sequences.number_of_sequences()))
+        elif group_by == "mode_and_sequence":
+            # Only the sequences that are labelled form groups
+            labelled_seqs = sorted(self.drift_mode_labels.keys())
+            seq_group_idxs = np.full(self.drift_sequences.number_of_sequences(), -1)
+            seq_group_idxs[labelled_seqs] = np.arange(len(labelled_seqs))
+            group_idxs = seq_group_idxs[seqs]
+            groups = [(self.drift_mode_labels[seq], seq) for seq in labelled_seqs]
+        else:
+            raise ValueError("Unrecognised grouping '{}'".format(group_by))
+
+        use = group_idxs >= 0
+        if pulse_mask is not None:
+            use = np.logical_and(use, pulse_mask)
+
+        # Accumulate in double precision, since the variance comes from the
+        # difference of the sums of squares and the squared sums
+        values = np.array(self.values[use,:], dtype=np.float64)
+        group_idxs = group_idxs[use]
+
+        ngroups = len(groups)
+        summed = np.zeros((ngroups, self.nbins))
+        summed_squares = np.zeros((ngroups, self.nbins))
+        np.add.at(summed, group_idxs, values)
+        np.add.at(summed_squares, group_idxs, values**2)
+        npulses = np.bincount(group_idxs, minlength=ngroups)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            n = npulses[:,np.newaxis]
+            mean = summed/n
+            variance = np.maximum(summed_squares - summed*mean, 0)/(n - 1)
+
+        return {
+                "groups":   groups,
+                "summed":   summed,
+                "mean":     mean,
+                "variance": variance,
+                "npulses":  npulses,
+                }
+
+    def get_subpulse_window(self):
+        # The default (full) width of the window used to fit each subpulse: the typical
+        # P2 of the model fits, or (if there aren't any) 10 deg
+        P2s = [np.abs(model_fit.calc_P2()) for model_fit in self.model_fits.values() if model_fit.parameters is not None]
+        if len(P2s) == 0:
+            return 10.0
+        return float(np.median(P2s))
+
+    def calc_subpulse_widths(self, window_deg=None, subset=None, progress=None):
+        '''
+        Fit a Gaussian to every subpulse (or those in subset) over a window of window_deg
+        around it (by default, see get_subpulse_window()), all at once (see
+        Pulsestack.fit_subpulse_gaussians()). Returns the indexes of the subpulses whose fits
+        succeeded, and their refined phases and widths (the Gaussians' sigmas, in deg),
+        ready for a "set_subpulse_widths" edit. progress (if given) is passed on to
+        fit_subpulse_gaussians().
+        '''
+        if window_deg is None:
+            window_deg = self.get_subpulse_window()
+
+        idxs = np.arange(self.subpulses.get_nsubpulses())
+        if subset is not None:
+            idxs = idxs[subset]
+
+        _, centres, widths, success = self.fit_subpulse_gaussians(self.subpulses.get_phases(subset=idxs),
+                self.subpulses.get_pulses(subset=idxs), window_deg, progress=progress)
+
+        return idxs[success], centres[success], widths[success]
+
+    def fit_subpulse_widths(self, window_deg=None, subset=None):
+        '''
+        Refine the phases of the subpulses (all of them, or those in subset), and set their
+        widths, from Gaussians fitted to the pulsestack around them (see calc_subpulse_widths()).
+        Subpulses whose fits fail are left as they were. This is done as a (single) edit.
+        '''
+        if self.subpulses.get_nsubpulses() == 0:
+            print("No subpulses to fit")
+            return
+
+        idxs, phases, widths = self.calc_subpulse_widths(window_deg=window_deg, subset=subset)
+        if len(idxs) == 0:
+            print("No subpulse fits succeeded")
+            return
+
+        self.perform_edit(history.Edit("set_subpulse_widths", idxs=idxs, phases=phases, widths=widths))
+
+    def get_model_fit_of_subpulses(self, model_fits):
+        '''
+        Returns, for every subpulse, the index (into the list model_fits) of the model fit
+        whose pulse range it falls in, or -1 if it isn't in any of them. (The pulse ranges
+        of different drift sequences don't overlap.)
+        '''
+        if len(model_fits) == 0 or self.subpulses.get_nsubpulses() == 0:
+            return np.full(self.subpulses.get_nsubpulses(), -1, dtype=int)
+
+        first_pulses = np.array([model_fit.first_pulse for model_fit in model_fits], dtype=float)
+        last_pulses  = np.array([model_fit.last_pulse for model_fit in model_fits], dtype=float)
+        order = np.argsort(first_pulses)
+
+        p = self.subpulses.get_pulses()
+        fit_idxs = order[np.clip(np.searchsorted(first_pulses[order], p, side='right') - 1, 0, None)]
+        in_range = np.logical_and(p >= first_pulses[fit_idxs], p <= last_pulses[fit_idxs])
+        return np.where(in_range, fit_idxs, -1)
+
+    def calc_nearest_driftbands(self, model_fits, fit_of_subpulse):
+        '''
+        Assign every subpulse (in the pulse range of one of model_fits, as given by
+        fit_of_subpulse, see get_model_fit_of_subpulses()) to its nearest driftband, and
+        calculate its residual from it, all at once. This is done with a stand-in model per
+        kind of model, whose parameters are arrays with one element per subpulse (as in
+        GlobalFit). Returns the driftbands and residuals (NaN outside the model fits).
+        '''
+        driftbands = np.full(self.subpulses.get_nsubpulses(), np.nan)
+        residuals  = np.full(self.subpulses.get_nsubpulses(), np.nan)
+
+        for model_name in set([model_fit.model_name for model_fit in model_fits]):
+            in_model = np.array([model_fit.model_name == model_name for model_fit in model_fits])
+            on_points = np.logical_and(fit_of_subpulse >= 0, in_model[fit_of_subpulse])
+            if not np.any(on_points):
+                continue
+
+            parameters   = np.array([model_fit.parameters for model_fit in model_fits if model_fit.model_name == model_name], dtype=float)
+            first_pulses = np.array([model_fit.first_pulse for model_fit in model_fits if model_fit.model_name == model_name], dtype=float)
+            model_of_point = np.cumsum(in_model)[fit_of_subpulse[on_points]] - 1
+
+            model = ModelFit()
+            model.model_name  = model_name
+            model.parameters  = parameters[model_of_point].T
+            model.first_pulse = first_pulses[model_of_point]
+
+            ph = self.subpulses.get_phases(subset=on_points)
+            p  = self.subpulses.get_pulses(subset=on_points)
+            driftbands[on_points] = model.get_nearest_driftband(p, ph)
+            residuals[on_points]  = model.calc_residual(p, ph, driftbands[on_points])
+
+        return driftbands, residuals
+
+    def calc_robust_sigmas(self, residuals, groups, ngroups):
+        '''
+        The robust standard deviation (1.4826 times the median absolute residual, i.e.
+        about the model rather than about the residuals' own median) of the residuals
+        of each group (0 to ngroups-1), all at once: the residuals are sorted within
+        their groups, and the middle of each group is picked out. NaN for empty groups.
+        '''
+        absolute = np.abs(residuals)
+        order    = np.lexsort((absolute, groups))
+        counts   = np.bincount(groups, minlength=ngroups)
+        starts   = np.cumsum(counts) - counts
+
+        sorted_absolute = np.append(absolute[order], np.nan)
+        lower = sorted_absolute[np.where(counts > 0, starts + (counts - 1)//2, -1)]
+        upper = sorted_absolute[np.where(counts > 0, starts + counts//2, -1)]
+        return 1.4826*0.5*(lower + upper)
+
+    def calc_clipped_driftbands(self, seqs=None, nsigma=3.0, max_passes=5, progress=None):
+        '''
+        Iteratively assign driftbands to the subpulses of the given drift sequences (by
+        default, all with a model fit), refit the models, and reject the subpulses whose
+        residuals are more than nsigma robust standard deviations (see calc_robust_sigmas())
+        from their sequence's model, until the rejected subpulses stop changing (or for at
+        most max_passes refits). Each pass assigns and clips all the subpulses at once; only
+        the refits are done one sequence at a time. The final assignment and clipping is
+        always done with the final (returned) model fits.
+
+        Rejected subpulses are not deleted, but are flagged as rejected (see
+        Subpulses.get_rejected()) and left without a driftband, which keeps them out of
+        later assignments and fits. Subpulses that were already rejected stay rejected, and
+        are left out here. Nothing in the session is changed: returns the indexes of the
+        subpulses in the sequences, their new driftbands, whether each was rejected, the
+        sequences, their refitted (serialized) model fits, and the number of refits, ready
+        for a "clip_driftbands" edit. progress (if given) is called with the fraction of
+        the (at most max_passes) passes done after each refit.
+        '''
+        if seqs is None:
+            seqs = sorted(self.model_fits.keys())
+        seqs = [seq for seq in seqs if self.model_fits[seq].parameters is not None]
+        if len(seqs) == 0 or self.subpulses.get_nsubpulses() == 0:
+            return np.array([], dtype=int), np.array([]), np.array([], dtype=bool), seqs, [], 0
+
+        # Work on copies, so that the changes can be made as a single edit
+        model_fits = []
+        for seq in seqs:
+            model_fit = ModelFit()
+            model_fit.unserialize(self.model_fits[seq].serialize())
+            model_fits.append(model_fit)
+
+        fit_of_subpulse = self.get_model_fit_of_subpulses(model_fits)
+        fit_of_subpulse[self.subpulses.get_rejected()] = -1
+        in_fit = fit_of_subpulse >= 0
+        rejected = None
+
+        npasses = 0
+        while True:
+            driftbands, residuals = self.calc_nearest_driftbands(model_fits, fit_of_subpulse)
+            sigmas = self.calc_robust_sigmas(residuals[in_fit], fit_of_subpulse[in_fit], len(model_fits))
+
+            new_rejected = np.zeros(len(residuals), dtype=bool)
+            new_rejected[in_fit] = np.abs(residuals[in_fit]) > nsigma*sigmas[fit_of_subpulse[in_fit]]
+            converged = rejected is not None and np.array_equal(new_rejected, rejected)
+            rejected = new_rejected
+            if converged or npasses == max_passes:
+                break
+            npasses += 1
+
+            kept = np.logical_and(in_fit, ~rejected)
+            for i, model_fit in enumerate(model_fits):
+                subset = np.logical_and(kept, fit_of_subpulse == i)
+                if np.sum(subset) <= len(model_fit.parameters):
+                    continue
+
+                try:
+                    model_fit.optimise_fit_to_subpulses(self.subpulses.get_phases(subset=subset),
+                            self.subpulses.get_pulses(subset=subset), driftbands[subset], verbose=False)
+                except (RuntimeError, ValueError, np.linalg.LinAlgError):
+                    print("Could not refit sequence {}; keeping its previous fit".format(seqs[i]))
+
+                if progress is not None:
+                    progress((npasses - 1 + (i + 1)/len(model_fits))/max_passes)
+
+        driftbands[rejected] = np.nan
+        idxs = np.flatnonzero(in_fit)
+        return idxs, driftbands[idxs], rejected[idxs], seqs, [model_fit.serialize() for model_fit in model_fits], npasses
+
+    def clip_driftbands(self, seqs=None, nsigma=3.0, max_passes=5):
+        '''
+        Reassign driftbands and refit the model fits of the given drift sequences (by
+        default, all of them), rejecting outlying subpulses, as a single edit (see
+        calc_clipped_driftbands()). Returns the number of rejected subpulses.
+        '''
+        idxs, driftbands, rejected, seqs, model_fits, npasses = self.calc_clipped_driftbands(seqs=seqs, nsigma=nsigma, max_passes=max_passes)
+        if len(idxs) == 0:
+            print("No subpulses in any drift sequence with a model fit")
+            return 0
+
+        self.perform_edit(history.Edit("clip_driftbands", idxs=idxs, driftbands=driftbands, rejected=rejected, seqs=seqs, model_fits=model_fits))
+        return int(np.sum(rejected))
+
+    def get_resampling_problems(self, seqs=None):
+        '''
+        Returns the drift sequences (of those given, or by default all of them) whose
+        model fits can be resampled, and for each one, the (model_fit, phases, pulses,
+        driftbands) that resampling.resample_model_fits() needs. Only subpulses with
+        driftbands within each model's pulse range are used.
+        '''
+        if seqs is None:
+            seqs = sorted(self.model_fits.keys())
+
+        problem_seqs = []
+        problems = []
+        for seq in seqs:
+            model_fit = self.model_fits[seq]
+            if model_fit.parameters is None:
+                continue
+
+            subset = self.subpulses.in_pulse_range(np.array(model_fit.get_pulse_bounds()), with_valid_driftband=True)
+            if np.sum(subset) <= len(model_fit.parameters):
+                print("Not enough subpulses to resample the model fit of sequence {}".format(seq))
+                continue
+
+            problem_seqs.append(seq)
+            problems.append((model_fit, self.subpulses.get_phases(subset=subset), self.subpulses.get_pulses(subset=subset),
+                self.subpulses.get_driftbands(subset=subset)))
+
+        return problem_seqs, problems
+
+    def set_model_fit_intervals(self, seqs, intervals):
+        # Store resampled intervals in the model fits of the given sequences (one per
+        # sequence), as a single edit (so that they can all be undone at once)
+        model_fits = []
+        for seq, seq_intervals in zip(seqs, intervals):
+            model_fit = ModelFit()
+            model_fit.unserialize(self.model_fits[seq].serialize())
+            model_fit.intervals = seq_intervals
+            model_fits.append(model_fit.serialize())
+        self.perform_edit(history.Edit("set_model_fits", seqs=list(seqs), model_fits=model_fits))
+
+    def resample_model_fits(self, seqs=None, method="bootstrap", nresamples=1000, block_size=None,
+            confidence=0.68, seed=None, nprocesses=None, progress=None):
+        '''
+        Estimate confidence intervals for the parameters of the model fits of the given
+        drift sequences (by default, all of them) by refitting them to resampled subpulses
+        (see resampling.py), and store them next to the pcovs (in each ModelFit's intervals),
+        as a single edit
+        '''
+        import resampling # (resampling itself imports this module)
+
+        problem_seqs, problems = self.get_resampling_problems(seqs)
+        results = resampling.resample_model_fits(problems, method=method, nresamples=nresamples, block_size=block_size,
+                confidence=confidence, seed=seed, nprocesses=nprocesses, progress=progress)
+
+        seqs = []
+        intervals = []
+        for seq, (seq_intervals, _) in zip(problem_seqs, results):
+            if seq_intervals is None:
+                print("Too few resampled fits of sequence {} succeeded".format(seq))
+                continue
+            seqs.append(seq)
+            intervals.append(seq_intervals)
+
+        if len(seqs) > 0:
+            self.set_model_fit_intervals(seqs, intervals)
+
+    def sample_model_fits(self, seqs=None, chains_file=None, nwalkers=32, nsteps=2000, nburn=None,
+            outliers=False, outlier_sigma=None, seed=None, nprocesses=None):
+        '''
+        Sample the posteriors of the parameters of the model fits of the given drift sequences
+        (by default, all of them) with an ensemble MCMC sampler (see mcmc.py), one sequence
+        per process. The chains are saved to chains_file (by default, next to the session's
+        json file), and each model fit is linked to its chain (in its mcmc) as a (single)
+        edit, so it can be undone. nburn (by default a quarter of nsteps) is the number
+        of steps left out of the posterior summaries.
+        '''
+        import mcmc # (mcmc itself imports this module)
+
+        if chains_file is None:
+            if self.jsonfile is None:
+                print("No file to save the chains to. Save the session first, or give a chains_file")
+                return
+            chains_file = self.jsonfile + ".chains.npz"
+
+        if nburn is None:
+            nburn = nsteps//4
+
+        problem_seqs, problems = self.get_resampling_problems(seqs)
+        results = mcmc.sample_model_fits(problems, nprocesses=nprocesses, seed=seed, nwalkers=nwalkers, nsteps=nsteps,
+                outliers=outliers, outlier_sigma=outlier_sigma)
+
+        # The links are made on copies, which then replace the model fits
+        model_fits = []
+        for seq in problem_seqs:
+            model_fit = ModelFit()
+            model_fit.unserialize(self.model_fits[seq].serialize())
+            model_fits.append(model_fit)
+        mcmc.save_chains(chains_file, model_fits, results, nburn=nburn)
+
+        if len(problem_seqs) > 0:
+            self.perform_edit(history.Edit("set_model_fits", seqs=problem_seqs,
+                model_fits=[model_fit.serialize() for model_fit in model_fits]))
 
-        if drift_dict["version"] != __version__:
-            print("Warning: version mismatch, File = {}, Software = {}".format(drift_dict["version"], __version__))
+    def get_sequence_table(self):
+        '''
+        Returns a dictionary of arrays describing every drift sequence:
+          sequence, mode (or "None"), first_pulse, last_pulse, npulses, nsubpulses,
+          model_name (or "None"), and the mean drift rate (deg/pulse), P3 (pulses)
+          and drift rate decay rate (/pulse) of the model fit over the sequence
+          (NaN if there is no model fit)
+        '''
+        nseqs = self.drift_sequences.number_of_sequences()
+        first_idxs, last_idxs = self.drift_sequences.get_all_bounding_pulse_idxs(self.npulses)
+
+        nsubpulses = np.zeros(nseqs, dtype=int)
+        if self.subpulses.get_nsubpulses() > 0:
+            subpulse_seqs = self.drift_sequences.get_sequence_numbers(self.get_pulse_bin(self.subpulses.get_pulses(), inrange=False))
+            nsubpulses = np.bincount(subpulse_seqs, minlength=nseqs)
+
+        # Average the model time series over each sequence
+        means = {}
+        series = self.get_model_time_series()
+        fitted_seqs = np.unique(series["seqs"])
+        starts = np.concatenate([[0], series["breaks"]]).astype(int)
+        lengths = np.diff(np.concatenate([starts, [len(series["pulses"])]]))
+        for quantity in ["driftrate", "P3", "decay_rate"]:
+            means[quantity] = np.full(nseqs, np.nan)
+            if len(fitted_seqs) > 0:
+                means[quantity][fitted_seqs] = np.add.reduceat(series[quantity], starts)/lengths
+
+        return {
+                "sequence":        np.arange(nseqs),
+                "mode":            np.array([str(self.drift_mode_labels.get(i)) for i in range(nseqs)]),
+                "first_pulse":     self.get_pulse_from_bin(first_idxs),
+                "last_pulse":      self.get_pulse_from_bin(last_idxs),
+                "npulses":         last_idxs - first_idxs + 1,
+                "nsubpulses":      nsubpulses,
+                "model_name":      np.array([str(self.model_fits[i].model_name) if i in self.model_fits.keys() else "None" for i in range(nseqs)]),
+                "mean_driftrate":  means["driftrate"],
+                "mean_P3":         means["P3"],
+                "mean_decay_rate": means["decay_rate"],
+                }
 
-        # Load the pulsestack data
-        self.unserialize(drift_dict["pulsestack"])
-        self.subpulses.unserialize(drift_dict["subpulses"])
+    def get_mode_profiles(self):
+        '''
+        Returns a dictionary whose keys are the mode labels (see set_drift_mode_label()),
+        and whose values are (summed profile, mean profile, number of pulses) of all
+        the pulses in sequences with that label (see aggregate_profiles())
+        '''
+        aggregated = self.aggregate_profiles(group_by="mode")
+        return {label: (aggregated["summed"][i], aggregated["mean"][i], aggregated["npulses"][i])
+                for i, label in enumerate(aggregated["groups"])}
 
-        for item in drift_dict["model_fits"]:
-            self.model_fits[item[0]] = ModelFit()
-            self.model_fits[item[0]].unserialize(item[1])
+    def export_tables(self, prefix=None, formats=("txt",)):
+        '''
+        Write out the tables used by the plotting scripts in drift_analysis/:
+          <prefix>.subpulses         - see get_subpulse_table()
+          <prefix>.json.profile      - the mean profile of the whole pulsestack
+          <prefix>_<mode>_profile.txt - the summed and mean profiles of each labelled mode
+        prefix defaults to the session's json filename without the ".json".
+        formats can also include "npz" and/or "parquet", to write all of the above to
+        <prefix>.tables.npz, or <prefix>.subpulses.parquet and <prefix>.profiles.parquet
+        (which needs pandas, with pyarrow or fastparquet).
+        '''
+        if prefix is None:
+            if self.jsonfile is None:
+                print("No prefix given, and the session has not been saved. Nothing exported")
+                return
+            prefix = self.jsonfile[:-5] if self.jsonfile.endswith(".json") else self.jsonfile
+
+        table = self.get_subpulse_table()
+        phases = self.get_phases_array()
+        profile = np.mean(self.values, axis=0)
+        mode_profiles = self.get_mode_profiles()
+
+        if "txt" in formats:
+            # Missing values are written as "None", as in the original tables
+            columns = [table[name].astype(object) for name in ["mode", "sequence", "phase", "pulse_in_seq", "pulse", "pulse_from_end", "driftrate"]]
+            for i, name in zip([3, 4, 5], ["pulse_in_seq", "pulse", "pulse_from_end"]):
+                # Pulse numbers are usually whole numbers, so write them as such if possible
+                values = np.asarray(table[name], dtype=float)
+                valid  = np.isfinite(values)
+                if np.all(values[valid] == np.round(values[valid])):
+                    columns[i][valid] = np.round(values[valid]).astype(int).astype(object)
+                columns[i][~valid] = None
+            columns[6][np.isnan(table["driftrate"])] = None
+            header = "Subpulses of {}\nMode | Sequence number | Phase (deg) | Pulse number in sequence | Pulse number | Pulse number from end of sequence | Drift rate (deg/pulse)".format(self.jsonfile)
+            np.savetxt(prefix + ".subpulses", np.transpose(columns), fmt="%s", header=header)
+
+            np.savetxt(prefix + ".json.profile", np.transpose([phases, profile]), header="Pulse phase (deg) | Flux density")
+
+            for label in mode_profiles:
+                summed, mean, npulses = mode_profiles[label]
+                header = "Profile of mode {}\nTotal number of pulses = {}\nPulse phase (deg) | Summed flux density | Mean flux density".format(label, npulses)
+                np.savetxt("{}_{}_profile.txt".format(prefix, label), np.transpose([phases, summed, mean]), header=header)
+
+        if "npz" in formats:
+            arrays = {"subpulses_" + name: table[name] for name in table}
+            arrays["subpulses_mode"] = table["mode"].astype(str)
+            arrays["phases"] = phases
+            arrays["profile"] = profile
+            for label in mode_profiles:
+                summed, mean, npulses = mode_profiles[label]
+                arrays["mode_{}_summed_profile".format(label)] = summed
+                arrays["mode_{}_mean_profile".format(label)]   = mean
+                arrays["mode_{}_npulses".format(label)]        = npulses
+            np.savez(prefix + ".tables.npz", **arrays)
+
+        if "parquet" in formats:
+            try:
+                import pandas
+            except ImportError:
+                print("Parquet output needs pandas (with pyarrow or fastparquet). No parquet files written")
+                return
 
-        self.maxima_threshold = drift_dict["maxima_threshold"]
-        self.drift_sequences.unserialize(drift_dict["drift_mode_boundaries"])
+            subpulses = dict(table)
+            subpulses["mode"] = table["mode"].astype(str)
+            pandas.DataFrame(subpulses).to_parquet(prefix + ".subpulses.parquet")
 
-        self.jsonfile = jsonfile
+            profiles = {"phase": phases, "profile": profile}
+            for label in mode_profiles:
+                profiles["mode_{}_summed".format(label)] = mode_profiles[label][0]
+                profiles["mode_{}_mean".format(label)]   = mode_profiles[label][1]
+            pandas.DataFrame(profiles).to_parquet(prefix + ".profiles.parquet")
 
     def plot_drift_mode_boundaries(self):
         xlo = self.first_phase
@@ -845,6 +2387,14 @@ class DriftAnalysis(pulsestack.Pulsestack):
         else:
             self.dm_boundary_plt = self.ax.hlines(ys, xlo, xhi, colors=["k"], linestyles='dashed')
 
+    def plot_observation_joins(self):
+        # Mark where concatenated observations meet (see concatenation.py)
+        for join_plt in self.join_plts:
+            join_plt.remove()
+
+        join_pulses, _ = self.get_join_pulses()
+        self.join_plts = [self.ax.axhline(pulse - 0.5*self.dpulse, color='c', linewidth=2) for pulse in join_pulses]
+
     def plot_all_model_fits(self):
         for i in self.model_fits:
             if self.onpulse is None:
@@ -868,6 +2418,165 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
         self.visible_ps  = None
         self.show_smooth  = False
 
+        self.tasks             = None # A tasks.TaskRunner, created when the plot is started
+        self.title_before_task = None
+
+        self.blit_background   = None # The figure without the candidate fit, while in "model_fit" mode
+
+    def replot_session(self):
+        '''
+        Bring every plotted element up to date with the current state of the session
+        (e.g. after an undo or redo)
+        '''
+        # Any smoothed copy of the pulsestack may now be out of date, so revert to the raw one
+        self.show_smooth = False
+        self.visible_ps  = None
+
+        self.ps_image.set_data(self.get_image_values())
+        self.ps_image.set_extent(self.calc_image_extent())
+        self.cbar.update_normal(self.ps_image)
+
+        if self.subpulses.get_nsubpulses() == 0:
+            self.subpulses.clear_plots()
+        self.subpulses.plot_subpulses(self.ax)
+        self.plot_drift_mode_boundaries()
+        self.plot_observation_joins()
+
+        self.unplot_all_model_fits()
+        if self.quadratic_visible:
+            self.plot_all_model_fits()
+
+    def run_task(self, description, function, on_done=None, cancellable=True):
+        '''
+        Run function(task) in the background (see tasks.Task), and then
+        on_done(result) back in the GUI thread. While the task is running, the
+        window title shows its progress, and the only key that does anything is
+        escape (to cancel it).
+        '''
+        task = tasks.Task(description, function, on_done=on_done, cancellable=cancellable)
+
+        # Without a figure (e.g. when scripting), there's no event loop to come back to
+        if self.tasks is None:
+            task.start_time = time.time()
+            result = task.function(task)
+            if task.on_done is not None:
+                task.on_done(result)
+            return
+
+        self.tasks.submit(task)
+
+    def set_task_status(self, status):
+        if status is not None:
+            if self.title_before_task is None:
+                self.title_before_task = self.fig.canvas.manager.get_window_title()
+            self.fig.canvas.manager.set_window_title(status)
+        elif self.title_before_task is not None:
+            self.fig.canvas.manager.set_window_title(self.title_before_task)
+            self.title_before_task = None
+
+    def save_json_in_background(self, jsonfile):
+        '''
+        Saves the whole session (see save_json()) without blocking the GUI.
+        If jsonfile is None, the user is asked for one
+        '''
+        if jsonfile is None:
+            root = tkinter.Tk()
+            root.withdraw()
+            jsonfile = tkinter.filedialog.asksaveasfilename(filetypes=(("All files", "*.*"),))
+
+        if not jsonfile:
+            return
+
+        def show_saved(result):
+            self.fig.canvas.manager.set_window_title(self.jsonfile)
+
+        self.run_task("Saving", lambda task: self.save_json(jsonfile), show_saved, cancellable=False)
+
+    def refit_model_in_background(self, seq, model_name):
+        '''
+        Convert the model fit of drift sequence seq to the named model, and refit it
+        to all the subpulses in the sequence that have been assigned driftbands
+        '''
+        # Work on a copy, so that the change can be undone (and so that nothing
+        # is changed if the fit is cancelled)
+        model_fit = ModelFit()
+        model_fit.unserialize(self.model_fits[seq].serialize())
+        model_fit.convert_to_model(model_name)
+        pulse_range = model_fit.get_pulse_bounds()
+        subset = self.subpulses.in_pulse_range(pulse_range, with_valid_driftband=True)
+
+        ph = self.subpulses.get_phases(subset=subset)
+        p  = self.subpulses.get_pulses(subset=subset)
+        d  = self.subpulses.get_driftbands(subset=subset)
+
+        def fit(task):
+            model_fit.optimise_fit_to_subpulses(ph, p, d)
+            return model_fit
+
+        def show_fit(model_fit):
+            self.perform_edit(history.Edit("set_model_fit", seq=seq, model_fit=model_fit.serialize()))
+
+            # Update the plot
+            if self.onpulse is None:
+                phlim = self.get_phase_from_bin(np.array([0, self.nbins-1]))
+            else:
+                phlim = self.onpulse
+
+            self.model_fits[seq].plot_all_driftbands(self.ax, phlim, pstep=self.dpulse, color='k')
+
+            # Mark that unsaved changes have been made
+            if self.jsonfile is not None:
+                self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
+            self.fig.canvas.draw()
+
+        self.run_task("Fitting {} model".format(model_name), fit, show_fit)
+
+    def show_derived_pulsestack(self, derived, keep_drift_sequences=True):
+        '''
+        Open a new interactive plot of a pulsestack derived from this one
+        (e.g. correlations, the LRFS)
+        '''
+        viewer = DriftAnalysisInteractivePlot()
+
+        viewer.stokes      = derived.stokes
+        viewer.npulses     = derived.npulses
+        viewer.nbins       = derived.nbins
+        viewer.first_pulse = derived.first_pulse
+        viewer.first_phase = derived.first_phase
+        viewer.dpulse      = derived.dpulse
+        viewer.dphase_deg  = derived.dphase_deg
+        viewer.complex     = derived.complex
+        viewer.xlabel      = derived.xlabel
+        viewer.ylabel      = derived.ylabel
+        viewer.values      = derived.values
+
+        # Remove all the subpulses and models
+        viewer.subpulses = Subpulses()
+        viewer.model_fits = {}
+        # ... but (optionally) keep the drift sequence boundaries
+        if keep_drift_sequences:
+            viewer.drift_sequences = copy.copy(self.drift_sequences)
+        else:
+            viewer.drift_sequences = DriftSequences()
+
+        # Make it interactive!
+        viewer.start()
+        return viewer
+
+    def show_cross_correlation(self, crosscorr):
+        self.cc = self.show_derived_pulsestack(crosscorr)
+
+    def show_auto_correlation(self, autocorr):
+        self.ac = self.show_derived_pulsestack(autocorr)
+
+    def show_LRFS(self, lrfs):
+        self.lrfs = self.show_derived_pulsestack(lrfs, keep_drift_sequences=False)
+
+    def show_TDFS(self, result):
+        tdfs, peak = result
+        print("2DFS peak: P2 = {:.3f} +- {:.3f} deg, P3 = {:.3f} +- {:.3f} periods".format(peak["P2"], peak["P2_err"], peak["P3"], peak["P3_err"]))
+        self.tdfs = self.show_derived_pulsestack(tdfs, keep_drift_sequences=False)
+
     def deselect(self):
         self.selected = None
         if self.selected_plt is not None:
@@ -875,6 +2584,10 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
 
     def on_button_press_event(self, event):
 
+        # Ignore the mouse while a background task is running
+        if self.tasks is not None and self.tasks.is_busy():
+            return
+
         ##############################################
         # Interpret mouse clicks for different modes #
         ##############################################
@@ -920,7 +2633,7 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
         elif self.mode == "add_subpulse":
             # Snap to nearest pulse, but let phase be continuous
             pulse_bin = np.round(self.get_pulse_bin(event.ydata))
-            pulse = self.first_pulse + pulse_bin*self.dpulse
+            pulse = self.get_pulse_from_bin(pulse_bin)
             phase = event.xdata
             self.selected = np.array([pulse, phase])
 
@@ -963,21 +2676,14 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
 
         elif self.mode == "set_fiducial":
             if event.inaxes == self.ax:
-                # Set the fiducial phase for this pulsestack
-                self.set_fiducial_phase(event.xdata)
+                # Set the fiducial phase for this pulsestack, and shift the
+                # subpulses and models to match
+                self.perform_edit(history.Edit("set_fiducial", phase_deg=event.xdata))
 
                 # If necessary, also set the same fiducial phase for the smoothed pulsestack
                 if self.visible_ps is not None:
                     self.visible_ps.set_fiducial_phase(event.xdata)
 
-                # Adjust all the maxima points
-                if self.subpulses.get_nsubpulses() > 0:
-                    self.subpulses.shift_all_subpulses(dphase=-event.xdata)
-
-                # Shift the models
-                for i in self.model_fits:
-                    self.model_fits[i].shift_phase(-event.xdata)
-
                 # Replot everything
                 current_xlim = self.ax.get_xlim()
                 current_ylim = self.ax.get_ylim()
@@ -1008,7 +2714,7 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
         elif self.mode == "set_onpulse_trailing":
             if event.inaxes == self.ax:
                 self.ph_hi = event.xdata
-                self.set_onpulse(self.ph_lo, self.ph_hi)
+                self.perform_edit(history.Edit("set_onpulse", onpulse=[self.ph_lo, self.ph_hi]))
 
                 # Add the * to the window title
                 if self.jsonfile is not None:
@@ -1016,14 +2722,14 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
 
                 self.set_default_mode()
 
-        elif self.mode == "zoom_drift_sequence" or self.mode == "switch_to_quadratic_and_solve" or self.mode == "assign_driftbands" or self.mode == "switch_to_exponential_and_solve" or self.mode == "display_model_details" or self.mode == "plot_residuals":
+        elif self.mode == "zoom_drift_sequence" or self.mode == "switch_to_quadratic_and_solve" or self.mode == "assign_driftbands" or self.mode == "switch_to_exponential_and_solve" or self.mode == "switch_to_exponential_linear_and_solve" or self.mode == "display_model_details" or self.mode == "plot_residuals" or self.mode == "label_drift_sequence" or self.mode == "resample_model_fit":
             if event.inaxes == self.ax:
                 pulse_idx = self.get_pulse_bin(event.ydata, inrange=False)
                 self.selected = self.drift_sequences.get_sequence_number(pulse_idx, self.npulses)
                 if self.selected is not None:
 
                     # In some modes, the user only can select sequences with existing models
-                    if self.mode == "switch_to_quadratic_and_solve" or self.mode == "switch_to_exponential_and_solve" or self.mode == "assign_driftbands" or self.mode == "display_model_details" or self.mode == "plot_residuals":
+                    if self.mode == "switch_to_quadratic_and_solve" or self.mode == "switch_to_exponential_and_solve" or self.mode == "switch_to_exponential_linear_and_solve" or self.mode == "assign_driftbands" or self.mode == "display_model_details" or self.mode == "plot_residuals" or self.mode == "resample_model_fit":
                         if self.selected not in self.model_fits.keys():
                             return
 
@@ -1064,6 +2770,41 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
             self.fig.canvas.draw()
 
 
+    def get_candidate_fit_artists(self):
+        # The lines that change as points are added in "model_fit" mode
+        artists = [plt[0] for plt in self.candidate_quadratic_model.driftband_plts.values()]
+        if self.quadratic_selected_plt is not None:
+            artists.append(self.quadratic_selected_plt[0])
+        return artists
+
+    def on_draw_event(self, event):
+        '''
+        After every full redraw in "model_fit" mode, keep a copy of the figure so that the
+        (animated) candidate fit can be redrawn on its own (see blit_candidate_fit()), and
+        draw the candidate fit on top (since full redraws leave out animated artists)
+        '''
+        if self.mode != "model_fit" or not self.fig.canvas.supports_blit:
+            self.blit_background = None
+            return
+
+        self.blit_background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.get_candidate_fit_artists():
+            self.ax.draw_artist(artist)
+
+    def blit_candidate_fit(self):
+        '''
+        Redraw only the candidate fit's lines and points over the rest of the figure,
+        instead of redrawing the whole figure (if the backend allows it)
+        '''
+        if self.blit_background is None:
+            self.fig.canvas.draw()
+            return
+
+        self.fig.canvas.restore_region(self.blit_background)
+        for artist in self.get_candidate_fit_artists():
+            self.ax.draw_artist(artist)
+        self.fig.canvas.blit(self.fig.bbox)
+
     def set_default_mode(self):
         self.ax.set_title("Press (capital) 'H' for command list")
         self.fig.canvas.draw()
@@ -1071,6 +2812,12 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
 
     def on_key_press_event(self, event):
 
+        # While a background task is running, only let it be cancelled
+        if self.tasks is not None and self.tasks.is_busy():
+            if event.key == "escape":
+                self.tasks.cancel()
+            return
+
         ############################
         # When in the DEFAULT MODE #
         ############################
@@ -1089,10 +2836,12 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 print("q     Quit")
                 print("[Drift analysis]")
                 print("H     Prints this help")
-                print("j     Save analysis to (json) file")
+                print("j     Save analysis to (json) file (only edits since the last full save are written)")
                 print("J     'Save as' to (json) file")
                 print("^     Set subpulses to local maxima")
                 print("S     Toggle pulsestack smoothed with Gaussian filter")
+                print("K     Toggle pulsestack smoothed with 2D (optionally drift-aligned) Gaussian filter")
+                print("X     Switch to a different Stokes parameter")
                 print("F     Set fiducial point")
                 print("O     Set on-pulse region")
                 print("C     Crop pulsestack to current visible image")
@@ -1100,6 +2849,7 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 print(">     Delete a subpulse")
                 print("P     Plot the profile of the current view")
                 print("T     Plot the LRFS of the current view")
+                print("2     Plot the 2DFS of the current view, and print its P2 and P3 (with bootstrapped uncertainties)")
                 print("/     Add a drift mode boundary")
                 print("?     Delete a drift mode boundary")
                 print("v     Toggle visibility of plot feature")
@@ -1107,34 +2857,64 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 print("d     Plot the cross-correlation of pulses with their successor")
                 print("A     Plot the auto-correlation of each pulse")
                 print("D     Assign the nearest model driftband to each subpulse")
+                print("R     Reassign driftbands and refit all drift sequences, rejecting outlying subpulses")
                 print("r     Plot subpulse residuals from driftband model")
                 print("@     Perform quadratic fitting via subpulse selection (McSweeney et al, 2017)")
                 print("#     Switch to quadratic model and redo fit using all subpulses assigned driftbands in sequence")
                 print("3     Plot model P3 as a function of pulse number")
                 print("E     Switch to exponential model and redo fit using all subpulses assigned driftbands in sequence")
+                print("e     Switch to exponential-plus-linear model and redo fit using all subpulses assigned driftbands in sequence")
                 print("$     Plot the drift rate of the model fits against pulse number")
                 print("&     Plot the driftrate decay rate of the model fits against pulse number")
                 print("%     3D plot of drift rate (d) vs d-dot vs pulse number")
                 print("*     Plot the (exponential) model parameters as a function of pulse number")
                 print("(     Plot the (quadratic) model parameters as a function of pulse number")
+                print(")     Plot the (exponential-plus-linear) model parameters as a function of pulse number")
                 print("m     Print model parameters to stdout")
+                print("W     Fit a Gaussian to every subpulse, refining its phase and setting its width")
+                print("B     Block-bootstrap the model fit of a drift sequence, to get confidence intervals on its parameters")
+                print("u     Undo the last edit")
+                print("U     Redo the last undone edit")
+                print("M     Label a drift sequence with its drift mode (e.g. A, B, or N for nulls)")
+                print("!     Print a report of how long things have been taking (run with --profile)")
                 print("+/-   Set upper/lower colorbar range")
 
             elif event.key == "j":
-                self.save_json()
+                if self.journal is not None or self.journal_pending is not None:
+                    if self.save_journal() == True:
+                        self.fig.canvas.manager.set_window_title(self.jsonfile)
+                else:
+                    self.save_json_in_background(self.jsonfile)
+
+            elif event.key == "M":
+                self.ax.set_title("Select a drift sequence by clicking on the pulsestack.\nPress enter to confirm, esc to cancel.")
+                self.fig.canvas.draw()
+                self.mode = "label_drift_sequence"
+
+            elif event.key == "!":
+                if instrumentation.enabled:
+                    instrumentation.print_report()
+                else:
+                    print("Timing is off. Run with --profile (or set {}=1) to turn it on".format(instrumentation.ENV_VAR))
+
+            elif event.key == "u" or event.key == "U":
+                if event.key == "u":
+                    edit = self.undo()
+                else:
+                    edit = self.redo()
+
+                if edit is None:
+                    print("Nothing to {}".format("undo" if event.key == "u" else "redo"))
+                    return
 
-                if self.fig is not None and self.jsonfile is not None:
-                    self.fig.canvas.manager.set_window_title(self.jsonfile)
+                self.replot_session()
 
+                if self.jsonfile is not None:
+                    self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
+                self.fig.canvas.draw()
 
             elif event.key == "J":
-                old_jsonfile = self.jsonfile
-                self.jsonfile = None
-                self.save_json()
-                if self.jsonfile is None:
-                    self.jsonfile = old_jsonfile
-                if self.fig is not None:
-                    self.fig.canvas.manager.set_window_title(self.jsonfile)
+                self.save_json_in_background(None)
 
             elif event.key == "S":
                 if self.visible_ps is None:
@@ -1145,20 +2925,85 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                     root.withdraw()
                     sigma = tkinter.simpledialog.askfloat("Smoothing kernel", "Input Gaussian kernel size (deg)", parent=root)
                     if sigma:
-                        self.visible_ps = self.smooth_with_gaussian(sigma, inplace=False)
-                        self.ps_image.set_data(self.visible_ps.values)
+                        def show_smoothed(smoothed):
+                            self.visible_ps = smoothed
+                            self.ps_image.set_data(self.visible_ps.get_image_values())
+                            self.show_smooth = True
+                            # Update the colorbar
+                            self.cbar.update_normal(self.ps_image)
+                            self.fig.canvas.draw()
+
+                        if self.is_smoothing_cached(sigma):
+                            show_smoothed(self.smooth_with_gaussian(sigma, inplace=False))
+                        else:
+                            def smooth(task):
+                                return self.smooth_with_gaussian(sigma, inplace=False, progress=task.report_progress)
+
+                            self.run_task("Smoothing", smooth, show_smoothed)
+
+                else:
+                    self.ps_image.set_data(self.get_image_values())
+                    self.show_smooth = False
+                    # Update the colorbar
+                    self.cbar.update_normal(self.ps_image)
+                    self.fig.canvas.draw()
+
+            elif event.key == "K":
+                if self.visible_ps is None:
+                    self.show_smooth = False
+
+                if self.show_smooth == False:
+                    root = tkinter.Tk()
+                    root.withdraw()
+                    sigma_phase = tkinter.simpledialog.askfloat("Smoothing kernel", "Input Gaussian kernel width in phase (deg)", parent=root)
+                    if sigma_phase is None:
+                        return
+                    sigma_pulse = tkinter.simpledialog.askfloat("Smoothing kernel", "Input Gaussian kernel width in pulse number (pulses)", initialvalue=0, parent=root)
+                    if sigma_pulse is None:
+                        return
+                    driftrate = tkinter.simpledialog.askfloat("Smoothing kernel", "Input drift rate to align the kernel with (deg/pulse)", initialvalue=0, parent=root)
+                    if driftrate is None:
+                        return
+
+                    def show_smoothed(smoothed):
+                        self.visible_ps = smoothed
+                        self.ps_image.set_data(self.visible_ps.get_image_values())
                         self.show_smooth = True
                         # Update the colorbar
                         self.cbar.update_normal(self.ps_image)
                         self.fig.canvas.draw()
 
+                    if self.is_smoothing_2d_cached(sigma_phase, sigma_pulse=sigma_pulse, driftrate=driftrate):
+                        show_smoothed(self.smooth_2d(sigma_phase, sigma_pulse=sigma_pulse, driftrate=driftrate, inplace=False))
+                    else:
+                        self.run_task("Smoothing", lambda task: self.smooth_2d(sigma_phase, sigma_pulse=sigma_pulse, driftrate=driftrate, inplace=False), show_smoothed)
+
                 else:
-                    self.ps_image.set_data(self.values)
+                    self.ps_image.set_data(self.get_image_values())
                     self.show_smooth = False
                     # Update the colorbar
                     self.cbar.update_normal(self.ps_image)
                     self.fig.canvas.draw()
 
+            elif event.key == "X":
+                root = tkinter.Tk()
+                root.withdraw()
+                stokes = tkinter.simpledialog.askstring("Stokes", "Input Stokes parameter ({})".format(", ".join(pulsestack.STOKES_VIEWS)), initialvalue=self.stokes, parent=root)
+                if not stokes or stokes == self.stokes:
+                    return
+
+                try:
+                    self.perform_edit(history.Edit("set_stokes", stokes=stokes))
+                except (ValueError, IndexError) as err:
+                    print(err)
+                    return
+
+                self.replot_session()
+
+                if self.jsonfile is not None:
+                    self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
+                self.fig.canvas.draw()
+
             elif event.key == "+":
                 vmin, _ = self.ps_image.get_clim()
                 root = tkinter.Tk()
@@ -1247,7 +3092,7 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 profile_ax.plot(phases, profile)
                 profile_ax.set_xlabel("Pulse phase (deg)")
                 profile_ax.set_ylabel("Flux density (a.u.)")
-                profile_ax.set_title("Profile of pulses {} to {}".format(cropped.first_pulse, cropped.first_pulse + (cropped.npulses - 1)*cropped.dpulse))
+                profile_ax.set_title("Profile of pulses {} to {}".format(cropped.first_pulse, cropped.get_pulse_from_bin(cropped.npulses - 1)))
                 profile_fig.show()
 
             elif event.key == "v":
@@ -1281,92 +3126,49 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 self.fig.canvas.draw()
 
             elif event.key == "d":
-                # Start a new instance of DriftAnalysisInteractivePlot for the cross correlation
-                self.cc = DriftAnalysisInteractivePlot()
-
-                # Actually do the cross correlation and "copy" it across to this instance
-                crosscorr = self.cross_correlate_successive_pulses()
-                self.cc.stokes      = crosscorr.stokes
-                self.cc.npulses     = crosscorr.npulses
-                self.cc.nbins       = crosscorr.nbins
-                self.cc.first_pulse = crosscorr.first_pulse
-                self.cc.first_phase = crosscorr.first_phase
-                self.cc.dpulse      = crosscorr.dpulse
-                self.cc.dphase_deg  = crosscorr.dphase_deg
-                self.cc.values      = crosscorr.values
-
-                # Remove all the subpulses and models
-                self.cc.subpulses = Subpulses()
-                self.cc.model_fits = {}
-                # ... but keep the drift sequence boundaries
-                self.cc.drift_sequences = copy.copy(self.drift_sequences)
-
-                # Make it interactive!
-                self.cc.start()
+                self.run_task("Cross-correlating", lambda task: self.cross_correlate_successive_pulses(), self.show_cross_correlation)
 
             elif event.key == "D":
                 self.ax.set_title("Select a drift sequence by clicking on the pulsestack.\nPress enter to confirm, esc to cancel.")
                 self.fig.canvas.draw()
                 self.mode = "assign_driftbands"
 
+            elif event.key == "R":
+                def show_clipped(result):
+                    idxs, driftbands, rejected, seqs, model_fits, npasses = result
+                    if len(idxs) == 0:
+                        print("No subpulses in any drift sequence with a model fit")
+                        return
+                    self.perform_edit(history.Edit("clip_driftbands", idxs=idxs, driftbands=driftbands, rejected=rejected, seqs=seqs, model_fits=model_fits))
+                    print("Refitted {} sequences in {} passes, rejecting {} of {} subpulses".format(
+                        len(seqs), npasses, np.sum(rejected), len(idxs)))
+
+                    self.replot_session()
+                    if self.jsonfile is not None:
+                        self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
+                    self.fig.canvas.draw()
+
+                self.run_task("Clipping driftbands", lambda task: self.calc_clipped_driftbands(progress=task.report_progress), show_clipped)
+
             elif event.key == "r":
                 self.ax.set_title("Select a drift sequence by clicking on the pulsestack.\nPress enter to confirm, esc to cancel.")
                 self.fig.canvas.draw()
                 self.mode = "plot_residuals"
 
             elif event.key == "T":
-                # Start a new instance of DriftAnalysisInteractivePlot for the LRFS
-                self.lrfs = DriftAnalysisInteractivePlot()
-
-                # Make the LRFS and copy the necessary fields across
-                lrfs = self.LRFS(pulse_range=self.ax.get_ylim())
-
-                self.lrfs.stokes      = lrfs.stokes
-                self.lrfs.npulses     = lrfs.npulses
-                self.lrfs.nbins       = lrfs.nbins
-                self.lrfs.first_pulse = lrfs.first_pulse
-                self.lrfs.first_phase = lrfs.first_phase
-                self.lrfs.dpulse      = lrfs.dpulse
-                self.lrfs.dphase_deg  = lrfs.dphase_deg
-                self.lrfs.complex     = lrfs.complex
-                self.lrfs.xlabel      = lrfs.xlabel
-                self.lrfs.ylabel      = lrfs.ylabel
-                self.lrfs.values      = lrfs.values
-
-                # Remove all the subpulses, models, and drift sequence boundaries
-                self.lrfs.subpulses = Subpulses()
-                self.lrfs.model_fits = {}
-                self.lrfs.drift_sequences = DriftSequences()
-
-                # Make it interactive!
-                self.lrfs.start()
+                pulse_range = self.ax.get_ylim()
+                self.run_task("Calculating LRFS", lambda task: self.LRFS(pulse_range=pulse_range, progress=task.report_progress), self.show_LRFS)
+
+            elif event.key == "2":
+                pulse_range = self.ax.get_ylim()
+                def calc_TDFS(task):
+                    tdfs = self.TDFS(pulse_range=pulse_range, window="hann")
+                    peak = self.get_TDFS_peak(pulse_range=pulse_range, nbootstrap=100, progress=task.report_progress)
+                    return tdfs, peak
+                self.run_task("Calculating 2DFS", calc_TDFS, self.show_TDFS)
 
             elif event.key == "A":
-                # Start a new instance of DriftAnalysisInteractivePlot for the auto correlation
-                self.ac = DriftAnalysisInteractivePlot()
-
-                # Actually do the cross correlation and "copy" it across to this instance
-                autocorr = self.auto_correlate_pulses()
-                self.ac.stokes      = autocorr.stokes
-                self.ac.npulses     = autocorr.npulses
-                self.ac.nbins       = autocorr.nbins
-                self.ac.first_pulse = autocorr.first_pulse
-                self.ac.first_phase = autocorr.first_phase
-                self.ac.dpulse      = autocorr.dpulse
-                self.ac.dphase_deg  = autocorr.dphase_deg
-                self.ac.complex     = autocorr.complex
-                self.ac.xlabel      = autocorr.xlabel
-                self.ac.ylabel      = autocorr.ylabel
-                self.ac.values      = autocorr.values
-
-                # Remove all the subpulses and models
-                self.ac.subpulses = Subpulses()
-                self.ac.model_fits = {}
-                # ... but keep the drift sequence boundaries
-                self.ac.drift_sequences = copy.copy(self.drift_sequences)
-
-                # Make it interactive!
-                self.ac.start()
+                self.run_task("Auto-correlating", lambda task: self.auto_correlate_pulses(), self.show_auto_correlation)
 
             elif event.key == "@":
                 self.ax.set_title("Quadratic fit: Choose subpulses ('.' to confirm subpulse,\nenter to confirm fit, esc to cancel)")
@@ -1374,65 +3176,47 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 self.mode = "model_fit"
                 self.quadratic_selected = []
                 self.quadratic_selected_plt = None
+                self.quadratic_fit = IncrementalLeastSquares(4)
                 self.drift_sequence_selected = None
 
             elif event.key == "$":
+                series = self.get_model_time_series()
                 dr_fig, dr_ax = plt.subplots()
-                for seq in self.model_fits:
-                    pulse_range = self.model_fits[seq].get_pulse_bounds()
-                    pulse_idx_range = self.get_pulse_bin(pulse_range)
-                    pulse_idxs = np.arange(pulse_idx_range[0], pulse_idx_range[1] + 1)
-                    pulses     = self.get_pulse_from_bin(pulse_idxs)
-                    driftrates = self.model_fits[seq].calc_driftrate(pulses)
-                    dr_ax.plot(pulses, driftrates, 'k')
+                dr_ax.plot(*self.break_time_series(series, "driftrate"), 'k')
                 dr_ax.set_xlabel("Pulse number")
                 dr_ax.set_ylabel("Drift rate (deg/pulse)")
                 dr_fig.show()
 
             elif event.key == "3":
+                series = self.get_model_time_series()
                 P3_fig, P3_ax = plt.subplots()
-                for seq in self.model_fits:
-                    pulse_range = self.model_fits[seq].get_pulse_bounds()
-                    pulse_idx_range = self.get_pulse_bin(pulse_range)
-                    pulse_idxs = np.arange(pulse_idx_range[0], pulse_idx_range[1] + 1)
-                    pulses     = self.get_pulse_from_bin(pulse_idxs)
-                    P3s        = np.abs(self.model_fits[seq].calc_P3(pulses))
-                    P3_ax.plot(pulses, P3s, 'k')
+                pulses, P3s = self.break_time_series(series, "P3")
+                P3_ax.plot(pulses, np.abs(P3s), 'k')
                 P3_ax.set_xlabel("Pulse number")
                 P3_ax.set_ylabel("$P_3/P_1$")
                 P3_fig.show()
 
             elif event.key == "&":
+                series = self.get_model_time_series()
                 dr_fig, dr_ax = plt.subplots()
-                for seq in self.model_fits:
-                    pulse_range = self.model_fits[seq].get_pulse_bounds()
-                    pulse_idx_range = self.get_pulse_bin(pulse_range)
-                    pulse_idxs = np.arange(pulse_idx_range[0], pulse_idx_range[1] + 1)
-                    pulses     = self.get_pulse_from_bin(pulse_idxs)
-                    decayrates = self.model_fits[seq].calc_driftrate_decay_rate(pulses)
-                    dr_ax.plot(pulses, decayrates, 'k')
+                dr_ax.plot(*self.break_time_series(series, "decay_rate"), 'k')
                 dr_ax.set_xlabel("Pulse number")
                 dr_ax.set_ylabel("Driftrate decay rate (/pulse)")
                 dr_fig.show()
 
             elif event.key == "%":
+                series = self.get_model_time_series()
                 dr_fig = plt.figure()
                 dr_ax = plt.axes(projection='3d')
-                p  = [] # Pulse number
-                d  = [] # Drift rate
-                dd = [] # Derivative of drift rate (w.r.t. pulse number)
-                for seq in self.model_fits:
-                    p_lo, p_hi = self.model_fits[seq].get_pulse_bounds()
-                    p.append(0.5*(p_lo + p_hi))
-                    d.append(self.model_fits[seq].calc_driftrate(p[-1]))
-                    dd.append(self.model_fits[seq].calc_driftrate_derivative(p[-1]))
-                    dr_ax.plot(p, d, dd, 'ro')
+                for model_name in series["models"]:
+                    m = series["models"][model_name]
+                    dr_ax.plot(m["pmid"], m["driftrate_mid"], m["driftrate_derivative_mid"], 'ro')
                 dr_ax.set_xlabel("Pulse number")
                 dr_ax.set_ylabel("Drift rate (deg/pulse)")
                 dr_ax.set_zlabel("Drift rate derivative (deg/pulse^2)")
                 dr_fig.show()
 
-            elif event.key in ["*", "("]:
+            elif event.key in ["*", "(", ")"]:
                 # Define what model is going to be plotted here
                 # (Use a dummy object to get the necessary parameters)
                 dummy = ModelFit()
@@ -1440,41 +3224,22 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                     dummy.model_name = "exponential"
                 elif event.key == "(":
                     dummy.model_name = "quadratic"
+                elif event.key == ")":
+                    dummy.model_name = "exponential_linear"
                 nparameters = dummy.get_nparameters()
                 param_names = dummy.get_parameter_names(display_type='latex')
 
-                param_fig, param_axs = plt.subplots(nrows=nparameters, ncols=1, sharex=True)
-
-                pmid       = [] # Central pulse number
-                perr       = [] # X error bar represents size of drift sequence
-                params     = [] # The parameter values
-                param_errs = [] # The errors on the parameter values
-
-                for seq in self.model_fits:
-
-                    # Only plot up exponential parameters
-                    if self.model_fits[seq].model_name != dummy.model_name:
-                        continue
-
-                    # Get the mid pulse and range of the drift sequences
-                    p_lo, p_hi = self.model_fits[seq].get_pulse_bounds()
-                    pmid.append(0.5*(p_hi + p_lo))
-                    perr.append(0.5*(p_hi - p_lo))
-
-                    # Get the parameter values
-                    params.append(self.model_fits[seq].parameters)
-                    if self.model_fits[seq].pcov is not None:
-                        param_errs.append(list(np.sqrt(np.diag(self.model_fits[seq].pcov))))
-                    else:
-                        param_errs.append(np.zeros((nparameters,)))
+                series = self.get_model_time_series()
+                if dummy.model_name not in series["models"]:
+                    print("There are no {} model fits to plot".format(dummy.model_name))
+                    return
+                m = series["models"][dummy.model_name]
 
-                # Convert the params and param_errs list-of-lists to Numpy arrays
-                params     = np.array(params)
-                param_errs = np.array(param_errs)
+                param_fig, param_axs = plt.subplots(nrows=nparameters, ncols=1, sharex=True)
 
-                # Plot everything up!
+                # Plot everything up! (Parameters without uncertainties are plotted without error bars)
                 for i in range(nparameters):
-                    param_axs[i].errorbar(pmid, params[:,i], xerr=perr, yerr=param_errs[:,i], fmt='.')
+                    param_axs[i].errorbar(m["pmid"], m["parameters"][:,i], xerr=m["perr"], yerr=np.nan_to_num(m["parameter_errors"][:,i]), fmt='.')
                     param_axs[i].set_ylabel("$" + param_names[i] + "$")
                 param_axs[-1].set_xlabel("Pulse number")
 
@@ -1485,11 +3250,42 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 self.fig.canvas.draw()
                 self.mode = "switch_to_exponential_and_solve"
 
+            elif event.key == "e":
+                self.ax.set_title("Select a drift sequence by clicking on the pulsestack.\nPress enter to confirm, esc to cancel.")
+                self.fig.canvas.draw()
+                self.mode = "switch_to_exponential_linear_and_solve"
+
             elif event.key == "m":
                     self.ax.set_title("Select a drift sequence by clicking on the pulsestack.\nPress enter to confirm, esc to cancel.")
                     self.fig.canvas.draw()
                     self.mode = "display_model_details"
 
+            elif event.key == "B":
+                self.ax.set_title("Select a drift sequence by clicking on the pulsestack.\nPress enter to confirm, esc to cancel.")
+                self.fig.canvas.draw()
+                self.mode = "resample_model_fit"
+
+            elif event.key == "W":
+                if self.subpulses.get_nsubpulses() == 0:
+                    print("No subpulses to fit")
+                    return
+
+                def set_widths(result):
+                    idxs, phases, widths = result
+                    if len(idxs) == 0:
+                        print("No subpulse fits succeeded")
+                        return
+                    self.perform_edit(history.Edit("set_subpulse_widths", idxs=idxs, phases=phases, widths=widths))
+                    print("Fitted {} of {} subpulses (median width {:.3f} deg)".format(
+                        len(idxs), self.subpulses.get_nsubpulses(), np.median(widths)))
+
+                    self.subpulses.plot_subpulses(self.ax)
+                    if self.jsonfile is not None:
+                        self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
+                    self.fig.canvas.draw()
+
+                self.run_task("Fitting subpulses", lambda task: self.calc_subpulse_widths(progress=task.report_progress), set_widths)
+
         ########################################
         # SPECIALISED KEYS FOR DIFFERENT MODES #
         ########################################
@@ -1526,8 +3322,9 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
         elif self.mode == "set_threshold":
             if event.key == "enter":
                 self.threshold_line.set_data([], [])
-                self.subpulses.delete_all_subpulses()
-                self.subpulses.add_subpulses(self.max_locations[1], self.max_locations[0])
+                nmaxima = self.max_locations.shape[1]
+                rows = np.transpose([self.max_locations[1], self.max_locations[0], np.full(nmaxima, np.nan), np.full(nmaxima, np.nan)])
+                self.perform_edit(history.Edit("replace_subpulses", rows=rows))
                 self.maxima_plt.set_data([], [])
                 self.subpulses.plot_subpulses(self.ax)
 
@@ -1544,8 +3341,8 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
 
         elif self.mode == "crop":
             if event.key == "enter":
-                self.crop(pulse_range=self.ax.get_ylim(), phase_deg_range=self.ax.get_xlim())
-                self.ps_image.set_data(self.values)
+                self.perform_edit(history.Edit("crop", pulse_range=list(self.ax.get_ylim()), phase_deg_range=list(self.ax.get_xlim())))
+                self.ps_image.set_data(self.get_image_values())
                 self.ps_image.set_extent(self.calc_image_extent())
                 if self.jsonfile is not None:
                     self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
@@ -1558,7 +3355,7 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 if self.selected is not None:
                     # Delete the selected point from the actual list
                     # Here, "selected" refers to the idx of subpulses[]
-                    self.subpulses.delete_subpulses(self.selected)
+                    self.perform_edit(history.Edit("delete_subpulses", idxs=[self.selected]))
 
                     # Delete the point from the plot
                     self.subpulses.plot_subpulses(self.ax)
@@ -1579,34 +3376,7 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
             if event.key == "enter":
                 if self.selected is not None:
                     # Here, "selected" refers to the idx of drift_mode_boundaries[]
-
-                    # Before actually deleting the boundary, we have to consider how deleting
-                    # it will affect the quadratic fits. Only two changes have to be made:
-                    #   1) the fits for the immediately affected sequences should be deleted,
-                    #      as there's no (easy) way to decide which of the two surrounding
-                    #      sequences should take precedence
-                    #   2) all quadratic fits to later sequences have to be assigned a new
-                    #      (lower) sequence number
-                    seq = self.selected
-                    nseq = self.drift_sequences.number_of_sequences()
-
-                    # 1.
-                    if seq in self.model_fits.keys():
-                        self.model_fits[seq].clear_all_plots()
-                        self.model_fits.pop(seq)
-
-                    if seq+1 in self.model_fits.keys():
-                        self.model_fits[seq+1].clear_all_plots()
-                        self.model_fits.pop(seq+1)
-
-                    # 2.
-                    # Start from the next sequence and work up, bumping each one down by 1 as we go
-                    for i in range(seq+2, nseq):
-                        if i in self.model_fits.keys():
-                            self.model_fits[i-1] = self.model_fits.pop(i)
-
-                    # Now, actually delete the selected boundary
-                    self.drift_sequences.delete_boundaries([self.selected])
+                    self.perform_edit(history.Edit("delete_boundary", boundary_idx=int(self.selected)))
 
                     # Delete the boundary line from the plot
                     self.plot_drift_mode_boundaries()
@@ -1627,7 +3397,7 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
             if event.key == "enter":
                 # Here, "selected" is [pulse, phase] of new candidate subpulse
                 if self.selected is not None:
-                    self.subpulses.add_subpulses([self.selected[1]], [self.selected[0]])
+                    self.perform_edit(history.Edit("add_subpulses", rows=[[self.selected[1], self.selected[0], np.nan, np.nan]]))
                     self.subpulses.plot_subpulses(self.ax)
                 self.deselect()
                 if self.jsonfile is not None:
@@ -1644,43 +3414,21 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                     return
 
                 # Here, "selected" refers to the pulse_idx of the drift mode boundary
+                edit = self.perform_edit(history.Edit("add_boundary", pulse_idx=int(self.selected)))
+                seq = edit.backward["seq"]
 
-                # Before actually adding the boundary, we have to consider how adding it
-                # will affect the quadratic fits. Only two changes have to be made:
-                #   1) all quadratic fits to later sequences have to be assigned a new
-                #      (higher) sequence number
-                #   2) the fit for the selected sequence should be copied to the two "new"
-                #      sequences, with the appropriate adjustments to the pulse ranges
-                seq = self.drift_sequences.get_sequence_number(self.selected, self.npulses)
-                nseq = self.drift_sequences.number_of_sequences()
-
-                # 1.
-                # Start from the last sequence and work down, bumping each one up by 1 as we go
-                for i in range(nseq, seq, -1):
-                    if i in self.model_fits.keys():
-                        self.model_fits[i+1] = self.model_fits.pop(i)
-
-                # 2.
-                if seq in self.model_fits.keys():
-                    self.model_fits[seq+1] = copy.copy(self.model_fits[seq])
-                    self.model_fits[seq].last_pulse_idx = self.selected
-                    self.model_fits[seq+1].first_pulse_idx = self.selected + 1
-
-                    # Redraw the affected plots
-                    if self.quadratic_visible:
-                        if self.onpulse is None:
-                            phlim = self.get_phase_from_bin(np.array([0, self.nbins-1]))
-                        else:
-                            phlim = self.onpulse
-
-                        self.model_fits[seq].clear_all_plots()
-                        self.model_fits[seq].plot_all_driftbands(self.ax, phlim, pstep=self.dpulse, color='k')
+                # Redraw the affected plots
+                if seq in self.model_fits.keys() and self.quadratic_visible:
+                    if self.onpulse is None:
+                        phlim = self.get_phase_from_bin(np.array([0, self.nbins-1]))
+                    else:
+                        phlim = self.onpulse
 
-                        self.model_fits[seq+1].clear_all_plots()
-                        self.model_fits[seq+1].plot_all_driftbands(self.ax, phlim, pstep=self.dpulse, color='k')
+                    self.model_fits[seq].clear_all_plots()
+                    self.model_fits[seq].plot_all_driftbands(self.ax, phlim, pstep=self.dpulse, color='k')
 
-                # Now actually add the boundary
-                self.drift_sequences.add_boundary(self.selected)
+                    self.model_fits[seq+1].clear_all_plots()
+                    self.model_fits[seq+1].plot_all_driftbands(self.ax, phlim, pstep=self.dpulse, color='k')
 
                 xlim = self.ax.get_xlim()
                 ylim = self.ax.get_ylim()
@@ -1725,27 +3473,24 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 if self.selected is None:
                     return
 
-                # Convert to quadratic model
-                self.model_fits[self.selected].convert_to_model("quadratic")
-                pulse_range = self.model_fits[self.selected].get_pulse_bounds()
-                subset = self.subpulses.in_pulse_range(pulse_range, with_valid_driftband=True)
+                # Convert to quadratic model and refit
+                self.refit_model_in_background(self.selected, "quadratic")
 
-                ph = self.subpulses.get_phases(subset=subset)
-                p  = self.subpulses.get_pulses(subset=subset)
-                d  = self.subpulses.get_driftbands(subset=subset)
-                self.model_fits[self.selected].optimise_fit_to_subpulses(ph, p, d)
+                self.deselect()
+                self.set_default_mode()
 
-                # Update the plot
-                if self.onpulse is None:
-                    phlim = self.get_phase_from_bin(np.array([0, self.nbins-1]))
-                else:
-                    phlim = self.onpulse
+            elif event.key == "escape":
+                self.deselect()
+                self.set_default_mode()
 
-                self.model_fits[self.selected].plot_all_driftbands(self.ax, phlim, pstep=self.dpulse, color='k')
+        elif self.mode == "switch_to_exponential_and_solve":
+            if event.key == "enter":
+                # Here, self.selected is the drift sequence idx
+                if self.selected is None:
+                    return
 
-                # Mark that unsaved changes have been made
-                if self.jsonfile is not None:
-                    self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
+                # Convert to exponential model and refit
+                self.refit_model_in_background(self.selected, "exponential")
 
                 self.deselect()
                 self.set_default_mode()
@@ -1754,33 +3499,40 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 self.deselect()
                 self.set_default_mode()
 
-        elif self.mode == "switch_to_exponential_and_solve":
+        elif self.mode == "switch_to_exponential_linear_and_solve":
             if event.key == "enter":
                 # Here, self.selected is the drift sequence idx
                 if self.selected is None:
                     return
 
-                # Convert to exponential model
-                self.model_fits[self.selected].convert_to_model("exponential")
-                pulse_range = self.model_fits[self.selected].get_pulse_bounds()
-                subset = self.subpulses.in_pulse_range(pulse_range, with_valid_driftband=True)
+                # Convert to exponential-plus-linear model and refit
+                self.refit_model_in_background(self.selected, "exponential_linear")
 
-                ph = self.subpulses.get_phases(subset=subset)
-                p  = self.subpulses.get_pulses(subset=subset)
-                d  = self.subpulses.get_driftbands(subset=subset)
-                self.model_fits[self.selected].optimise_fit_to_subpulses(ph, p, d)
+                self.deselect()
+                self.set_default_mode()
 
-                # Update the plot
-                if self.onpulse is None:
-                    phlim = self.get_phase_from_bin(np.array([0, self.nbins-1]))
-                else:
-                    phlim = self.onpulse
+            elif event.key == "escape":
+                self.deselect()
+                self.set_default_mode()
 
-                self.model_fits[self.selected].plot_all_driftbands(self.ax, phlim, pstep=self.dpulse, color='k')
 
-                # Mark that unsaved changes have been made
-                if self.jsonfile is not None:
-                    self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
+        elif self.mode == "label_drift_sequence":
+            if event.key == "enter":
+                # Here, self.selected is the drift sequence idx
+                if self.selected is None:
+                    return
+
+                root = tkinter.Tk()
+                root.withdraw()
+                label = tkinter.simpledialog.askstring("Drift mode", "Mode label for sequence {} (leave empty to remove)".format(self.selected),
+                        initialvalue=self.drift_mode_labels.get(self.selected, ""), parent=root)
+
+                # A cancelled dialog changes nothing
+                if label is not None:
+                    self.perform_edit(history.Edit("set_mode_label", seq=int(self.selected), label=label if label != "" else None))
+
+                    if self.jsonfile is not None:
+                        self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
 
                 self.deselect()
                 self.set_default_mode()
@@ -1789,7 +3541,6 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 self.deselect()
                 self.set_default_mode()
 
-
         elif self.mode == "assign_driftbands":
             if event.key == "enter":
                 # Here, self.selected is the drift sequence idx
@@ -1797,7 +3548,7 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                     return
 
                 # Assign each subpulse in sequence to the nearest driftband
-                subset = self.subpulses.assign_driftbands_to_subpulses(self.model_fits[self.selected])
+                self.perform_edit(history.Edit("assign_driftbands", seq=self.selected))
 
                 # Replot subpulses to reflect change in status
                 self.subpulses.plot_subpulses(self.ax)
@@ -1888,16 +3639,30 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 q  = np.array(self.quadratic_selected)
                 ph = q[:,0] # The phases
                 p  = q[:,1] # The pulses
-                d  = q[:,2] # The driftbands
 
-                # Draw the points selected so far
+                # Draw the points selected so far (animated, so that they can be redrawn
+                # on their own; see blit_candidate_fit())
                 if self.quadratic_selected_plt is None:
-                    self.quadratic_selected_plt = self.ax.plot(ph, p, 'bo')
+                    self.quadratic_selected_plt = self.ax.plot(ph, p, 'bo', animated=True)
                 else:
                     self.quadratic_selected_plt[0].set_data(ph, p)
 
+                # The quadratic model is linear in its parameters (its Jacobian is just the
+                # design matrix), so the fit can be updated with just this one new point
+                self.quadratic_fit.add_point(self.candidate_quadratic_model.calc_phase_jacobian(pulse, driftband), phase)
+
                 if len(self.quadratic_selected) >= 4:
-                    self.candidate_quadratic_model.optimise_fit_to_subpulses(ph, p, d)
+                    parameters, pcov = self.quadratic_fit.solve()
+                    if parameters is None:
+                        print("The selected subpulses don't determine a quadratic model yet (are they all on the same driftband?)")
+                        self.blit_candidate_fit()
+                        return
+
+                    self.candidate_quadratic_model.parameters = parameters
+                    self.candidate_quadratic_model.pcov       = pcov
+                    self.candidate_quadratic_model.intervals  = None
+                    self.candidate_quadratic_model.mcmc       = None
+
                     pulse_idx_range = self.drift_sequences.get_bounding_pulse_idxs(self.drift_sequence_selected, self.npulses)
                     first_pulse, last_pulse = self.get_pulse_from_bin(np.array(pulse_idx_range))
                     self.candidate_quadratic_model.set_pulse_bounds(first_pulse, last_pulse)
@@ -1908,22 +3673,23 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                     else:
                         phlim = self.onpulse
 
-                    # Clear all previous driftbands from the plot and replace them with new ones!
-                    self.candidate_quadratic_model.clear_all_plots()
-                    self.candidate_quadratic_model.plot_all_driftbands(self.ax, phlim, pstep=self.dpulse, color='w')
-                    self.fig.canvas.draw()
+                    # Move the driftbands already drawn, and only add/remove those that
+                    # have come into/gone out of range
+                    self.candidate_quadratic_model.update_all_driftbands(self.ax, phlim, pstep=self.dpulse, color='w', animated=True)
+
+                self.blit_candidate_fit()
 
             elif event.key == "enter" or event.key == "escape":
 
-                # If they push enter too early, do nothing
-                if event.key == "enter" and len(self.quadratic_selected) < 4:
+                # If they push enter too early (or before the points determine a model), do nothing
+                if event.key == "enter" and self.quadratic_fit.solve()[0] is None:
                     return
 
                 self.candidate_quadratic_model.clear_all_plots()
 
                 # The only difference between enter and escape is that enter saves the model
                 if event.key == "enter":
-                    self.model_fits[self.drift_sequence_selected] = copy.copy(self.candidate_quadratic_model)
+                    self.perform_edit(history.Edit("set_model_fit", seq=self.drift_sequence_selected, model_fit=self.candidate_quadratic_model.serialize()))
 
                     if self.jsonfile is not None:
                         self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
@@ -1955,6 +3721,41 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
                 self.deselect()
                 self.set_default_mode()
 
+        elif self.mode == "resample_model_fit":
+
+            if event.key == "enter":
+                # Here, self.selected is the drift sequence idx
+                if self.selected is None:
+                    return
+
+                problem_seqs, problems = self.get_resampling_problems([self.selected])
+                if len(problems) > 0:
+                    import resampling # (resampling itself imports this module)
+
+                    def resample(task):
+                        return resampling.resample_model_fits(problems, method="block_bootstrap", progress=task.report_progress)
+
+                    def show_intervals(results, seq=problem_seqs[0]):
+                        intervals, _ = results[0]
+                        if intervals is None:
+                            print("Too few resampled fits of sequence {} succeeded".format(seq))
+                            return
+                        self.set_model_fit_intervals([seq], [intervals])
+                        print(self.model_fits[seq])
+
+                        # Mark that unsaved changes have been made
+                        if self.jsonfile is not None:
+                            self.fig.canvas.manager.set_window_title(self.jsonfile + "*")
+
+                    self.run_task("Resampling model fit", resample, show_intervals)
+
+                self.deselect()
+                self.set_default_mode()
+
+            elif event.key == "escape":
+                self.deselect()
+                self.set_default_mode()
+
     def closest_drift_mode_boundary(self, y):
         dm_boundary_display = self.ax.transData.transform([[0,y] for y in self.get_pulse_from_bin(self.drift_sequences.get_pulse_mid_idxs())])
         dists = np.abs(y - dm_boundary_display[:,1])
@@ -1967,6 +3768,22 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
         idx = np.argmin(dists)
         return idx, dists[idx]
 
+    def instrument(self):
+        '''
+        Time the computations, plotting, and drawing that the handlers spend most of
+        their time on (see instrumentation.py). Only done if timing has been turned on,
+        so that there is no overhead otherwise.
+        '''
+        instrumentation.instrument_methods(pulsestack.Pulsestack, ["smooth_with_gaussian", "smooth_2d", "crop",
+            "cross_correlate_successive_pulses", "auto_correlate_pulses", "LRFS", "plot_image"])
+        instrumentation.instrument_methods(Subpulses, ["plot_subpulses", "add_subpulses", "assign_driftbands_to_subpulses"])
+        instrumentation.instrument_methods(ModelFit, ["calc_phase", "get_nearest_driftband", "optimise_fit_to_subpulses",
+            "plot_all_driftbands", "update_all_driftbands"])
+        instrumentation.instrument_methods(DriftAnalysis, ["get_local_maxima", "apply_edit", "plot_all_model_fits",
+            "save_json", "load_json"])
+
+        self.fig.canvas.draw = instrumentation.timed("canvas.draw", self.fig.canvas.draw)
+
     def start(self):
         '''
         Start the interactive plot
@@ -1981,6 +3798,7 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
 
         self.subpulses.plot_subpulses(self.ax)
         self.plot_drift_mode_boundaries()
+        self.plot_observation_joins()
         self.plot_all_model_fits()
 
         self.ax.set_xlim(xlim)
@@ -1989,9 +3807,21 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
         # Set the mode to "default"
         self.set_default_mode()
 
+        # Long computations are run in the background
+        self.tasks = tasks.TaskRunner(self.fig.canvas, self.set_task_status)
+
+        # Optionally time the handlers and the main steps within them
+        on_button_press_event = self.on_button_press_event
+        on_key_press_event    = self.on_key_press_event
+        if instrumentation.enabled:
+            self.instrument()
+            on_button_press_event = instrumentation.timed_handler("button", on_button_press_event)
+            on_key_press_event    = instrumentation.timed_handler("key", on_key_press_event)
+
         # Make it interactive!
-        self.cid = self.fig.canvas.mpl_connect('button_press_event', self.on_button_press_event)
-        self.cid = self.fig.canvas.mpl_connect('key_press_event', self.on_key_press_event)
+        self.cid = self.fig.canvas.mpl_connect('button_press_event', on_button_press_event)
+        self.cid = self.fig.canvas.mpl_connect('key_press_event', on_key_press_event)
+        self.cid = self.fig.canvas.mpl_connect('draw_event', self.on_draw_event)
 
         # Set the window title to the json filename
         if self.jsonfile is not None:
@@ -2005,6 +3835,19 @@ class DriftAnalysisInteractivePlot(DriftAnalysis):
 
 
 if __name__ == '__main__':
+    # Optionally time how long everything takes (see instrumentation.py)
+    if "--profile" in sys.argv:
+        sys.argv.remove("--profile")
+        instrumentation.enable()
+
+    # Export the tables of a saved session without starting the interactive plot:
+    #   python drift_analysis.py export <json_file> [txt] [npz] [parquet]
+    if len(sys.argv) >= 3 and sys.argv[1] == "export":
+        da = DriftAnalysis()
+        da.load_json(sys.argv[2])
+        da.export_tables(formats=sys.argv[3:] if len(sys.argv) > 3 else ["txt"])
+        sys.exit()
+
     # Start an interactive plot instance
     ps = DriftAnalysisInteractivePlot()
 
@@ -2012,6 +3855,12 @@ if __name__ == '__main__':
     # If one argument is given, assume it is in the custom saved (json) format
     if len(sys.argv) == 2:
         ps.load_json(sys.argv[1])
+    # If more than two are given, assume they are several pdv files (to be joined end to end)
+    # followed by a stokes parameter
+    elif len(sys.argv) > 3:
+        pdvfiles = sys.argv[1:-1]
+        stokes = sys.argv[-1]
+        ps.load_concatenated(pdvfiles, stokes)
     # Otherwise, assume the first argument is a pdv file, and the second is a stokes parameter
     else:
         pdvfile = sys.argv[1]
@@ -2022,3 +3871,7 @@ if __name__ == '__main__':
     ps.start()
     plt.show()
 
+    # Make sure any journalled edits are on disk before exiting
+    if ps.journal is not None:
+        ps.journal.close()
+
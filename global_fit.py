@@ -0,0 +1,234 @@
+'''
+Fit the model fits of all drift sequences (of one or more sessions) jointly, with
+each sequence keeping its own drift parameters, but with P2 shared between all the
+sequences of the same drift mode.
+
+Every model in ModelFit has P2 as its last parameter, so a sequence's parameters are
+its own "local" parameters followed by the P2 of its group. The residual of each
+subpulse only depends on the parameters of its own sequence and group, so the Jacobian
+is sparse, and the cost of the fit grows only linearly with the number of subpulses.
+'''
+
+import sys
+
+import numpy as np
+import scipy.sparse
+from scipy.optimize import least_squares
+
+import drift_analysis
+
+class GlobalFit:
+    '''
+    sessions - a list of DriftAnalysis objects (or a single one)
+    group_by - which sequences share a P2:
+               "mode"             - all sequences with the same mode label (in any session).
+                                    Unlabelled sequences all share one P2 ("None").
+               "mode_and_session" - as "mode", but each session separately
+               "all"              - all sequences
+    Only sequences with a model fit, and at least one subpulse with a driftband
+    assigned within the model's pulse range, are included.
+    '''
+    def __init__(self, sessions, group_by="mode"):
+        if isinstance(sessions, drift_analysis.DriftAnalysis):
+            sessions = [sessions]
+
+        self.sessions   = sessions
+        self.group_by   = group_by
+        self.sequences  = [] # One dictionary per included sequence
+        self.groups     = [] # The (distinct) group keys, in order of their P2s in the parameter vector
+
+        self.parameters = None
+        self.pcov       = None
+        self.chi2       = None
+        self.dof        = None
+
+        self.collect_sequences()
+        self.build_parameter_map()
+
+    def get_group_key(self, session_idx, label):
+        if self.group_by == "mode":
+            return str(label)
+        elif self.group_by == "mode_and_session":
+            return (session_idx, str(label))
+        elif self.group_by == "all":
+            return "all"
+        else:
+            raise ValueError("Unrecognised grouping '{}'".format(self.group_by))
+
+    def collect_sequences(self):
+        for session_idx, session in enumerate(self.sessions):
+            if session.subpulses.get_nsubpulses() == 0:
+                continue
+
+            for seq in sorted(session.model_fits.keys()):
+                model_fit = session.model_fits[seq]
+                if model_fit.parameters is None:
+                    continue
+
+                subset = session.subpulses.in_pulse_range(np.array(model_fit.get_pulse_bounds()), with_valid_driftband=True)
+                if not np.any(subset):
+                    continue
+
+                group = self.get_group_key(session_idx, session.drift_mode_labels.get(seq))
+                if group not in self.groups:
+                    self.groups.append(group)
+
+                self.sequences.append({
+                    "session_idx": session_idx,
+                    "seq":         seq,
+                    "model_fit":   model_fit,
+                    "group":       group,
+                    "phases":      session.subpulses.get_phases(subset=subset),
+                    "pulses":      session.subpulses.get_pulses(subset=subset),
+                    "driftbands":  session.subpulses.get_driftbands(subset=subset),
+                    })
+
+        if len(self.sequences) == 0:
+            raise ValueError("No sequences with both a model fit and subpulses assigned to driftbands")
+
+    def build_parameter_map(self):
+        '''
+        Lay out the parameter vector (the local parameters of every sequence, followed by
+        the shared P2s), and work out, for every subpulse, which elements of it are the
+        parameters of its sequence's model
+        '''
+        nlocal = [len(s["model_fit"].parameters) - 1 for s in self.sequences]
+        local_offsets = np.concatenate([[0], np.cumsum(nlocal)[:-1]]).astype(int)
+        self.nlocal_total = int(np.sum(nlocal))
+
+        for s, offset, n in zip(self.sequences, local_offsets, nlocal):
+            s["parameter_idxs"] = np.append(offset + np.arange(n), self.nlocal_total + self.groups.index(s["group"]))
+
+        self.nparameters = self.nlocal_total + len(self.groups)
+
+        # The points (subpulses) of all sequences, end to end
+        self.phases     = np.concatenate([s["phases"] for s in self.sequences])
+        self.pulses     = np.concatenate([s["pulses"] for s in self.sequences])
+        self.driftbands = np.concatenate([s["driftbands"] for s in self.sequences])
+        self.seq_of_point = np.repeat(np.arange(len(self.sequences)), [len(s["phases"]) for s in self.sequences])
+
+        # Points are evaluated one kind of model at a time
+        self.model_names = sorted(set([s["model_fit"].model_name for s in self.sequences]))
+
+    def get_initial_parameters(self):
+        x0 = np.zeros(self.nparameters)
+        P2s = [[] for group in self.groups]
+        for s in self.sequences:
+            parameters = np.array(s["model_fit"].parameters, dtype=float)
+            x0[s["parameter_idxs"][:-1]] = parameters[:-1]
+            P2s[self.groups.index(s["group"])].append(parameters[-1])
+
+        # Each shared P2 starts at the average of those of its sequences
+        x0[self.nlocal_total:] = [np.mean(P2) for P2 in P2s]
+        return x0
+
+    def get_point_models(self, x, model_name):
+        '''
+        Returns a mask of the points belonging to sequences with the given kind of model,
+        and a stand-in ModelFit whose parameters (and first_pulse) are arrays with
+        one element per such point, so that it can evaluate all of them at once
+        '''
+        in_model = np.array([s["model_fit"].model_name == model_name for s in self.sequences])
+        on_points = in_model[self.seq_of_point]
+
+        parameter_idxs = np.array([s["parameter_idxs"] for s in self.sequences if s["model_fit"].model_name == model_name])
+        first_pulses   = np.array([s["model_fit"].first_pulse for s in self.sequences if s["model_fit"].model_name == model_name], dtype=float)
+        model_of_point = np.cumsum(in_model)[self.seq_of_point[on_points]] - 1
+
+        model = drift_analysis.ModelFit()
+        model.model_name  = model_name
+        model.parameters  = x[parameter_idxs[model_of_point]].T
+        model.first_pulse = first_pulses[model_of_point]
+
+        return on_points, model, parameter_idxs[model_of_point]
+
+    def calc_residuals(self, x):
+        residuals = np.empty(len(self.phases))
+        for model_name in self.model_names:
+            on_points, model, _ = self.get_point_models(x, model_name)
+            residuals[on_points] = self.phases[on_points] - model.calc_phase(self.pulses[on_points], self.driftbands[on_points])
+        return residuals
+
+    def calc_jacobian(self, x):
+        rows = []
+        cols = []
+        vals = []
+        for model_name in self.model_names:
+            on_points, model, parameter_idxs = self.get_point_models(x, model_name)
+            jac = model.calc_phase_jacobian(self.pulses[on_points], self.driftbands[on_points])
+
+            rows.append(np.repeat(np.flatnonzero(on_points), jac.shape[1]))
+            cols.append(parameter_idxs.ravel())
+            vals.append(-jac.ravel()) # The residuals are data minus model
+
+        return scipy.sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                shape=(len(self.phases), self.nparameters))
+
+    def fit(self, **kwargs):
+        '''
+        Do the joint least squares fit, starting from the sequences' current model fits.
+        Extra keyword arguments are passed on to scipy's least_squares.
+        The covariance of all the parameters is scaled by the reduced chi-squared (i.e.
+        the phase uncertainties are assumed to be equal, and estimated from the residuals),
+        as ModelFit.optimise_fit_to_subpulses() does (like curve_fit).
+        '''
+        res = least_squares(self.calc_residuals, self.get_initial_parameters(), jac=self.calc_jacobian,
+                tr_solver='lsmr', x_scale='jac', **kwargs)
+
+        self.parameters = res.x
+        self.chi2 = np.sum(res.fun**2)
+        self.dof  = len(self.phases) - self.nparameters
+
+        JTJ = (res.jac.T @ res.jac).toarray()
+        self.pcov = np.linalg.pinv(JTJ)*self.chi2/max(self.dof, 1)
+
+        return res
+
+    def get_shared_P2s(self):
+        '''
+        Returns a dictionary of (P2, uncertainty) for each group
+        '''
+        return {group: (self.parameters[self.nlocal_total + i], np.sqrt(self.pcov[self.nlocal_total + i, self.nlocal_total + i]))
+                for i, group in enumerate(self.groups)}
+
+    def get_sequence_fit(self, i):
+        '''
+        Returns the (full) parameters of the i'th included sequence (see self.sequences),
+        and their covariance matrix, taken from the covariance of all parameters
+        '''
+        idxs = self.sequences[i]["parameter_idxs"]
+        return self.parameters[idxs], self.pcov[np.ix_(idxs, idxs)]
+
+    def apply(self):
+        '''
+        Set the parameters (and pcov) of every included sequence's model fit to the result
+        '''
+        for i, s in enumerate(self.sequences):
+            parameters, pcov = self.get_sequence_fit(i)
+            s["model_fit"].parameters = parameters
+            s["model_fit"].pcov       = pcov
+            s["model_fit"].intervals  = None
+            s["model_fit"].mcmc       = None
+
+    def __str__(self):
+        if self.parameters is None:
+            return "Global fit of {} sequences (not yet fitted)".format(len(self.sequences))
+
+        lines = ["Global fit of {} sequences, {} subpulses: chi2 = {:.3f}, dof = {}".format(
+            len(self.sequences), len(self.phases), self.chi2, self.dof)]
+        for group, (P2, P2_err) in self.get_shared_P2s().items():
+            nseqs = len([s for s in self.sequences if s["group"] == group])
+            lines.append("  P2 ({}, {} sequences) = {:.4f} +- {:.4f} deg".format(group, nseqs, P2, P2_err))
+        return "\n".join(lines)
+
+if __name__ == '__main__':
+    # Fit all the sessions given on the command line jointly, and print the shared P2s
+    sessions = []
+    for jsonfile in sys.argv[1:]:
+        session = drift_analysis.DriftAnalysis()
+        session.load_json(jsonfile)
+        sessions.append(session)
+
+    global_fit = GlobalFit(sessions)
+    global_fit.fit()
+    print(global_fit)
@@ -0,0 +1,148 @@
+import os
+import sys
+import tempfile
+import numpy as np
+
+# Default memory cap for the undo/redo history (bytes)
+DEFAULT_MAX_BYTES = 64*1024**2
+
+def get_nbytes(value):
+    '''
+    A (rough) estimate of the memory held by an edit payload value. Numpy arrays are
+    counted exactly, and dictionaries, lists and tuples (e.g. serialized model fits, or
+    lists of rows) are counted along with everything in them
+    '''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sys.getsizeof(value) + sum([get_nbytes(v) for v in value.values()])
+    elif isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum([get_nbytes(v) for v in value])
+    else:
+        return sys.getsizeof(value)
+
+class Edit:
+    '''
+    A single reversible change to a drift analysis session.
+
+    kind     - a string naming the type of edit (e.g. "add_subpulses")
+    forward  - a dictionary of whatever is needed to (re)apply the edit
+    backward - a dictionary of whatever is needed to undo the edit. This is
+               filled in by whoever applies the edit, at the time it is applied,
+               so that only the parts of the session that actually change are kept
+    '''
+    def __init__(self, kind, **forward):
+        self.kind      = kind
+        self.forward   = forward
+        self.backward  = {}
+        self.spillfile = None
+
+    def nbytes(self):
+        '''
+        A (rough) estimate of the memory held by this edit (see get_nbytes())
+        '''
+        return get_nbytes(self.forward) + get_nbytes(self.backward)
+
+    def spill(self, **arrays):
+        '''
+        Write the given arrays out to a temporary file instead of keeping them
+        in memory. They can be retrieved again with unspill()
+        '''
+        self.discard()
+        fd, self.spillfile = tempfile.mkstemp(prefix="drift_analysis_undo_", suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+
+    def unspill(self):
+        with np.load(self.spillfile) as spilled:
+            return {key: spilled[key] for key in spilled.files}
+
+    def discard(self):
+        '''
+        Release any resources held outside of memory (i.e. spill files)
+        '''
+        if self.spillfile is not None:
+            if os.path.exists(self.spillfile):
+                os.remove(self.spillfile)
+            self.spillfile = None
+
+class EditHistory:
+    '''
+    An undo/redo log of Edits, capped at max_bytes of memory.
+    When the cap is exceeded, the oldest edits are evicted (and can no longer be undone).
+    '''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes  = max_bytes
+        self.undo_stack = []
+        self.redo_stack = []
+        self.edit_nbytes = {} # The size of each edit in the history (keyed by id), measured when it was (re)applied
+
+    def get_nbytes(self):
+        return sum(self.edit_nbytes.values())
+
+    def measure(self, edit):
+        # (Measuring nested payloads takes a while, so each edit is only measured once
+        # each time it enters the history, i.e. after its backward payload was (re)filled)
+        self.edit_nbytes[id(edit)] = edit.nbytes()
+
+    def forget(self, edit):
+        self.edit_nbytes.pop(id(edit), None)
+        edit.discard()
+
+    def keep_in_memory(self, nbytes):
+        '''
+        Decide whether a large undo payload (e.g. the margins removed by a crop)
+        is small enough to be held in memory, or should be spilled to disk instead
+        '''
+        return nbytes <= self.max_bytes//4
+
+    def record(self, edit):
+        '''
+        Record an edit that has just been applied. Anything that could previously
+        have been redone is forgotten.
+        '''
+        for redo_edit in self.redo_stack:
+            self.forget(redo_edit)
+        self.redo_stack = []
+
+        self.undo_stack.append(edit)
+        self.measure(edit)
+        self.evict()
+
+    def evict(self):
+        # Drop the oldest undoable edits first, then the most distant redoable ones,
+        # but never the edit that was just made
+        nbytes = self.get_nbytes()
+        while nbytes > self.max_bytes and len(self.undo_stack) + len(self.redo_stack) > 1:
+            if len(self.undo_stack) > 1 or len(self.redo_stack) == 0:
+                edit = self.undo_stack.pop(0)
+            else:
+                edit = self.redo_stack.pop(0)
+            nbytes -= self.edit_nbytes.get(id(edit), 0)
+            self.forget(edit)
+
+    def pop_undo(self):
+        if len(self.undo_stack) == 0:
+            return None
+        return self.undo_stack.pop()
+
+    def push_undo(self, edit):
+        self.undo_stack.append(edit)
+        self.measure(edit)
+        self.evict()
+
+    def pop_redo(self):
+        if len(self.redo_stack) == 0:
+            return None
+        return self.redo_stack.pop()
+
+    def push_redo(self, edit):
+        self.redo_stack.append(edit)
+        self.measure(edit)
+        self.evict()
+
+    def clear(self):
+        for edit in self.undo_stack + self.redo_stack:
+            self.forget(edit)
+        self.undo_stack = []
+        self.redo_stack = []
@@ -0,0 +1,132 @@
+import os
+import time
+import atexit
+import functools
+import collections
+
+import numpy as np
+
+# Set this environment variable (to anything but "" or "0") to turn on timing
+ENV_VAR = "DRIFT_ANALYSIS_PROFILE"
+
+# How many of the most recent timings to keep for each instrumented step
+DEFAULT_HISTORY = 1000
+
+# Histogram bin edges (s) used in the report: half-decades from 10 us to 10 s
+HISTOGRAM_EDGES = 10**np.arange(-5, 1.5, 0.5)
+
+enabled = os.environ.get(ENV_VAR, "") not in ["", "0"]
+
+class Timings:
+    '''
+    Rolling records of how long each named step has taken. Only the most recent
+    history timings of each step are kept, so that the report reflects how the
+    viewer is behaving now (e.g. after cropping) rather than on average.
+    '''
+    def __init__(self, history=DEFAULT_HISTORY):
+        self.history = history
+        self.records = collections.OrderedDict()
+        self.counts  = collections.Counter()
+
+    def record(self, name, seconds):
+        if name not in self.records:
+            self.records[name] = collections.deque(maxlen=self.history)
+        self.records[name].append(seconds)
+        self.counts[name] += 1
+
+    def clear(self):
+        self.records.clear()
+        self.counts.clear()
+
+    def get_histogram(self, name):
+        # Returns the number of (recent) timings of the given step in each HISTOGRAM_EDGES bin
+        counts, _ = np.histogram(np.clip(self.records[name], HISTOGRAM_EDGES[0], HISTOGRAM_EDGES[-1]), bins=HISTOGRAM_EDGES)
+        return counts
+
+    def report(self):
+        '''
+        Returns a text report of the timings of every step, slowest (by total recent time) first,
+        with a histogram whose columns are half-decades from 10 us to 10 s
+        '''
+        if len(self.records) == 0:
+            return "No timings recorded"
+
+        lines = ["{:<48s} {:>7s} {:>9s} {:>9s} {:>9s} {:>9s}  {}".format(
+            "Step", "Calls", "Mean(ms)", "Med(ms)", "95%(ms)", "Max(ms)", "Histogram (10us..10s)")]
+
+        names = sorted(self.records.keys(), key=lambda name: -np.sum(self.records[name]))
+        for name in names:
+            t = 1e3*np.array(self.records[name])
+            histogram = self.get_histogram(name)
+            bars = "".join([" .:-=+*#%@"[min(9, int(np.ceil(9*n/np.max(histogram))))] for n in histogram])
+            lines.append("{:<48s} {:>7d} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}  |{}|".format(
+                name[:48], self.counts[name], np.mean(t), np.median(t), np.percentile(t, 95), np.max(t), bars))
+
+        return "\n".join(lines)
+
+# All timings go here
+timings = Timings()
+
+def timed(name, function):
+    '''
+    Returns a version of function that records how long each call takes under the given name
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings.record(name, time.perf_counter() - start)
+    return wrapper
+
+def timed_handler(name, handler):
+    '''
+    Like timed(), but for Matplotlib event handlers, so that (e.g.) each key is timed separately
+    '''
+    @functools.wraps(handler)
+    def wrapper(event):
+        start = time.perf_counter()
+        try:
+            return handler(event)
+        finally:
+            key = getattr(event, "key", None) if event.name == "key_press_event" else getattr(event, "button", None)
+            timings.record("{} {}".format(name, key), time.perf_counter() - start)
+    return wrapper
+
+def instrument_methods(cls, method_names):
+    '''
+    Replace the given methods of a class with timed versions (named "Class.method").
+    Methods that are already instrumented are left alone.
+    '''
+    for method_name in method_names:
+        method = getattr(cls, method_name)
+        if getattr(method, "instrumented", False):
+            continue
+        wrapper = timed("{}.{}".format(cls.__name__, method_name), method)
+        wrapper.instrumented = True
+        setattr(cls, method_name, wrapper)
+
+def print_report():
+    print(timings.report())
+
+def enable():
+    '''
+    Turn on timing (e.g. from a command line flag), printing a report when the program exits.
+    Instrumentation is only put in place by code that checks "enabled" after this is called,
+    so this should be done before anything is set up.
+    '''
+    global enabled
+    enabled = True
+    register_report_at_exit()
+
+report_registered = False
+
+def register_report_at_exit():
+    global report_registered
+    if not report_registered:
+        atexit.register(print_report)
+        report_registered = True
+
+if enabled:
+    register_report_at_exit()
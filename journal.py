@@ -0,0 +1,247 @@
+import os
+import json
+import queue
+import threading
+import numpy as np
+
+def journal_filename(jsonfile):
+    return jsonfile + ".journal"
+
+def to_json(obj):
+    '''
+    Used as the "default" argument of json.dump(s), for the numpy types that
+    can turn up in edit payloads
+    '''
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+def write_session_file(jsonfile, drift_dict):
+    '''
+    Write a whole (serialized) session to jsonfile. It is written to a temporary file
+    first, so that a crash part way through doesn't destroy the previous save.
+    '''
+    with open(jsonfile + ".tmp", "w") as f:
+        json.dump(drift_dict, f)
+    os.replace(jsonfile + ".tmp", jsonfile)
+
+def make_entry(edit, action=None):
+    '''
+    The journal entry for applying an edit or, if action is "undo" or "redo", for undoing
+    or redoing it. These carry the whole edit (and undo entries its backward payload too,
+    including anything spilled to disk), so that they can be replayed even if the edit
+    itself was made before the journal was started (i.e. before the last save).
+    '''
+    entry = {"kind": edit.kind, "forward": edit.forward}
+    if action is None:
+        return entry
+
+    if action == "undo":
+        entry["backward"] = dict(edit.backward)
+        if edit.spillfile is not None:
+            entry["backward"]["spilled"] = edit.unspill()
+
+    return {"kind": action, "edit": entry}
+
+def is_same_edit(edit, entry):
+    # Whether an edit (e.g. at the top of the undo stack) is the one in a journal entry
+    return edit.kind == entry["kind"] and \
+            json.dumps(edit.forward, default=to_json, sort_keys=True) == json.dumps(entry["forward"], default=to_json, sort_keys=True)
+
+def read_journal(jsonfile, generation):
+    '''
+    Returns the list of entries in the journal belonging to jsonfile.
+    The journal is only valid if it was started from the same save ("generation")
+    of the session file; otherwise (or if there is no journal) an empty list is returned.
+    A partially written last line (e.g. from a crash) is ignored.
+    '''
+    filename = journal_filename(jsonfile)
+    if not os.path.exists(filename):
+        return []
+
+    with open(filename, "r") as f:
+        lines = f.readlines()
+
+    if len(lines) == 0:
+        return []
+
+    try:
+        header = json.loads(lines[0])
+    except json.JSONDecodeError:
+        return []
+
+    if header.get("generation") != generation:
+        return []
+
+    entries = []
+    for line in lines[1:]:
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            break
+
+    return entries
+
+class Journal:
+    '''
+    An append-only log of the edits made to a session since it was last saved in full.
+    Entries are written (and flushed to disk) by a background thread, so that
+    appending to the journal costs the GUI thread almost nothing. The same thread
+    also folds the journal back into the session file when asked to (see compact()).
+
+    If the journal can't be written (e.g. the disk is full), the writer thread records
+    the error (in error) and writes nothing more, since any later entries could no
+    longer be replayed in order; it keeps taking entries off the queue, so that flush()
+    and close() never hang.
+    '''
+    def __init__(self, jsonfile, generation, nentries=0):
+        '''
+        If nentries > 0, the existing journal (with that many entries) is continued,
+        otherwise a new one is started
+        '''
+        self.jsonfile   = jsonfile
+        self.filename   = journal_filename(jsonfile)
+        self.generation = generation
+        self.nentries   = nentries
+        self.error      = None
+        self.compaction = None # "pending" while a compaction is queued, "failed" if one couldn't be done
+        self.lock       = threading.Lock() # (nentries is changed by both threads)
+
+        if nentries == 0:
+            with open(self.filename, "w") as f:
+                f.write(json.dumps({"generation": generation}) + "\n")
+        else:
+            self.truncate(nentries)
+
+        self.queue  = queue.Queue()
+        self.thread = threading.Thread(target=self.write_entries, daemon=True)
+        self.thread.start()
+
+    def truncate(self, nentries):
+        '''
+        Cut the journal off after its header and first nentries entries, so that anything
+        after them that read_journal() ignored (e.g. a line left half written by a crash)
+        can't swallow the entries appended after it
+        '''
+        with open(self.filename, "r+b") as f:
+            for i in range(nentries + 1):
+                line = f.readline()
+
+            f.seek(f.tell())
+            if not line.endswith(b"\n"):
+                f.write(b"\n")
+            f.truncate()
+
+    def write_entries(self):
+        try:
+            f = open(self.filename, "a")
+        except OSError as err:
+            f = self.fail(err)
+
+        while True:
+            entry = self.queue.get()
+            try:
+                if entry is None:
+                    if f is not None:
+                        f.close()
+                    return
+
+                # (After a failure, nothing more is written)
+                if f is None:
+                    continue
+
+                if isinstance(entry, tuple):
+                    f = self.write_compaction(f, *entry)
+                    continue
+
+                try:
+                    f.write(json.dumps(entry, default=to_json) + "\n")
+                except TypeError as err:
+                    print("Could not write journal entry:", err)
+
+                # Only pay for the flush once the backlog has been written
+                if self.queue.empty():
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            except OSError as err:
+                f = self.fail(err, f)
+
+            finally:
+                self.queue.task_done()
+
+    def fail(self, err, f=None):
+        # (On the writer thread) Give up on the journal. Returns the (now absent) journal file.
+        print("Could not write to the journal {}: {}".format(self.filename, err))
+        self.error = err
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+        return None
+
+    def write_compaction(self, f, drift_dict, generation, nentries):
+        '''
+        (On the writer thread) Write the session out in full, and then start the journal
+        afresh. Until the session file has been replaced, the old journal is still complete
+        and valid; once it has, the old journal no longer matches the session file's
+        generation, so a crash in between loses nothing. Only then are the journal's
+        generation and number of entries (less the nentries folded into the session file)
+        updated. Returns the (new) journal file.
+        '''
+        f.flush()
+        os.fsync(f.fileno())
+
+        try:
+            write_session_file(self.jsonfile, drift_dict)
+        except (TypeError, OSError) as err:
+            # (The old journal is still good for the old session file, so carry on with
+            # it, but don't try again until the next full save)
+            print("Could not save out json file:", err)
+            self.compaction = "failed"
+            return f
+
+        f.close()
+        f = open(self.filename, "w")
+        f.write(json.dumps({"generation": generation}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+        with self.lock:
+            self.generation = generation
+            self.nentries  -= nentries
+        self.compaction = None
+        return f
+
+    def append(self, entry):
+        self.queue.put(entry)
+        with self.lock:
+            self.nentries += 1
+
+    def compact(self, drift_dict, generation):
+        '''
+        Replace the session file with drift_dict (the whole session, with the given
+        generation), and start a new journal, once everything appended so far is written
+        (see write_compaction())
+        '''
+        self.compaction = "pending"
+        self.queue.put((drift_dict, generation, self.nentries))
+
+    def flush(self):
+        '''
+        Block until everything appended so far is on disk
+        '''
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
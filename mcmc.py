@@ -0,0 +1,268 @@
+'''
+Posterior sampling of the parameters of drift sequence model fits (see ModelFit),
+with an affine-invariant ensemble sampler (the "stretch move" of Goodman & Weare, 2010,
+as used by emcee). The log-likelihood is evaluated for all walkers at once, with the
+model's own formulas broadcast over walkers x subpulses.
+
+Besides the model parameters, the scatter of the subpulse phases about the model
+(sigma, sampled as log_sigma) is also a free parameter. Optionally, a fraction
+(outlier_fraction) of the subpulses can be "outliers" which don't follow the model,
+e.g. during interruptions of the drift, whose phases are instead scattered over a
+much wider Gaussian (of width outlier_sigma, by default half of P2).
+
+Chains are saved (in single precision) in an npz file, and each model fit that has
+been sampled records which file (and which arrays in it) hold its chain.
+
+Usage:
+
+    python mcmc.py <json_file> [<nsteps> [outliers]]
+
+which samples every drift sequence with a model fit, saves the chains to
+<json_file>.chains.npz, and saves the links to them in the session.
+'''
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import drift_analysis
+
+DEFAULT_NWALKERS = 32
+
+# The scale parameter of the stretch move (the usual choice)
+STRETCH_SCALE = 2.0
+
+def get_parameter_names(model_name, outliers=False):
+    # The names of the sampled parameters: the model's, then the nuisance parameters
+    model_fit = drift_analysis.ModelFit()
+    model_fit.model_name = model_name
+    names = model_fit.get_parameter_names() + ["log_sigma"]
+    if outliers == True:
+        names.append("outlier_fraction")
+    return names
+
+def log_probability(theta, model_name, first_pulse, phases, pulses, driftbands, outliers=False, outlier_sigma=None):
+    '''
+    The log posterior (flat priors, up to a constant) of each row of theta (nwalkers x ndim),
+    whose columns are as in get_parameter_names(). Returns an array with one value per walker.
+    '''
+    nparameters = theta.shape[1] - (2 if outliers == True else 1)
+
+    # A stand-in model whose parameters are columns (nwalkers x 1), so that calc_phase()
+    # broadcasts them against the subpulses, giving the phases of every walker's model
+    # for every subpulse (nwalkers x nsubpulses) in one go
+    model = drift_analysis.ModelFit()
+    model.model_name  = model_name
+    model.parameters  = theta[:,:nparameters,np.newaxis].transpose(1, 0, 2)
+    model.first_pulse = first_pulse
+
+    sigma = np.exp(theta[:,nparameters])[:,np.newaxis]
+    residuals = phases - model.calc_phase(pulses, driftbands)
+
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        log_inlier = -0.5*(residuals/sigma)**2 - np.log(sigma) - 0.5*np.log(2*np.pi)
+
+        if outliers == True:
+            f = theta[:,nparameters+1][:,np.newaxis]
+            log_outlier = -0.5*(residuals/outlier_sigma)**2 - np.log(outlier_sigma) - 0.5*np.log(2*np.pi)
+            log_like = np.sum(np.logaddexp(np.log1p(-f) + log_inlier, np.log(f) + log_outlier), axis=1)
+            in_prior = np.logical_and(theta[:,nparameters+1] > 0, theta[:,nparameters+1] < 1)
+            log_like[~in_prior] = -np.inf
+        else:
+            log_like = np.sum(log_inlier, axis=1)
+
+    # Anything the model can't evaluate (e.g. overflowing exponentials) is ruled out
+    log_like[~np.isfinite(log_like)] = -np.inf
+    return log_like
+
+def run_sampler(model_fit, phases, pulses, driftbands, nwalkers=DEFAULT_NWALKERS, nsteps=2000,
+        outliers=False, outlier_sigma=None, seed=None):
+    '''
+    Sample the posterior of a model fit's parameters (plus the nuisance parameters; see
+    get_parameter_names()), given the subpulses assigned to its driftbands. The walkers
+    start in a small ball around the model's current parameters, which should already be
+    a good (e.g. least squares) fit.
+
+    Returns a dictionary with the "chain" (nsteps x nwalkers x ndim, single precision),
+    the "log_prob" of every sample (nsteps x nwalkers), the "parameter_names", and the
+    "acceptance" fraction of each walker.
+    '''
+    rng = np.random.default_rng(seed)
+    phases, pulses, driftbands = np.asarray(phases, dtype=float), np.asarray(pulses, dtype=float), np.asarray(driftbands, dtype=float)
+
+    if outlier_sigma is None:
+        outlier_sigma = 0.5*np.abs(model_fit.calc_P2())
+
+    parameters = np.array(model_fit.parameters, dtype=float)
+    residuals = phases - model_fit.calc_phase(pulses, driftbands)
+    start = np.append(parameters, np.log(np.std(residuals)))
+    if outliers == True:
+        start = np.append(start, 0.05)
+    ndim = len(start)
+
+    # The starting ball is much smaller than the expected posterior widths
+    if model_fit.pcov is not None and np.all(np.isfinite(np.diag(model_fit.pcov))):
+        scales = np.sqrt(np.abs(np.diag(model_fit.pcov)))
+    else:
+        scales = 1e-4*np.maximum(np.abs(parameters), 1e-6)
+    scales = np.append(1e-2*scales, [1e-3]*(ndim - len(parameters)))
+    walkers = start + scales*rng.standard_normal((nwalkers, ndim))
+
+    args = (model_fit.model_name, model_fit.first_pulse, phases, pulses, driftbands, outliers, outlier_sigma)
+    log_probs = log_probability(walkers, *args)
+
+    chain = np.empty((nsteps, nwalkers, ndim), dtype=np.float32)
+    chain_log_prob = np.empty((nsteps, nwalkers), dtype=np.float32)
+    naccepted = np.zeros(nwalkers)
+
+    # Each half of the ensemble is moved in turn, using the other half as the
+    # complementary ensemble
+    halves = [np.arange(0, nwalkers//2), np.arange(nwalkers//2, nwalkers)]
+    for step in range(nsteps):
+        for this, other in [(halves[0], halves[1]), (halves[1], halves[0])]:
+            z = ((STRETCH_SCALE - 1)*rng.random(len(this)) + 1)**2/STRETCH_SCALE
+            partners = walkers[rng.choice(other, size=len(this))]
+            proposals = partners + z[:,np.newaxis]*(walkers[this] - partners)
+
+            proposal_log_probs = log_probability(proposals, *args)
+            log_accept = (ndim - 1)*np.log(z) + proposal_log_probs - log_probs[this]
+            accepted = np.log(rng.random(len(this))) < log_accept
+
+            walkers[this[accepted]] = proposals[accepted]
+            log_probs[this[accepted]] = proposal_log_probs[accepted]
+            naccepted[this[accepted]] += 1
+
+        chain[step] = walkers
+        chain_log_prob[step] = log_probs
+
+    return {
+            "chain":           chain,
+            "log_prob":        chain_log_prob,
+            "parameter_names": get_parameter_names(model_fit.model_name, outliers),
+            "acceptance":      naccepted/nsteps,
+            }
+
+def run_sampler_on_serialized(serialized_model, phases, pulses, driftbands, **kwargs):
+    # (For running in other processes, which are sent the model fit serialized)
+    model_fit = drift_analysis.ModelFit()
+    model_fit.unserialize(serialized_model)
+    return run_sampler(model_fit, phases, pulses, driftbands, **kwargs)
+
+def sample_model_fits(problems, nprocesses=None, seed=None, **kwargs):
+    '''
+    Run the sampler (see run_sampler()) on several model fits, one per process (unless
+    nprocesses is 1). problems is a list of (model_fit, phases, pulses, driftbands), e.g.
+    from DriftAnalysis.get_resampling_problems(). Other keyword arguments are passed on to
+    run_sampler(). Returns a list of results, one per problem.
+    '''
+    seeds = np.random.SeedSequence(seed).spawn(len(problems))
+
+    if nprocesses == 1:
+        return [run_sampler(model_fit, phases, pulses, driftbands, seed=np.random.default_rng(s), **kwargs)
+                for (model_fit, phases, pulses, driftbands), s in zip(problems, seeds)]
+
+    with ProcessPoolExecutor(max_workers=nprocesses) as executor:
+        futures = [executor.submit(run_sampler_on_serialized, model_fit.serialize(), phases, pulses, driftbands,
+            seed=np.random.default_rng(s), **kwargs) for (model_fit, phases, pulses, driftbands), s in zip(problems, seeds)]
+        return [future.result() for future in futures]
+
+def get_chain_key(model_fit):
+    # The name of a model fit's chain in the npz file, which (unlike the sequence
+    # number) doesn't change when other drift sequences are added or removed
+    return "chain_{}_{}".format(int(model_fit.first_pulse), int(model_fit.last_pulse))
+
+def save_chains(chains_file, model_fits, results, nburn=0):
+    '''
+    Add the chains of the given model fits to chains_file (any other chains already in
+    it are kept), and link each model fit to its chain (see ModelFit.mcmc), together with
+    a summary of the posterior (medians and 68% intervals, after discarding the first
+    nburn steps).
+    '''
+    arrays = {}
+    if os.path.exists(chains_file):
+        with np.load(chains_file) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+
+    for model_fit, result in zip(model_fits, results):
+        key = get_chain_key(model_fit)
+        arrays[key] = result["chain"].astype(np.float32)
+        arrays[key + "_log_prob"] = result["log_prob"].astype(np.float32)
+
+        samples = result["chain"][nburn:].reshape(-1, result["chain"].shape[-1])
+        lower, median, upper = np.percentile(samples, [16, 50, 84], axis=0)
+
+        model_fit.mcmc = {
+                "file":            chains_file,
+                "key":             key,
+                "model_name":      model_fit.model_name,
+                "parameter_names": result["parameter_names"],
+                "nwalkers":        int(result["chain"].shape[1]),
+                "nsteps":          int(result["chain"].shape[0]),
+                "nburn":           int(nburn),
+                "acceptance":      float(np.mean(result["acceptance"])),
+                "median":          [float(x) for x in median],
+                "lower":           [float(x) for x in lower],
+                "upper":           [float(x) for x in upper],
+                }
+
+    # Write to a temporary file first, so that a crash doesn't lose the existing chains
+    # (np.savez adds .npz to any filename that doesn't already end with it)
+    tmp_file = chains_file + ".tmp.npz"
+    np.savez_compressed(tmp_file, **arrays)
+    os.replace(tmp_file, chains_file)
+
+def load_chain(model_fit, discard_burn=True, flat=False):
+    '''
+    Returns the chain linked to a model fit (see save_chains()), optionally without its
+    burn-in steps, and optionally flattened to (nsamples x ndim)
+    '''
+    if model_fit.mcmc is None:
+        raise ValueError("This model fit has no MCMC chain")
+
+    with np.load(model_fit.mcmc["file"]) as npz:
+        chain = npz[model_fit.mcmc["key"]]
+
+    # Account for any shift in phase since the chain was saved (see ModelFit.shift_phase())
+    if model_fit.mcmc.get("phase_offset", 0.0) != 0.0:
+        chain = chain.copy()
+        chain[...,model_fit.get_phase_parameter_idx()] += model_fit.mcmc["phase_offset"]
+
+    if discard_burn == True:
+        chain = chain[model_fit.mcmc["nburn"]:]
+    if flat == True:
+        chain = chain.reshape(-1, chain.shape[-1])
+
+    return chain
+
+def get_posterior_samples(model_fit, parameter_name):
+    '''
+    All the (post burn-in) samples of the named parameter of a model fit's chain.
+    "P2" can be asked for whatever the model calls it, since it is always the model's
+    last parameter (e.g. for comparing the P2s of different drift modes).
+    '''
+    names = model_fit.mcmc["parameter_names"]
+    if parameter_name == "P2" and "P2" not in names:
+        idx = names.index("log_sigma") - 1
+    else:
+        idx = names.index(parameter_name)
+    return load_chain(model_fit, flat=True)[:,idx]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print(__doc__)
+        sys.exit()
+
+    nsteps   = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    outliers = len(sys.argv) > 3 and sys.argv[3] == "outliers"
+
+    session = drift_analysis.DriftAnalysis()
+    session.load_json(sys.argv[1])
+    session.sample_model_fits(chains_file=sys.argv[1] + ".chains.npz", nsteps=nsteps, outliers=outliers)
+
+    for seq in sorted(session.model_fits.keys()):
+        if session.model_fits[seq].mcmc is not None:
+            print("Sequence {}:\n{}".format(seq, session.model_fits[seq]))
+
+    session.save_json(sys.argv[1])
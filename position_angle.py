@@ -0,0 +1,375 @@
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.optimize import least_squares
+
+import pulsestack
+
+def read_pdv_rms(pdvfile):
+    '''
+    Returns the RMS given in the header line of a pdv file, or None if there isn't one
+    '''
+    with open(pdvfile, "r") as f:
+        header = f.readline().split()
+
+    if "RMS:" in header:
+        return float(header[header.index("RMS:") + 1])
+    return None
+
+def weighted_linear_fit(x, y, yerr):
+    '''
+    Weighted least squares fit of y = intercept + slope*x.
+    x, y, yerr can have any number of leading dimensions, in which case each
+    row (i.e. last axis) is fitted independently, all at once.
+    Returns intercept, slope, and their (formal) uncertainties.
+    '''
+    w = 1/yerr**2
+
+    S   = np.sum(w, axis=-1)
+    Sx  = np.sum(w*x, axis=-1)
+    Sy  = np.sum(w*y, axis=-1)
+    Sxx = np.sum(w*x*x, axis=-1)
+    Sxy = np.sum(w*x*y, axis=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta     = S*Sxx - Sx**2
+        slope     = (S*Sxy - Sx*Sy)/delta
+        intercept = (Sxx*Sy - Sx*Sxy)/delta
+
+        slope_err     = np.sqrt(S/delta)
+        intercept_err = np.sqrt(Sxx/delta)
+
+    return intercept, slope, intercept_err, slope_err
+
+class PAProfile:
+    '''
+    A (time- and frequency-scrunched) polarisation profile, as printed by "pdv -tKTFZ",
+    i.e. with Stokes IQUV as well as the position angle (PA) and its uncertainty
+    '''
+    def __init__(self, pdvfile=None):
+        self.pdvfile = None
+        self.nbins   = None
+        self.rms     = None
+        self.stokes  = None
+
+        if pdvfile is not None:
+            self.load_from_pdv(pdvfile)
+
+    def load_from_pdv(self, pdvfile):
+        self.pdvfile = pdvfile
+
+        cube = pulsestack.load_stokes_cube(pdvfile, cache=False)
+        if not cube.has_stokes("PAerr"):
+            raise IndexError("{} does not contain PA columns (use pdv -Z)".format(pdvfile))
+
+        # Only the first subintegration is used (the profile should be time-scrunched anyway)
+        self.stokes = {name: np.array(cube.get(name)[0], dtype=float) for name in cube.names}
+        self.stokes["L"] = np.hypot(self.stokes["Q"], self.stokes["U"])
+        self.nbins = len(self.stokes["I"])
+
+        # Use the RMS that pdv reports if possible. Otherwise, estimate it robustly
+        # (from the median absolute deviation) from Stokes Q and U
+        self.rms = read_pdv_rms(pdvfile)
+        if self.rms is None:
+            QU = np.concatenate([self.stokes["Q"], self.stokes["U"]])
+            self.rms = 1.4826*np.median(np.abs(QU - np.median(QU)))
+
+    def get_phases(self):
+        # The phase of each bin, in degrees
+        return np.arange(self.nbins)*360/self.nbins
+
+    def select_bins(self, threshold=4.0, phase_range=None):
+        '''
+        Returns a mask of the bins whose linear polarisation is at least threshold
+        times the RMS, and which have a (non-zero) PA uncertainty.
+        phase_range (deg) can optionally restrict the selection further.
+        '''
+        selected = np.logical_and(self.stokes["L"] >= threshold*self.rms, self.stokes["PAerr"] > 0)
+
+        if phase_range is not None:
+            ph = self.get_phases()
+            selected = np.logical_and(selected, np.logical_and(ph >= phase_range[0], ph <= phase_range[1]))
+
+        return selected
+
+    def fit_slope(self, threshold=4.0, phase_range=None, nbootstrap=10000, bootstrap="parametric", seed=None):
+        '''
+        Fit a straight line to the PA of the selected bins (see select_bins()) by
+        weighted least squares, and estimate the uncertainty of the slope by bootstrapping.
+        bootstrap can be "parametric" (resample each PA from its own uncertainty) or
+        "pairs" (resample the bins with replacement).
+        All bootstrap fits are done in one batched operation.
+        Returns a dictionary of results. Slopes are in deg/deg.
+        '''
+        selected = self.select_bins(threshold=threshold, phase_range=phase_range)
+        bins = np.flatnonzero(selected)
+        if len(bins) < 2:
+            print("Only {} bins of {} pass the selection. No PA slope fitted".format(len(bins), self.pdvfile))
+            return None
+
+        ph    = self.get_phases()[bins]
+        PA    = np.unwrap(self.stokes["PA"][bins], period=180) # PA is only defined modulo 180 deg
+        PAerr = self.stokes["PAerr"][bins]
+
+        intercept, slope, intercept_err, slope_err = weighted_linear_fit(ph, PA, PAerr)
+
+        rng = np.random.default_rng(seed)
+        if bootstrap == "parametric":
+            PA_resampled = PA + PAerr*rng.standard_normal((nbootstrap, len(bins)))
+            _, slopes, _, _ = weighted_linear_fit(ph, PA_resampled, PAerr)
+        elif bootstrap == "pairs":
+            idxs = rng.integers(len(bins), size=(nbootstrap, len(bins)))
+            _, slopes, _, _ = weighted_linear_fit(ph[idxs], PA[idxs], PAerr[idxs])
+        else:
+            raise ValueError("Unrecognised bootstrap method '{}'".format(bootstrap))
+
+        # (Pairs resampling can pick the same bin every time, which can't be fitted)
+        slopes = slopes[np.isfinite(slopes)]
+
+        return {
+                "pdvfile":             self.pdvfile,
+                "bins":                bins,
+                "slope":               slope,
+                "slope_err":           slope_err,
+                "intercept":           intercept,
+                "intercept_err":       intercept_err,
+                "bootstrap_slope_err": np.std(slopes),
+                "bootstrap_interval":  np.percentile(slopes, [16, 84]),
+                }
+
+def fit_pa_slope(pdvfile, **kwargs):
+    '''
+    Load a pdv file and fit its PA slope (see PAProfile.fit_slope())
+    '''
+    return PAProfile(pdvfile).fit_slope(**kwargs)
+
+def fit_pa_slopes(pdvfiles, nprocesses=None, **kwargs):
+    '''
+    Fit the PA slopes of many pdv files in parallel (see PAProfile.fit_slope()).
+    Returns a list of results in the same order as pdvfiles.
+    '''
+    with ProcessPoolExecutor(max_workers=nprocesses) as executor:
+        futures = [executor.submit(fit_pa_slope, pdvfile, **kwargs) for pdvfile in pdvfiles]
+        return [future.result() for future in futures]
+
+def rvm_pa(phase, alpha, beta, phi0, psi0):
+    '''
+    The position angle predicted by the rotating vector model (RVM), i.e.
+
+      tan(PA - psi0) = sin(alpha) sin(phase - phi0) / (sin(zeta) cos(alpha) - cos(zeta) sin(alpha) cos(phase - phi0))
+
+    where zeta = alpha + beta. All angles are in radians. The arguments broadcast
+    against each other, so that many sets of parameters can be evaluated at once.
+    The returned PA is not wrapped to any particular range.
+    '''
+    zeta = alpha + beta
+    dphi = phase - phi0
+    num  = np.sin(alpha)*np.sin(dphi)
+    den  = np.sin(zeta)*np.cos(alpha) - np.cos(zeta)*np.sin(alpha)*np.cos(dphi)
+    return psi0 + np.arctan2(num, den)
+
+def wrap_pa(PA):
+    # Wrap angles (radians) into the range [-pi/2, pi/2), since PAs are only defined modulo 180 deg
+    return (PA + np.pi/2) % np.pi - np.pi/2
+
+def get_pa_stack(ps, threshold=4.0, sigma=None):
+    '''
+    Returns the PA and its uncertainty (both in radians, shape npulses x nbins) for every
+    bin of a Pulsestack, computed from its Stokes Q and U (see Pulsestack.get_stokes()).
+    Bins whose linear polarisation is below threshold times the noise have their
+    uncertainty set to inf, so that they carry no weight in the RVM fits.
+
+    sigma is the noise level in Q and U. If not given, it is estimated for each pulse
+    separately from the off-pulse bins (if ps.onpulse is set) or else robustly (from the
+    median absolute deviation) from all bins.
+    '''
+    Q = np.array(ps.get_stokes("Q"), dtype=float)
+    U = np.array(ps.get_stokes("U"), dtype=float)
+    L = np.hypot(Q, U)
+
+    if sigma is None:
+        QU = np.concatenate([Q, U], axis=1)
+        if ps.onpulse is not None:
+            ph = np.tile(ps.get_phases_array(), 2)
+            offpulse = np.logical_or(ph < ps.onpulse[0], ph > ps.onpulse[1])
+            sigma = np.std(QU[:,offpulse], axis=1)
+        else:
+            sigma = 1.4826*np.median(np.abs(QU - np.median(QU, axis=1, keepdims=True)), axis=1)
+        sigma = sigma[:,np.newaxis]
+
+    PA = 0.5*np.arctan2(U, Q)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        PAerr = sigma/(2*L)
+    PAerr[~(L >= threshold*sigma)] = np.inf
+
+    return PA, PAerr
+
+def rvm_grid(alphas_deg=None, betas_deg=None, phi0s_deg=None):
+    '''
+    Returns a (ngrid x 3) array of (alpha, beta, phi0) grid points, in radians.
+    Defaults: alpha from 5 to 175 deg in steps of 5 deg, beta from -30 to 30 deg
+    in steps of 2 deg, and phi0 from -180 to 180 deg in steps of 5 deg.
+    '''
+    if alphas_deg is None:
+        alphas_deg = np.arange(5, 180, 5)
+    if betas_deg is None:
+        betas_deg = np.arange(-30, 31, 2)
+    if phi0s_deg is None:
+        phi0s_deg = np.arange(-180, 180, 5)
+
+    grid = np.meshgrid(alphas_deg, betas_deg, phi0s_deg, indexing='ij')
+    return np.deg2rad(np.stack([g.ravel() for g in grid], axis=1))
+
+def grid_search_rvm(phases_deg, PA, PAerr, grid, block_size=2048):
+    '''
+    Find the best (alpha, beta, phi0) grid point for each row (pulse) of PA/PAerr
+    (radians, shape npulses x nbins; phases_deg has length nbins) at the same time.
+
+    For any (alpha, beta, phi0), the best psi0 and the chi-squared (to second order
+    in the residuals, which are taken modulo 180 deg) both follow from the complex sum
+
+      C = sum_bins w exp(2i(PA - RVM)),   w = 1/PAerr^2
+
+    namely psi0 = arg(C)/2 and chi^2 = (sum(w) - |C|)/2. For all pulses and a whole
+    block of grid points at once, this is a single matrix product.
+
+    Returns an (npulses x 4) array of (alpha, beta, phi0, psi0) and the chi-squared of each.
+    '''
+    phases = np.deg2rad(phases_deg)
+    w = 1/PAerr**2
+    A = w*np.exp(2j*PA)
+    W = np.sum(w, axis=1)
+
+    npulses = PA.shape[0]
+    best_chi2 = np.full(npulses, np.inf)
+    best_params = np.full((npulses, 4), np.nan)
+
+    for start in range(0, len(grid), block_size):
+        g = grid[start:start+block_size]
+        model = rvm_pa(phases[np.newaxis,:], g[:,0:1], g[:,1:2], g[:,2:3], 0)
+        C = A @ np.exp(-2j*model).T # npulses x (grid block)
+        chi2 = 0.5*(W[:,np.newaxis] - np.abs(C))
+
+        best_in_block = np.argmin(chi2, axis=1)
+        chi2_in_block = chi2[np.arange(npulses), best_in_block]
+        better = chi2_in_block < best_chi2
+
+        best_chi2[better] = chi2_in_block[better]
+        best_params[better,:3] = g[best_in_block[better]]
+        best_params[better,3] = 0.5*np.angle(C[better, best_in_block[better]])
+
+    return best_params, best_chi2
+
+def rvm_residuals(params, phases, PA, PAerr):
+    # Residuals (wrapped into +-90 deg) in units of the PA uncertainties
+    return wrap_pa(PA - rvm_pa(phases, *params))/PAerr
+
+def refine_rvm_fit(phases_deg, PA, PAerr, p0):
+    '''
+    Refine a single RVM fit (e.g. from grid_search_rvm()) by non-linear least squares.
+    Only bins with a finite PAerr are used.
+    Returns the parameters (alpha, beta, phi0, psi0), their covariance matrix (both
+    in radians), and the chi-squared.
+    '''
+    used = np.isfinite(PAerr)
+    phases = np.deg2rad(phases_deg)[used]
+
+    res = least_squares(rvm_residuals, p0, args=(phases, PA[used], PAerr[used]))
+
+    try:
+        pcov = np.linalg.inv(res.jac.T @ res.jac)
+    except np.linalg.LinAlgError:
+        pcov = np.full((4, 4), np.nan)
+
+    return res.x, pcov, 2*res.cost
+
+def fit_rvm_chunk(phases_deg, PA, PAerr, grid, min_bins=5):
+    '''
+    Grid search and refine the RVM fits of a number of pulses (rows of PA, PAerr).
+    This is the unit of work that fit_rvm() hands to each process.
+    '''
+    npulses = PA.shape[0]
+    params = np.full((npulses, 4), np.nan)
+    pcovs  = np.full((npulses, 4, 4), np.nan)
+    chi2s  = np.full(npulses, np.nan)
+    nbins  = np.sum(np.isfinite(PAerr), axis=1)
+
+    # Fits with fewer usable bins than this are too poorly constrained to be worth doing
+    fittable = nbins >= min_bins
+    if not np.any(fittable):
+        return params, pcovs, chi2s, nbins
+
+    p0, _ = grid_search_rvm(phases_deg, PA[fittable], PAerr[fittable], grid)
+
+    for i, p in zip(np.flatnonzero(fittable), p0):
+        params[i], pcovs[i], chi2s[i] = refine_rvm_fit(phases_deg, PA[i], PAerr[i], p)
+
+    return params, pcovs, chi2s, nbins
+
+def fit_rvm(phases_deg, PA, PAerr, grid=None, min_bins=5, nprocesses=None, pulses_per_chunk=200):
+    '''
+    Fit the RVM independently to every row (pulse) of PA/PAerr (radians, npulses x nbins,
+    e.g. from get_pa_stack()), first on a grid (see rvm_grid() and grid_search_rvm()), and
+    then refining each one locally. Chunks of pulses are fitted in parallel in separate
+    processes (unless nprocesses is 1).
+
+    Per-mode (or any other averaged) PA swings can be fitted in the same way by passing
+    the PAs of the averaged Q and U.
+
+    Returns a dictionary of arrays, one value per pulse. Angles are in degrees, and pulses
+    that could not be fitted (fewer than min_bins usable bins) have NaNs.
+    '''
+    if grid is None:
+        grid = rvm_grid()
+
+    chunks = [slice(start, start + pulses_per_chunk) for start in range(0, PA.shape[0], pulses_per_chunk)]
+
+    if nprocesses == 1:
+        results = [fit_rvm_chunk(phases_deg, PA[chunk], PAerr[chunk], grid, min_bins) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=nprocesses) as executor:
+            futures = [executor.submit(fit_rvm_chunk, phases_deg, PA[chunk], PAerr[chunk], grid, min_bins) for chunk in chunks]
+            results = [future.result() for future in futures]
+
+    params = np.concatenate([r[0] for r in results])
+    pcovs  = np.concatenate([r[1] for r in results])
+    chi2s  = np.concatenate([r[2] for r in results])
+    nbins  = np.concatenate([r[3] for r in results])
+
+    # psi0 is only defined modulo 180 deg
+    params[:,3] = wrap_pa(params[:,3])
+    params = np.rad2deg(params)
+    errs = np.rad2deg(np.sqrt(np.diagonal(pcovs, axis1=1, axis2=2)))
+
+    return {
+            "alpha":     params[:,0],
+            "beta":      params[:,1],
+            "phi0":      params[:,2],
+            "psi0":      params[:,3],
+            "alpha_err": errs[:,0],
+            "beta_err":  errs[:,1],
+            "phi0_err":  errs[:,2],
+            "psi0_err":  errs[:,3],
+            "pcov":      pcovs,
+            "chi2":      chi2s,
+            "nbins":     nbins,
+            }
+
+def fit_rvm_to_pulsestack(ps, threshold=4.0, **kwargs):
+    '''
+    Fit the RVM to every pulse of a Pulsestack loaded from a pdv file with polarisation
+    data (see get_pa_stack() and fit_rvm())
+    '''
+    PA, PAerr = get_pa_stack(ps, threshold=threshold)
+    return fit_rvm(ps.get_phases_array(), PA, PAerr, **kwargs)
+
+if __name__ == '__main__':
+    # Fit the PA slopes of all the pdv files given on the command line
+    results = fit_pa_slopes(sys.argv[1:])
+    for result in results:
+        if result is None:
+            continue
+        print("{}: bins {}, slope = {:.2f} +- {:.2f} °/° (bootstrap 68% interval: {:.2f} - {:.2f})".format(
+            result["pdvfile"], result["bins"].tolist(), result["slope"], result["bootstrap_slope_err"], *result["bootstrap_interval"]))
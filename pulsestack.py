@@ -1,8 +1,443 @@
+import os
 import copy
+import itertools
+import threading
+import collections
 import numpy as np
 import matplotlib.pyplot as plt
+import scipy.fft
 from scipy.ndimage import gaussian_filter1d
 
+import smoothing
+
+# Every change to any pulsestack's values gets a new (globally unique) version number
+value_versions = itertools.count()
+
+# Default memory budget for cached smoothed pulsestacks (bytes)
+DEFAULT_SMOOTHING_CACHE_BYTES = 256*1024**2
+
+class SmoothingCache:
+    '''
+    A least-recently-used cache of smoothed pulsestack values, keyed by
+    (sigma, version of the unsmoothed values), and capped at max_bytes
+    '''
+    def __init__(self, max_bytes=DEFAULT_SMOOTHING_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries   = collections.OrderedDict()
+        self.lock      = threading.Lock()
+
+    def get_nbytes(self):
+        return sum([values.nbytes for values in self.entries.values()])
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, values):
+        # Cached values are shared by everything that asks for them, so protect
+        # them from being changed in place
+        values.flags.writeable = False
+
+        with self.lock:
+            self.entries[key] = values
+            self.entries.move_to_end(key)
+
+            # Evict the least recently used entries (but always keep the newest one)
+            nbytes = self.get_nbytes()
+            while nbytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# The names of the data columns in pdv output (after the subint, channel, and bin columns),
+# depending on how many there are: total intensity only, full Stokes, or full Stokes
+# plus position angle (pdv -Z)
+PDV_COLUMN_NAMES = {1: ["I"], 4: ["I", "Q", "U", "V"], 6: ["I", "Q", "U", "V", "PA", "PAerr"]}
+
+# Everything that can be selected as the "Stokes" of a pulsestack. L (linear
+# polarisation) and PA (position angle, deg) are calculated from Q and U (unless
+# the pdv file already provides PA).
+STOKES_VIEWS = ["I", "Q", "U", "V", "L", "PA"]
+
+def load_stokes_cube(pdvfile, cache=True, keep_channels=False):
+    '''
+    Read all the polarisation columns of a pdv file into a StokesCube.
+    Unless keep_channels is True, the data are frequency scrunched as they are read.
+    If cache is True, the columns are also written to <pdvfile>.stokes.npy (or
+    <pdvfile>.channels.npy if keeping channels), which is memory-mapped instead of
+    re-parsing the pdv file next time (as long as it is newer than the pdv file).
+    '''
+    if keep_channels == True:
+        cachefile = pdvfile + ".channels.npy"
+    else:
+        cachefile = pdvfile + ".stokes.npy"
+
+    if cache and os.path.exists(cachefile) and os.path.getmtime(cachefile) >= os.path.getmtime(pdvfile):
+        columns = np.load(cachefile, mmap_mode='r')
+        return StokesCube(columns, PDV_COLUMN_NAMES[columns.shape[0]])
+
+    dat = np.loadtxt(pdvfile, dtype=np.float32)
+
+    # Figure out from the first few columns what the dimensions of the pulsestack are
+    npulses = int(dat[-1,0] + 1)
+    nfreqs  = int(dat[-1,1] + 1)
+    nbins   = int(dat[-1,2] + 1)
+
+    ncolumns = dat.shape[1] - 3
+    if ncolumns not in PDV_COLUMN_NAMES.keys():
+        raise IndexError("Could not make sense of the {} data columns in {}".format(ncolumns, pdvfile))
+
+    # Reshape into (column, pulse, freq, bin), and frequency scrunch if requested
+    columns = np.reshape(dat[:,3:].T, (ncolumns, npulses, nfreqs, nbins))
+    if keep_channels == True:
+        columns = np.ascontiguousarray(columns)
+    else:
+        columns = np.mean(columns, axis=2, dtype=np.float64).astype(np.float32)
+
+    if cache:
+        try:
+            np.save(cachefile, columns)
+        except OSError as err:
+            print("Could not cache Stokes data:", err)
+
+    return StokesCube(columns, PDV_COLUMN_NAMES[ncolumns])
+
+def channel_group_weights(groups, nfreqs):
+    '''
+    Returns an (ngroups, nfreqs) matrix that averages frequency channels into groups
+    (sub-bands). groups can be either an integer (split the band into that many
+    contiguous, nearly equal sub-bands) or a list of groups, each of which is a list
+    (or array, or slice) of channel indices. Groups don't have to be contiguous, and
+    may overlap.
+    '''
+    if np.isscalar(groups):
+        groups = np.array_split(np.arange(nfreqs), groups)
+
+    weights = np.zeros((len(groups), nfreqs), dtype=np.float32)
+    for g in range(len(groups)):
+        weights[g, groups[g]] = 1
+
+    nchans = np.sum(weights, axis=1, keepdims=True)
+    if np.any(nchans == 0):
+        raise ValueError("Every channel group must contain at least one channel")
+
+    return weights/nchans
+
+class StokesCube:
+    '''
+    All the polarisation data of a pulsestack, stored compactly as a single
+    (ncolumns, npulses, nbins) float32 (or memory-mapped) array, or, if the
+    frequency channels are kept, (ncolumns, npulses, nfreqs, nbins).
+    Frequency scrunching, linear polarisation and position angle are only
+    calculated when first asked for.
+    '''
+    def __init__(self, columns, names):
+        self.columns = columns
+        self.names   = names
+        self.derived = {}
+
+    def has_channels(self):
+        return self.columns.ndim == 4
+
+    def get_nfreqs(self):
+        if self.has_channels():
+            return self.columns.shape[2]
+        return 1
+
+    def get_shape(self):
+        # (npulses, nbins)
+        return self.columns.shape[1], self.columns.shape[-1]
+
+    def has_stokes(self, stokes):
+        if stokes in self.names:
+            return True
+        if stokes in ["L", "PA"]:
+            return "Q" in self.names and "U" in self.names
+        return False
+
+    def get(self, stokes):
+        '''
+        Returns a (frequency scrunched) (npulses, nbins) array for the given Stokes (one of STOKES_VIEWS)
+        '''
+        if stokes in self.names and not self.has_channels():
+            return self.columns[self.names.index(stokes)]
+
+        if not self.has_stokes(stokes):
+            raise IndexError("Stokes {} is not available (only {})".format(stokes, ", ".join(self.names)))
+
+        if stokes not in self.derived.keys():
+            if stokes in self.names:
+                self.derived[stokes] = np.mean(self.columns[self.names.index(stokes)], axis=1, dtype=np.float64).astype(np.float32)
+            else:
+                self.derived[stokes] = linear_polarisation(self.get("Q"), self.get("U"), stokes)
+
+        return self.derived[stokes]
+
+    def get_subbands(self, stokes, groups, pulse_slice=slice(None), bin_slice=slice(None)):
+        '''
+        Returns an (ngroups, npulses, nbins) array of the given Stokes averaged over each group
+        of channels (see channel_group_weights()), all in one operation.
+        pulse_slice and bin_slice select part of the cube before averaging.
+        '''
+        if not self.has_channels():
+            raise IndexError("The frequency channels have not been kept")
+
+        if not self.has_stokes(stokes):
+            raise IndexError("Stokes {} is not available (only {})".format(stokes, ", ".join(self.names)))
+
+        if stokes not in self.names:
+            Q = self.get_subbands("Q", groups, pulse_slice, bin_slice)
+            U = self.get_subbands("U", groups, pulse_slice, bin_slice)
+            return linear_polarisation(Q, U, stokes)
+
+        weights  = channel_group_weights(groups, self.get_nfreqs())
+        channels = self.columns[self.names.index(stokes)][pulse_slice,:,bin_slice] # (npulses, nfreqs, nbins)
+        return np.tensordot(weights, channels, axes=([1], [1]))
+
+def linear_polarisation(Q, U, stokes):
+    # Returns either L or PA (deg), calculated from Q and U
+    if stokes == "L":
+        return np.hypot(Q, U)
+    elif stokes == "PA":
+        return 0.5*np.rad2deg(np.arctan2(U, Q))
+    else:
+        raise ValueError("Unrecognised linear polarisation quantity {}".format(stokes))
+
+def fft_window(window, n):
+    # Returns the named window function (or no window, if window is None) with n points
+    if window is None:
+        return np.ones(n)
+    elif window == "hann":
+        return np.hanning(n)
+    elif window == "hamming":
+        return np.hamming(n)
+    elif window == "blackman":
+        return np.blackman(n)
+    else:
+        raise ValueError("Unrecognised window '{}'".format(window))
+
+def tdfs_spectrum(values, pad_factor=1, window=None, padded_shape=None):
+    '''
+    Returns the two-dimensional fluctuation spectrum of values, whose last two axes are
+    (pulses, phase bins), so that a whole batch of pulsestacks can be done at once.
+    The average profile is subtracted first, then both axes are windowed (see fft_window())
+    and zero-padded to pad_factor times their length (or to padded_shape = (npulses, nbins),
+    if given, so that spectra of different lengths can be compared). The result has the P3 (cycles per
+    period) axis first, without its zero frequency (as in the LRFS), and the P2 axis
+    shifted so that zero frequency is in the middle.
+    '''
+    npulses, nbins = values.shape[-2:]
+    weights = (fft_window(window, npulses)[:,np.newaxis] * fft_window(window, nbins)[np.newaxis,:]).astype(values.dtype)
+    fluctuations = (values - np.mean(values, axis=-2, keepdims=True))*weights
+
+    if padded_shape is None:
+        padded_shape = (pad_factor*npulses, pad_factor*nbins)
+
+    # A real FFT along the pulses, and a complex one along the phase bins (in single
+    # precision if the values are, using all available cores)
+    spectrum = scipy.fft.rfft2(fluctuations, s=(padded_shape[1], padded_shape[0]), axes=(-1, -2), workers=-1)
+    return np.fft.fftshift(spectrum[...,1:,:], axes=-1)
+
+def find_spectrum_peak(power, exclude_column=None):
+    '''
+    Finds the maximum of power, whose last two axes are (rows, columns), for every
+    spectrum in a batch. The position of each maximum is refined to a fraction of a bin
+    by fitting a parabola through it and its neighbours along each axis.
+    Returns the (fractional) row and column indexes and the power at each maximum.
+    exclude_column, if given, is a column that is left out of the search (e.g. zero frequency).
+    '''
+    nrows, ncols = power.shape[-2:]
+    batch_shape = power.shape[:-2]
+    power = power.reshape(-1, nrows, ncols)
+    if exclude_column is not None:
+        power = power.copy()
+        power[:,:,exclude_column] = -np.inf
+
+    batch = np.arange(power.shape[0])
+    rows, cols = np.divmod(np.argmax(power.reshape(power.shape[0], -1), axis=1), ncols)
+    peak = power[batch, rows, cols]
+
+    def parabolic_offset(below, above):
+        # The offset of the vertex of the parabola through (-1, below), (0, peak), (1, above).
+        # Neighbours off the edge (or excluded) leave the peak where it is
+        curvature = below - 2*peak + above
+        with np.errstate(invalid='ignore', divide='ignore'):
+            offset = 0.5*(below - above)/curvature
+        return np.where(np.logical_and(np.isfinite(offset), curvature < 0), offset, 0.0)
+
+    row_offsets = parabolic_offset(power[batch, np.maximum(rows - 1, 0), cols], power[batch, np.minimum(rows + 1, nrows - 1), cols])
+    col_offsets = parabolic_offset(power[batch, rows, np.maximum(cols - 1, 0)], power[batch, rows, np.minimum(cols + 1, ncols - 1)])
+    row_offsets[np.logical_or(rows == 0, rows == nrows - 1)] = 0
+    col_offsets[np.logical_or(cols == 0, cols == ncols - 1)] = 0
+
+    return (rows + row_offsets).reshape(batch_shape), (cols + col_offsets).reshape(batch_shape), peak.reshape(batch_shape)
+
+def get_index_positions(index, values, step):
+    '''
+    The (fractional) positions of values within index, an increasing array (e.g. of
+    the pulse numbers of the rows of a pulsestack with gaps), found by binary search.
+    Between two elements of index, positions are interpolated linearly (so a value in
+    a gap lies between the rows either side of it). Beyond either end, they carry on
+    at one position per step.
+    '''
+    values = np.asarray(values, dtype=float)
+    if len(index) < 2:
+        return (values - index[0])/step
+
+    i = np.clip(np.searchsorted(index, values, side='right') - 1, 0, len(index) - 2)
+    positions = i + (values - index[i])/(index[i+1] - index[i])
+    positions = np.where(values < index[0], (values - index[0])/step, positions)
+    positions = np.where(values > index[-1], len(index) - 1 + (values - index[-1])/step, positions)
+    return positions[()] # (a scalar, if values was)
+
+def get_index_values(index, positions, step):
+    # The inverse of get_index_positions()
+    positions = np.asarray(positions, dtype=float)
+    if len(index) < 2:
+        return index[0] + positions*step
+
+    i = np.clip(np.floor(positions).astype(int), 0, len(index) - 2)
+    values = index[i] + (positions - i)*(index[i+1] - index[i])
+    values = np.where(positions < 0, index[0] + positions*step, values)
+    values = np.where(positions > len(index) - 1, index[-1] + (positions - (len(index) - 1))*step, values)
+    return values[()]
+
+def lomb_scargle_spectrum(times, values, freqs, samples_per_block=2**24, progress=None):
+    '''
+    The spectrum of values (whose second last axis is sampled at the given, possibly
+    uneven, times) at the given frequencies (all > 0, in cycles per unit of time), by the
+    Lomb-Scargle method, with all the series along the other axes done at once. Each
+    series' mean is subtracted first.
+
+    The result is complex, like an FFT along that axis: its power is the Lomb-Scargle
+    periodogram (times the number of samples), and its phase is relative to time zero,
+    so for evenly sampled values at the FFT's frequencies, it is the same as the FFT.
+    The frequencies are done a block at a time, so that the cosines and sines of at most
+    samples_per_block (frequency, time) pairs are held at once, and progress (if given) is
+    called with the fraction done after each block.
+    '''
+    times  = np.asarray(times, dtype=float)
+    values = np.asarray(values)
+    values = values - np.mean(values, axis=-2, keepdims=True)
+    nsamples = len(times)
+
+    spectrum = np.empty(values.shape[:-2] + (len(freqs),) + values.shape[-1:], dtype=complex)
+    freqs_per_block = max(1, samples_per_block//nsamples)
+    for start in range(0, len(freqs), freqs_per_block):
+        omega = 2*np.pi*np.asarray(freqs[start:start+freqs_per_block], dtype=float)[:,np.newaxis]
+
+        # The time offset that makes the sines and cosines orthogonal
+        tau = np.arctan2(np.sum(np.sin(2*omega*times), axis=1), np.sum(np.cos(2*omega*times), axis=1))[:,np.newaxis]/(2*omega)
+        C = np.cos(omega*(times - tau))
+        S = np.sin(omega*(times - tau))
+        CC = np.sum(C**2, axis=1)[:,np.newaxis]
+        SS = np.sum(S**2, axis=1)[:,np.newaxis]
+
+        # (At the Nyquist frequency of evenly sampled values, the sines are all zero, and
+        # the cosines are all +-1, so there is nothing to rescale)
+        has_sines = SS > 1e-9*CC
+        scale_C = np.where(has_sines, np.sqrt(0.5*nsamples/CC), 1)
+        scale_S = np.where(has_sines, np.sqrt(0.5*nsamples/np.where(has_sines, SS, 1)), 0)
+
+        spectrum[...,start:start+len(omega),:] = np.exp(-1j*omega*tau)*(scale_C*np.matmul(C, values) - 1j*scale_S*np.matmul(S, values))
+
+        if progress is not None:
+            progress((start + len(omega))/len(freqs))
+
+    return spectrum
+
+def fit_gaussians(x, y, amplitudes, centres, widths, valid=None, niterations=20, tolerance=1e-4):
+    '''
+    Fit y = amplitude*exp(-(x - centre)**2/(2*width**2)) to every row of x and y
+    (nfits x npoints) at the same time, starting from the given amplitudes, centres and
+    widths (one per row). valid (if given) marks which points of each row to use.
+
+    Every row takes its own damped Gauss-Newton (Levenberg-Marquardt) steps, but the
+    3x3 normal equations of all the rows are formed and solved together as arrays,
+    so there is no loop over the fits, only over the iterations. Fits stop taking part
+    once their steps become small (less than the fraction tolerance of the amplitude and
+    width), or once they are hopeless (a negative amplitude, a centre beyond the row's
+    points, or a width wider than them all or narrower than a quarter of their spacing,
+    as when fitting noise), so the later iterations only do the few that are still
+    converging.
+
+    Returns the fitted amplitudes, centres and widths, and the sum of the squared
+    residuals of each fit.
+    '''
+    weights = np.ones(y.shape) if valid is None else valid.astype(float)
+    y = np.where(weights > 0, y, 0.0)
+    params = np.stack([amplitudes, centres, widths], axis=1).astype(float)
+
+    def calc_model(params, rows):
+        dx = x[rows] - params[:,1,np.newaxis]
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            gaussian = np.exp(-0.5*(dx/params[:,2,np.newaxis])**2)
+        return params[:,0,np.newaxis]*gaussian, gaussian, dx
+
+    def calc_cost(model, rows):
+        return np.sum(weights[rows]*(y[rows] - model)**2, axis=1)
+
+    xmin, xmax = np.min(x, axis=1), np.max(x, axis=1)
+    min_width = 0.25*(xmax - xmin)/max(x.shape[1] - 1, 1)
+
+    active = np.arange(len(params))
+    cost = calc_cost(calc_model(params, active)[0], active)
+    damping = np.full(len(params), 1e-3)
+
+    for iteration in range(niterations):
+        if len(active) == 0:
+            break
+
+        p = params[active]
+        model, gaussian, dx = calc_model(p, active)
+
+        # The columns of the Jacobian (with respect to amplitude, centre, and width),
+        # with the unused points zeroed
+        weighted_gaussian = weights[active]*gaussian
+        d_centre = weights[active]*model*dx/p[:,2,np.newaxis]**2
+        d_width  = d_centre*dx/p[:,2,np.newaxis]
+        columns  = [weighted_gaussian, d_centre, d_width]
+
+        residuals = y[active] - model
+        JTJ = np.empty((len(active), 3, 3))
+        for i in range(3):
+            for j in range(i, 3):
+                JTJ[:,i,j] = JTJ[:,j,i] = np.sum(columns[i]*columns[j], axis=1)
+        JTr = np.stack([np.sum(column*residuals, axis=1) for column in columns], axis=1)
+
+        # Levenberg-Marquardt damping, plus a little extra so that fits with no usable
+        # points (whose normal equations are all zero) don't stop the others from being solved
+        diagonal = np.diagonal(JTJ, axis1=1, axis2=2)
+        damped = JTJ + (damping[active,np.newaxis]*diagonal + 1e-12*(1 + diagonal))[...,np.newaxis]*np.eye(3)
+        steps = np.linalg.solve(damped, JTr[...,np.newaxis])[...,0]
+
+        # Only keep the steps that make the fit better (and keep the width positive)
+        new_params = p + steps
+        new_cost = calc_cost(calc_model(new_params, active)[0], active)
+        better = np.logical_and(new_cost < cost[active], new_params[:,2] > 0)
+        converged = np.logical_and.reduce([better, np.abs(steps[:,0]) <= tolerance*np.abs(p[:,0]),
+            np.abs(steps[:,1]) <= tolerance*p[:,2], np.abs(steps[:,2]) <= tolerance*p[:,2]])
+
+        params[active[better]] = new_params[better]
+        cost[active[better]]   = new_cost[better]
+        damping[active] = np.where(better, damping[active]*0.3, damping[active]*10)
+
+        # Fits whose steps no longer help, or which can't find a step that does, are done
+        converged = np.logical_or(converged, damping[active] > 1e10)
+        p = params[active]
+        hopeless = np.logical_or.reduce([p[:,0] <= 0, p[:,1] < xmin[active], p[:,1] > xmax[active],
+            p[:,2] > xmax[active] - xmin[active], p[:,2] < min_width[active]])
+        converged = np.logical_or(converged, hopeless)
+        active = active[~converged]
+
+    return params[:,0], params[:,1], params[:,2], cost
+
 class Pulsestack:
 
     def __init__(self):
@@ -19,6 +454,36 @@ class Pulsestack:
         self.xlabel      = None
         self.ylabel      = None
 
+        # All polarisations (see StokesCube), if they have been loaded, and where
+        # the (possibly cropped) values start within them
+        self.stokes_cube       = None
+        self.source_bin_offset = [0, 0]
+
+        # Several observations joined end to end (see concatenation.py), if this
+        # pulsestack was loaded from more than one pdv file
+        self.concatenation = None
+
+        # The pulse number of every row, if the pulses are not all consecutive (see
+        # set_pulse_numbers()). Otherwise (None), first_pulse and dpulse say it all.
+        self.pulse_numbers = None
+
+        self.values_changed()
+
+    def values_changed(self):
+        '''
+        Must be called whenever self.values is changed (but not when only the pulse/phase
+        geometry changes, e.g. when setting the fiducial phase), so that any cached
+        products of the old values are no longer used
+        '''
+        self.version = next(value_versions)
+
+        # Copies of this pulsestack may share the old cache, so start a new one
+        # rather than clearing it
+        if hasattr(self, "smoothing_cache"):
+            self.smoothing_cache = SmoothingCache(self.smoothing_cache.max_bytes)
+        else:
+            self.smoothing_cache = SmoothingCache()
+
     def serialize(self):
         serialized = {}
 
@@ -43,6 +508,9 @@ class Pulsestack:
         if self.dpulse is not None:
             serialized["dpulse"] = float(self.dpulse)
 
+        if self.pulse_numbers is not None:
+            serialized["pulse_numbers"] = self.pulse_numbers.tolist()
+
         if self.dphase_deg is not None:
             serialized["dphase_deg"] = float(self.dphase_deg)
 
@@ -58,12 +526,20 @@ class Pulsestack:
         if self.ylabel is not None:
             serialized["ylabel"] = self.ylabel
 
-        if self.values is not None:
+        if self.source_bin_offset is not None:
+            serialized["source_bin_offset"] = [int(offset) for offset in self.source_bin_offset]
+
+        if self.concatenation is not None:
+            serialized["concatenation"] = self.concatenation.serialize()
+
+        # (The values of concatenated observations are read from their pdv files again
+        # when loaded, rather than saved)
+        if self.values is not None and not self.is_concatenated():
             flattened = self.values.flatten()
             if self.complex is None or self.complex == "real":
-                serialized["values"] = list(flattened)
+                serialized["values"] = flattened.tolist()
             elif self.complex == "complex":
-                serialized["values"] = {"real": list(np.real(flattened)), "imag": list(np.imag(flattened))}
+                serialized["values"] = {"real": np.real(flattened).tolist(), "imag": np.imag(flattened).tolist()}
 
         return serialized
 
@@ -104,6 +580,11 @@ class Pulsestack:
         else:
             self.dpulse = None
 
+        if "pulse_numbers" in data.keys():
+            self.pulse_numbers = np.array(data["pulse_numbers"], dtype=float)
+        else:
+            self.pulse_numbers = None
+
         if "dphase_deg" in data.keys():
             self.dphase_deg = data["dphase_deg"]
         else:
@@ -129,6 +610,22 @@ class Pulsestack:
         else:
             self.ylabel = None
 
+        # (Older files don't record this, in which case there's no telling where a
+        # cropped pulsestack lies within the original pdv file)
+        if "source_bin_offset" in data.keys():
+            self.source_bin_offset = data["source_bin_offset"]
+        else:
+            self.source_bin_offset = None
+
+        # The other polarisations will be loaded from the pdv file if and when they are needed
+        self.stokes_cube = None
+
+        if "concatenation" in data.keys():
+            import concatenation # (concatenation itself imports this module)
+            self.concatenation = concatenation.Concatenation(data["concatenation"]["pdvfiles"], data["concatenation"]["gaps"])
+        else:
+            self.concatenation = None
+
         if "values" in data.keys() and self.npulses is not None and self.nbins is not None:
             if self.complex is None or self.complex == "real":
                 self.values = np.reshape(data["values"], (self.npulses, self.nbins))
@@ -136,56 +633,243 @@ class Pulsestack:
                 re = np.array(data["values"]["real"])
                 im = np.array(data["values"]["imag"])
                 self.values = np.reshape(re + 1j*im, (self.npulses, self.nbins))
+        elif self.concatenation is not None and self.stokes is not None:
+            self.values = self.get_stokes(self.stokes)
         else:
             self.values = None
 
-    def load_from_pdv(self, filename, stokes):
-        # Read in the pdv data using numpy's handy loadtxt
+        self.values_changed()
+
+    def load_from_pdv(self, filename, stokes, cache=True, keep_channels=False):
+        # Read in all polarisations of the pdv data (see load_stokes_cube()).
+        # The pulsestack itself is always frequency scrunched, but if keep_channels
+        # is True, the individual channels are kept for get_subbands() etc.
         self.pdvfile = filename
-        dat = np.loadtxt(filename)
+        self.stokes_cube = load_stokes_cube(filename, cache=cache, keep_channels=keep_channels)
 
-        # Record what Stokes parameter is being read
-        self.stokes = stokes
+        # Figure out what the dimensions of the pulsestack are, and store these
+        # to class variables
+        self.npulses, self.nbins = self.stokes_cube.get_shape()
+        self.nfreqs = self.stokes_cube.get_nfreqs()
 
-        # Figure out from the first few columns what the dimensions of the
-        # pulsestack are, and store these to class variables
-        self.npulses = int(dat[-1,0] + 1)
-        self.nfreqs  = int(dat[-1,1] + 1)
-        self.nbins   = int(dat[-1,2] + 1)
+        # The pulses in a pdv file are contiguous (i.e. no gaps), so that the pulse
+        # numbers and longitude bins can be represented by just two numbers: a
+        # reference pulse/bin and a step size (but see set_pulse_numbers())
+        self.first_pulse = 0
+        self.first_phase = 0
+        self.pulse_numbers = None
 
-        # Pull out the column for this Stokes, and reshape it into a
-        # pulsestack (i.e. 2D array)
-        stokes_col = "IQUV".find(stokes)
-        if stokes_col == -1:
-            raise ValueError("Unrecognised Stokes parameter {}".format(stokes))
-        stokes_col += 3 # (Stokes I starts in column 3)
+        self.dpulse     = 1 # i.e. 1 pulse per row
+        self.dphase_deg = 360/self.nbins
+
+        self.complex = "real"
+
+        self.source_bin_offset = [0, 0]
+        self.concatenation = None
+
+        # Pull out the requested Stokes as the pulsestack (i.e. 2D array)
+        self.set_stokes(stokes)
+
+    def load_concatenated(self, pdvfiles, stokes, gaps=None):
+        '''
+        Load several pdv files as one pulsestack, joined end to end along the pulse axis
+        (see concatenation.py). Nothing is read in until it is needed. gaps (if given) is
+        the number of pulses missing at each join, which are then skipped in the pulse
+        numbering (see set_pulse_numbers()). Otherwise (or where a gap is None), the pulses
+        are numbered consecutively across the joins. (See get_source_pulses() for which
+        observation each pulse came from.)
+        '''
+        import concatenation # (concatenation itself imports this module)
+
+        self.pdvfile = None
+        self.stokes_cube = None
+        self.concatenation = concatenation.Concatenation(pdvfiles, gaps=gaps)
+
+        self.npulses, self.nbins = self.concatenation.get_shape()
 
-        try:
-            self.values = np.reshape(dat[:,stokes_col], (self.npulses, self.nfreqs, self.nbins))
-            # Frequency scrunch
-            self.values = np.mean(self.values, axis=1)
-            self.nfreqs = 1
-        except:
-            raise IndexError("Could not read Stokes {} data from {}".format(stokes, filename))
-
-        # We will assume that the pulsestack array is always contiguous
-        # (i.e. no gaps), so that the pulse numbers and longitude bins can
-        # be represented by just two numbers: a reference pulse/bin and a
-        # step size
         self.first_pulse = 0
         self.first_phase = 0
 
-        self.dpulse     = 1 # i.e. 1 pulse per row
+        self.dpulse     = 1
         self.dphase_deg = 360/self.nbins
 
         self.complex = "real"
 
+        self.source_bin_offset = [0, 0]
+
+        self.pulse_numbers = None
+        missing = [0 if gap is None else gap for gap in self.concatenation.gaps]
+        if any([gap != 0 for gap in missing]):
+            skipped = np.repeat(np.cumsum(np.concatenate([[0], missing])), self.concatenation.npulses)
+            self.set_pulse_numbers(np.arange(self.npulses) + skipped)
+
+        self.set_stokes(stokes)
+
+    def is_concatenated(self):
+        # Whether the values are (still) those of concatenated observations, read in as needed
+        import concatenation # (concatenation itself imports this module)
+        return isinstance(self.values, concatenation.ConcatenatedValues)
+
+    def get_source_pulses(self, pulses):
+        '''
+        For concatenated observations, returns the pdv file that each of the given pulses
+        comes from, and its pulse number within that file
+        '''
+        if self.concatenation is None or self.source_bin_offset is None:
+            raise ValueError("This pulsestack is not a concatenation of observations")
+
+        rows = np.round(self.get_pulse_bin(pulses, inrange=False)).astype(int) + self.source_bin_offset[0]
+        segments, source_pulses = self.concatenation.get_source_pulses(rows)
+        return np.array(self.concatenation.pdvfiles)[segments], source_pulses
+
+    def get_join_pulses(self):
+        '''
+        For concatenated observations, returns the pulse numbers of the first pulse of
+        each observation after the first (that is within the current pulsestack), and
+        their gap records (see Concatenation.get_gap_records())
+        '''
+        if self.concatenation is None or self.source_bin_offset is None:
+            return np.array([]), []
+
+        gap_records = self.concatenation.get_gap_records()
+        rows = np.array([gap["row"] for gap in gap_records], dtype=int) - self.source_bin_offset[0]
+        inside = np.logical_and(rows > 0, rows < self.npulses)
+        return self.get_pulse_from_bin(rows[inside]), [gap for gap, i in zip(gap_records, inside) if i]
+
+    def set_stokes(self, stokes):
+        '''
+        Switch the pulsestack values to a different Stokes parameter (one of STOKES_VIEWS),
+        keeping the current cropping. The polarisation data are read from the pdv file
+        the first time this is needed.
+        '''
+        self.values = self.get_stokes(stokes)
+        self.stokes = stokes
+        self.values_changed()
+
+    def get_stokes(self, stokes):
+        '''
+        Returns the values of the given Stokes parameter (one of STOKES_VIEWS) over the
+        same pulses and phase bins as the current pulsestack, without switching to it
+        '''
+        if stokes not in STOKES_VIEWS:
+            raise ValueError("Unrecognised Stokes parameter {}".format(stokes))
+
+        if self.concatenation is not None:
+            if self.source_bin_offset is None:
+                raise IndexError("Could not read Stokes {} data: position within the concatenated observations unknown".format(stokes))
+            r0, c0 = self.source_bin_offset
+            return self.concatenation.get_values(stokes)[r0:r0+self.npulses, c0:c0+self.nbins]
+
+        self.load_stokes_cube(stokes)
+
+        r0, c0 = self.source_bin_offset
+        return self.stokes_cube.get(stokes)[r0:r0+self.npulses, c0:c0+self.nbins]
+
+    def load_stokes_cube(self, stokes, keep_channels=False):
+        '''
+        Make sure that self.stokes_cube is loaded (with frequency channels, if keep_channels
+        is True) and contains the given Stokes, reading the pdv file again if necessary
+        '''
+        if self.source_bin_offset is None:
+            raise IndexError("Could not read Stokes {} data: position within {} unknown".format(stokes, self.pdvfile))
+
+        if self.stokes_cube is None or (keep_channels == True and not self.stokes_cube.has_channels()):
+            if self.pdvfile is None or not os.path.exists(self.pdvfile):
+                raise IndexError("Could not read Stokes {} data: pdv file {} not available".format(stokes, self.pdvfile))
+            self.stokes_cube = load_stokes_cube(self.pdvfile, keep_channels=keep_channels)
+            self.nfreqs = self.stokes_cube.get_nfreqs()
+
+        if not self.stokes_cube.has_stokes(stokes):
+            raise IndexError("Could not read Stokes {} data from {}".format(stokes, self.pdvfile))
+
+    def get_subbands(self, groups, stokes=None):
+        '''
+        Returns an (nsubbands, npulses, nbins) array of the (current, or the given) Stokes,
+        averaged over the given groups of frequency channels (see channel_group_weights()),
+        over the same pulses and phase bins as the current pulsestack.
+        The channels are read from the pdv file the first time this is needed.
+        '''
+        if stokes is None:
+            stokes = self.stokes
+
+        self.load_stokes_cube(stokes, keep_channels=True)
+
+        r0, c0 = self.source_bin_offset
+        return self.stokes_cube.get_subbands(stokes, groups, slice(r0, r0+self.npulses), slice(c0, c0+self.nbins))
+
+    def get_subband_profiles(self, groups, stokes=None):
+        '''
+        Returns the (nsubbands, nbins) profiles of the given channel groups (see get_subbands())
+        '''
+        return np.mean(self.get_subbands(groups, stokes=stokes), axis=1)
+
+    def get_subband_LRFS(self, groups, stokes=None):
+        '''
+        Returns the LRFS of each sub-band (see get_subbands() and LRFS()), as an array
+        of shape (nsubbands, nfreqs, nbins), and the frequencies (cycles per period)
+        '''
+        subbands = self.get_subbands(groups, stokes=stokes)
+        lrfs, freqs, _ = self.calc_pulse_spectrum(subbands)
+        return lrfs, freqs
+
+    def get_subband_local_maxima(self, groups, maxima_threshold=None, stokes=None):
+        '''
+        Returns the locations of the local maxima (in phase) of every pulse of every sub-band
+        (see get_subbands()), as a (3, N) array of (sub-band index, pulse, phase), with pulse
+        and phase in data coordinates. Only maxima above maxima_threshold are included.
+        '''
+        subbands = self.get_subbands(groups, stokes=stokes)
+
+        is_bigger_than_left  = subbands[:,:,1:-1] >= subbands[:,:,:-2]
+        is_bigger_than_right = subbands[:,:,1:-1] >= subbands[:,:,2:]
+        is_local_max = np.logical_and(is_bigger_than_left, is_bigger_than_right)
+
+        if maxima_threshold is not None:
+            is_local_max = np.logical_and(is_local_max, subbands[:,:,1:-1] > maxima_threshold)
+
+        max_locations = np.array(np.where(is_local_max)).astype(float)
+
+        # Add one to phase (bin) locations because of previous splicing, then
+        # convert to data coordinates (pulse and phase)
+        max_locations[1,:] = self.get_pulse_from_bin(max_locations[1,:])
+        max_locations[2,:] = (max_locations[2,:] + 1)*self.dphase_deg + self.first_phase
+
+        return max_locations
+
     def set_onpulse(self, ph_lo, ph_hi):
         self.onpulse = [ph_lo, ph_hi]
 
+    def set_pulse_numbers(self, pulse_numbers):
+        '''
+        Give every row of the pulsestack its own pulse number, so that pulses that are
+        missing (e.g. dropped subintegrations, or the gaps between observations) don't
+        have to be filled in. pulse_numbers must be increasing, one per row, and should be
+        multiples of dpulse apart. If there turn out to be no gaps, first_pulse and dpulse
+        are enough, and no pulse numbers are kept.
+        '''
+        pulse_numbers = np.array(pulse_numbers, dtype=float)
+        if len(pulse_numbers) != self.npulses:
+            raise ValueError("There must be one pulse number for each of the {} pulses".format(self.npulses))
+        if np.any(np.diff(pulse_numbers) <= 0):
+            raise ValueError("Pulse numbers must be increasing")
+
+        self.first_pulse = pulse_numbers[0]
+        if np.allclose(np.diff(pulse_numbers), self.dpulse):
+            self.pulse_numbers = None
+        else:
+            self.pulse_numbers = pulse_numbers
+
+    def has_gaps(self):
+        # Whether any pulses are missing between the first and last (e.g. after cropping
+        # a pulsestack with pulse numbers, there might not be)
+        return self.pulse_numbers is not None and not np.allclose(np.diff(self.pulse_numbers), self.dpulse)
+
     def get_pulse_bin(self, pulse, inrange=True):
         # This can return fractional (non-integer) values
-        pulse_bin = (np.array(pulse) - self.first_pulse)/self.dpulse
+        if self.pulse_numbers is None:
+            pulse_bin = (np.array(pulse) - self.first_pulse)/self.dpulse
+        else:
+            pulse_bin = get_index_positions(self.pulse_numbers, pulse, self.dpulse)
         if inrange == True:
             if np.any(pulse_bin < 0):
                 pulse_bin[pulse_bin < 0] = 0
@@ -204,6 +888,8 @@ class Pulsestack:
         return phase_deg_bin
 
     def get_pulse_from_bin(self, pulse_bin):
+        if self.pulse_numbers is not None:
+            return get_index_values(self.pulse_numbers, pulse_bin, self.dpulse)
         return pulse_bin*self.dpulse + self.first_pulse
 
     def get_phase_from_bin(self, phase_bin):
@@ -235,41 +921,138 @@ class Pulsestack:
         else:
             newps = copy.copy(self)
 
-        if pulse_range is not None:
-
-            pulse_bin_range    = np.round(newps.get_pulse_bin(pulse_range)).astype(int)
-            newps.values       = newps.values[pulse_bin_range[0]:pulse_bin_range[1], :]
-            newps.first_pulse += pulse_bin_range[0]*newps.dpulse
-
-        if phase_deg_range is not None:
+        pulse_bin_range, phase_bin_range = newps.get_crop_bin_ranges(pulse_range, phase_deg_range)
 
-            phase_bin_range     = np.round(newps.get_phase_bin(phase_deg_range)).astype(int)
-            newps.values        = newps.values[:,phase_bin_range[0]:phase_bin_range[1]]
-            newps.first_phase  += phase_bin_range[0]*newps.dphase_deg
+        newps.first_pulse  = newps.get_pulse_from_bin(pulse_bin_range[0])
+        if newps.pulse_numbers is not None:
+            newps.pulse_numbers = newps.pulse_numbers[pulse_bin_range[0]:pulse_bin_range[1]]
+        newps.values       = newps.values[pulse_bin_range[0]:pulse_bin_range[1], phase_bin_range[0]:phase_bin_range[1]]
+        newps.first_phase += phase_bin_range[0]*newps.dphase_deg
+        if newps.source_bin_offset is not None:
+            newps.source_bin_offset = [newps.source_bin_offset[0] + pulse_bin_range[0], newps.source_bin_offset[1] + phase_bin_range[0]]
 
         newps.npulses, newps.nbins = newps.values.shape
+        newps.values_changed()
 
         return newps
 
-    def smooth_with_gaussian(self, sigma, inplace=True):
+    def get_crop_bin_ranges(self, pulse_range=None, phase_deg_range=None):
+        '''
+        Returns the [first, last+1) pulse bin and phase bin ranges (i.e. Python slice
+        limits) that crop() would keep for the given pulse_range and phase_deg_range
+        '''
+        if pulse_range is not None:
+            pulse_bin_range = np.round(self.get_pulse_bin(pulse_range)).astype(int)
+        else:
+            pulse_bin_range = np.array([0, self.values.shape[0]])
+
+        if phase_deg_range is not None:
+            phase_bin_range = np.round(self.get_phase_bin(phase_deg_range)).astype(int)
+        else:
+            phase_bin_range = np.array([0, self.values.shape[1]])
+
+        return pulse_bin_range, phase_bin_range
+
+    def smooth_with_gaussian(self, sigma, inplace=True, pulses_per_block=256, progress=None):
         '''
         Smooth the pulses with a gaussian filter using scipy's gaussian_filter1d function
         sigma is the gaussian width (analogous to the sigma parameter in
         gaussian_filter1d) in degrees
+        The smoothing is done in single precision, pulses_per_block pulses at a time,
+        and progress (if given) is called with the fraction done after each block.
+        Results are cached (see SmoothingCache), so asking for the same sigma again
+        is instant, as long as the pulsestack values haven't changed in the meantime.
         '''
+        key = (float(sigma), self.version)
+        smoothed = self.smoothing_cache.get(key)
+
+        if smoothed is None:
+            if np.iscomplexobj(self.values):
+                dtype = np.complex64
+            else:
+                dtype = np.float32
+
+            smoothed = np.empty(self.values.shape, dtype=dtype)
+            npulses = self.values.shape[0]
+            for i in range(0, npulses, pulses_per_block):
+                block = self.values[i:i+pulses_per_block].astype(dtype)
+                gaussian_filter1d(block, sigma/self.dphase_deg, mode='wrap', output=smoothed[i:i+pulses_per_block])
+                if progress is not None:
+                    progress(min(i + pulses_per_block, npulses)/npulses)
+
+            self.smoothing_cache.put(key, smoothed)
+
         if inplace == True:
             newps = self
         else:
             newps = copy.copy(self)
 
-        newps.values = gaussian_filter1d(self.values, sigma/self.dphase_deg, mode='wrap')
+        newps.values = smoothed
+        newps.values_changed()
         return newps
 
+    def is_smoothing_cached(self, sigma):
+        return self.smoothing_cache.get((float(sigma), self.version)) is not None
+
+    def smooth_2d(self, sigma_phase_deg, sigma_pulse=0, driftrate=0, method="auto", inplace=True):
+        '''
+        Smooth the pulsestack with a 2D Gaussian kernel (see smoothing.smooth_2d())
+        sigma_phase_deg is the kernel width in phase (deg)
+        sigma_pulse is the kernel width in the pulse direction (pulses)
+        driftrate (deg/pulse) shears the kernel to lie along driftbands with that drift rate
+        method is one of "direct", "fft", or "auto"
+        Like smooth_with_gaussian(), results are cached
+        '''
+        key = ("2d", float(sigma_phase_deg), float(sigma_pulse), float(driftrate), self.version)
+        smoothed = self.smoothing_cache.get(key)
+
+        if smoothed is None:
+            sigma_phase_bins = sigma_phase_deg/self.dphase_deg
+            sigma_pulse_bins = sigma_pulse/self.dpulse
+            shear = driftrate*self.dpulse/self.dphase_deg # phase bins per pulse bin
+
+            smoothed = smoothing.smooth_2d(self.values.astype(np.float32), sigma_phase_bins,
+                    sigma_pulse_bins=sigma_pulse_bins, shear=shear, method=method)
+            self.smoothing_cache.put(key, smoothed)
+
+        if inplace == True:
+            newps = self
+        else:
+            newps = copy.copy(self)
+
+        newps.values = smoothed
+        newps.values_changed()
+        return newps
+
+    def is_smoothing_2d_cached(self, sigma_phase_deg, sigma_pulse=0, driftrate=0):
+        key = ("2d", float(sigma_phase_deg), float(sigma_pulse), float(driftrate), self.version)
+        return self.smoothing_cache.get(key) is not None
+
     def calc_image_extent(self):
         return [self.first_phase - 0.5*self.dphase_deg,
                   self.first_phase + (self.values.shape[1] - 0.5)*self.dphase_deg,
-                  self.first_pulse - 0.5*self.dpulse,
-                  self.first_pulse + (self.values.shape[0] - 0.5)*self.dpulse]
+                  self.get_pulse_from_bin(-0.5),
+                  self.get_pulse_from_bin(self.values.shape[0] - 0.5)]
+
+    def get_image_values(self, max_expansion=4):
+        '''
+        The values as they should be shown as an image (see calc_image_extent()): if there
+        are gaps in the pulse numbers, the missing pulses are filled with NaNs (which are
+        left blank), unless that would make the image more than max_expansion times bigger,
+        in which case the pulses are shown evenly spaced (i.e. only approximately in place)
+        '''
+        if self.pulse_numbers is None:
+            return self.values
+
+        rows = np.round((self.pulse_numbers - self.pulse_numbers[0])/self.dpulse).astype(int)
+        if rows[-1] + 1 > max_expansion*self.npulses:
+            print("Warning: the gaps between pulses are too big to show, so the pulsestack is only approximately in place")
+            return self.values
+
+        dtype = complex if np.iscomplexobj(self.values) else float
+        image = np.full((rows[-1] + 1, self.nbins), np.nan, dtype=dtype)
+        image[rows] = np.asarray(self.values)
+        return image
 
     def cross_correlate_successive_pulses(self):
         # Calculate the cross correlation via the Fourier Transform method and
@@ -284,7 +1067,8 @@ class Pulsestack:
         shift = self.nbins//2
         crosscorr.values = np.roll(crosscorr.values, shift, axis=1)
         crosscorr.first_phase = -shift*self.dphase_deg
-        crossorr.xlabel = "Correlation lag (deg)"
+        crosscorr.xlabel = "Correlation lag (deg)"
+        crosscorr.values_changed()
 
         # Remember, there are now one fewer pulses!
         crosscorr.npulses -= 1
@@ -305,28 +1089,207 @@ class Pulsestack:
         autocorr.values = np.roll(autocorr.values, shift, axis=1)
         autocorr.first_phase = -shift*self.dphase_deg
         autocorr.xlabel = "Correlation lag (deg)"
+        autocorr.values_changed()
 
         return autocorr
 
-    def LRFS(self, pulse_range=None):
+    def calc_pulse_spectrum(self, values, progress=None):
+        '''
+        The spectrum of values (whose second last axis is this pulsestack's pulses) along
+        the pulses, without its zero frequency, the frequencies (cycles per period), and
+        their spacing (which is also the first frequency, even if there are fewer than two).
+        If there are gaps in the pulse numbers, the (Lomb-Scargle) spectrum is calculated
+        from the pulses that are there (see lomb_scargle_spectrum()), at the frequencies an
+        FFT of the whole span of pulses would have (but no finer than 4 times the resolution
+        of the pulses that are there), rather than pretending the pulses are consecutive.
+        progress (if given) is passed on to lomb_scargle_spectrum().
+        '''
+        if self.pulse_numbers is None:
+            spectrum = np.fft.rfft(values, axis=-2)[...,1:,:]
+            freqs = np.fft.rfftfreq(self.npulses, self.dpulse)[1:]
+            return spectrum, freqs, 1/(self.npulses*self.dpulse)
+
+        nspan = int(np.round((self.pulse_numbers[-1] - self.pulse_numbers[0])/self.dpulse)) + 1
+        nfft  = min(nspan, 4*self.npulses)
+        freqs = np.fft.rfftfreq(nfft, self.dpulse)[1:]
+        return lomb_scargle_spectrum(self.pulse_numbers, values, freqs, progress=progress), freqs, 1/(nfft*self.dpulse)
+
+    def LRFS(self, pulse_range=None, progress=None):
         lrfs = self.crop(pulse_range=pulse_range, inplace=False)
-        lrfs.values = np.fft.rfft(lrfs.values, axis=0)[1:,:]
+        lrfs.values, freqs, df = lrfs.calc_pulse_spectrum(lrfs.values, progress=progress)
         lrfs.complex = "complex"
-        freqs = np.fft.rfftfreq(lrfs.npulses, lrfs.dpulse)
-        df    = freqs[1] - freqs[0]
         lrfs.npulses  = lrfs.values.shape[0]
+        lrfs.pulse_numbers = None # (The frequencies are evenly spaced)
         lrfs.dpulse   = df
         lrfs.first_pulse = df
         lrfs.ylabel   = "Cycles per period"
+        lrfs.values_changed()
         return lrfs
 
+    def fit_subpulse_gaussians(self, phases, pulses, window_deg, niterations=20, subpulses_per_block=16384, progress=None):
+        '''
+        Fit a Gaussian to each subpulse (given by its phase and pulse), using the bins of
+        its pulse within window_deg (the full width) of its phase (see fit_gaussians()).
+        The subpulses are done subpulses_per_block at a time, to limit the memory used, and
+        progress (if given) is called with the fraction done after each block.
+
+        Returns the amplitudes, centres (deg), and widths (the Gaussians' sigmas, in deg)
+        of the fits, and a mask of which fits succeeded, i.e. ended up with a positive
+        amplitude, a width between a quarter of a bin and the window width, and a centre
+        within the window.
+        '''
+        phases = np.asarray(phases, dtype=float)
+        pulses = np.asarray(pulses, dtype=float)
+        nsubpulses = len(phases)
+
+        halfwidth_bins = max(int(np.ceil(0.5*window_deg/self.dphase_deg)), 1)
+        offsets = np.arange(-halfwidth_bins, halfwidth_bins + 1)
+
+        amplitudes = np.full(nsubpulses, np.nan)
+        centres    = np.full(nsubpulses, np.nan)
+        widths     = np.full(nsubpulses, np.nan)
+
+        for start in range(0, nsubpulses, subpulses_per_block):
+            block = slice(start, start + subpulses_per_block)
+
+            # Gather the window around every subpulse into one (nsubpulses x window) array
+            rows = np.round(self.get_pulse_bin(pulses[block], inrange=False)).astype(int)
+            cols = np.round(self.get_phase_bin(phases[block], inrange=False)).astype(int)[:,np.newaxis] + offsets
+            valid = np.logical_and(cols >= 0, cols < self.nbins)
+            valid[np.logical_or(rows < 0, rows >= self.npulses),:] = False
+
+            y = np.asarray(self.values[np.clip(rows, 0, self.npulses - 1)[:,np.newaxis], np.clip(cols, 0, self.nbins - 1)], dtype=float)
+            x = self.get_phase_from_bin(cols)
+
+            # Start from the subpulse's own position, the height of the bin it is in,
+            # and the width implied by the (positive part of the) window's second moment
+            positive = np.where(valid, np.clip(y, 0, None), 0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                width0 = np.sqrt(np.sum(positive*(x - phases[block,np.newaxis])**2, axis=1)/np.sum(positive, axis=1))
+            width0 = np.clip(np.nan_to_num(width0, nan=0.25*window_deg), self.dphase_deg, 0.5*window_deg)
+            amplitude0 = y[:,halfwidth_bins]
+
+            amplitudes[block], centres[block], widths[block], _ = fit_gaussians(x, y, amplitude0, phases[block], width0,
+                    valid=valid, niterations=niterations)
+
+            if progress is not None:
+                progress(min(start + subpulses_per_block, nsubpulses)/nsubpulses)
+
+        with np.errstate(invalid='ignore'):
+            success = np.logical_and.reduce([np.isfinite(amplitudes), np.isfinite(centres), np.isfinite(widths),
+                amplitudes > 0, widths > 0.25*self.dphase_deg, widths < window_deg,
+                np.abs(centres - phases) < 0.5*window_deg])
+
+        return amplitudes, centres, widths, success
+
+    def TDFS(self, pulse_range=None, onpulse_only=True, pad_factor=1, window=None):
+        '''
+        The two-dimensional fluctuation spectrum of the pulses in pulse_range (see tdfs_spectrum()).
+        If onpulse_only is True and an on-pulse region has been set, only that region is used.
+        The result is a pulsestack whose "pulses" are the P3 frequencies (cycles per period, P1/P3)
+        and whose "phases" are the P2 frequencies (cycles per period, P1/P2).
+        The pulses must be consecutive (i.e. there must be no gaps in pulse_range).
+        '''
+        phase_deg_range = self.onpulse if onpulse_only == True else None
+        cropped = self.crop(pulse_range=pulse_range, phase_deg_range=phase_deg_range, inplace=False)
+        if cropped.has_gaps():
+            raise ValueError("The 2DFS needs consecutive pulses, but some are missing; choose a pulse range without gaps")
+
+        tdfs = copy.copy(cropped)
+        tdfs.values = tdfs_spectrum(cropped.values, pad_factor=pad_factor, window=window)
+        tdfs.complex = "complex"
+        tdfs.pulse_numbers = None # (The frequencies are evenly spaced)
+
+        pulse_freqs = np.fft.rfftfreq(pad_factor*cropped.npulses, cropped.dpulse)
+        phase_freqs = np.fft.fftshift(np.fft.fftfreq(pad_factor*cropped.nbins, cropped.dphase_deg/360))
+        tdfs.npulses, tdfs.nbins = tdfs.values.shape
+        tdfs.dpulse      = pulse_freqs[1] - pulse_freqs[0]
+        tdfs.first_pulse = pulse_freqs[1]
+        tdfs.dphase_deg  = phase_freqs[1] - phase_freqs[0]
+        tdfs.first_phase = phase_freqs[0]
+        tdfs.onpulse     = None
+        tdfs.source_bin_offset = None # The bins no longer correspond to the original pulsestack's
+        tdfs.xlabel      = "Cycles per period (P1/P2)"
+        tdfs.ylabel      = "Cycles per period (P1/P3)"
+        tdfs.values_changed()
+        return tdfs
+
+    def get_TDFS_peak(self, pulse_range=None, onpulse_only=True, pad_factor=4, window="hann",
+            nbootstrap=0, block_size=None, batch_size=32, seed=None, progress=None):
+        '''
+        Finds the strongest feature in the 2DFS (see TDFS()), ignoring zero P2 frequency,
+        and converts its position into P2 (deg) and P3 (periods). P2 is signed so that
+        P2/P3 is the drift rate (deg/pulse), as for the model fits.
+
+        If nbootstrap > 0, the uncertainties of P2 and P3 are estimated by a block bootstrap:
+        the pulses are divided into blocks of block_size pulses (by default, a sixteenth of
+        them), and each resample is made of randomly chosen blocks (with replacement). The
+        2DFS of batch_size resamples are calculated together. progress (if given) is called
+        with the fraction done after each batch.
+
+        Returns a dictionary with the "P2" and "P3" of the peak, the corresponding frequencies
+        "P2_freq" and "P3_freq" (cycles per period), its "power", and, if bootstrapped,
+        "P2_err" and "P3_err" (standard deviations) and the resampled "P2s" and "P3s".
+        As for TDFS(), the pulses must be consecutive.
+        '''
+        phase_deg_range = self.onpulse if onpulse_only == True else None
+        cropped = self.crop(pulse_range=pulse_range, phase_deg_range=phase_deg_range, inplace=False)
+        if cropped.has_gaps():
+            raise ValueError("The 2DFS needs consecutive pulses, but some are missing; choose a pulse range without gaps")
+        values = np.asarray(cropped.values)
+        npulses, nbins = values.shape
+
+        pulse_freqs = np.fft.rfftfreq(pad_factor*npulses, cropped.dpulse)[1:]
+        phase_freqs = np.fft.fftshift(np.fft.fftfreq(pad_factor*nbins, cropped.dphase_deg/360))
+        zero_column = np.flatnonzero(phase_freqs == 0)[0]
+
+        def peak_to_periods(rows, cols):
+            # Convert fractional bins to frequencies (both axes are evenly spaced), and then to periods
+            P3_freq = pulse_freqs[0] + rows*(pulse_freqs[1] - pulse_freqs[0])
+            P2_freq = phase_freqs[0] + cols*(phase_freqs[1] - phase_freqs[0])
+            return -360/P2_freq, 1/P3_freq, P2_freq, P3_freq
+
+        power = np.abs(tdfs_spectrum(values, pad_factor=pad_factor, window=window))**2
+        rows, cols, peak_power = find_spectrum_peak(power, exclude_column=zero_column)
+        P2, P3, P2_freq, P3_freq = peak_to_periods(rows, cols)
+
+        result = {"P2": float(P2), "P3": float(P3), "P2_freq": float(P2_freq), "P3_freq": float(P3_freq), "power": float(peak_power)}
+
+        if nbootstrap > 0:
+            if block_size is None:
+                block_size = max(npulses//16, 1)
+            nblocks = npulses//block_size
+            blocks = values[:nblocks*block_size].reshape(nblocks, block_size, nbins)
+
+            rng = np.random.default_rng(seed)
+            P2s = np.empty(nbootstrap)
+            P3s = np.empty(nbootstrap)
+            for start in range(0, nbootstrap, batch_size):
+                nbatch = min(batch_size, nbootstrap - start)
+                chosen = rng.integers(nblocks, size=(nbatch, nblocks))
+                resampled = blocks[chosen].reshape(nbatch, nblocks*block_size, nbins)
+
+                # The resamples can be a little shorter than the original, so their spectra
+                # are padded to the same frequency bins
+                power = np.abs(tdfs_spectrum(resampled, window=window, padded_shape=(pad_factor*npulses, pad_factor*nbins)))**2
+                rows, cols, _ = find_spectrum_peak(power, exclude_column=zero_column)
+                P2s[start:start+nbatch], P3s[start:start+nbatch], _, _ = peak_to_periods(rows, cols)
+
+                if progress is not None:
+                    progress((start + nbatch)/nbootstrap)
+
+            result.update({"P2_err": float(np.std(P2s, ddof=1)), "P3_err": float(np.std(P3s, ddof=1)), "P2s": P2s, "P3s": P3s})
+
+        return result
+
     def plot_image(self, ax, **kwargs):
         # Plots the pulsestack as an image
         extent = self.calc_image_extent()
+        values = self.get_image_values()
         if self.complex == "real":
-            self.ps_image = ax.imshow(self.values, aspect='auto', origin='lower', interpolation='none', extent=extent, cmap='hot', **kwargs)
+            self.ps_image = ax.imshow(values, aspect='auto', origin='lower', interpolation='none', extent=extent, cmap='hot', **kwargs)
         else:
-            self.ps_image = ax.imshow(np.abs(self.values), aspect='auto', origin='lower', interpolation='none', extent=extent, cmap='hot', **kwargs)
+            self.ps_image = ax.imshow(np.abs(values), aspect='auto', origin='lower', interpolation='none', extent=extent, cmap='hot', **kwargs)
         self.cbar = plt.colorbar(mappable=self.ps_image, ax=ax)
         ax.set_xlabel("Pulse phase (deg)" if self.xlabel is None else self.xlabel)
         ax.set_ylabel("Pulse number" if self.ylabel is None else self.ylabel)
@@ -0,0 +1,211 @@
+'''
+Resampling estimates of the uncertainties of model fits (see ModelFit), as an
+alternative to the covariance (pcov) from curve_fit, which assumes that the
+subpulse phases have independent errors and that the model is close to linear in
+its parameters. Neither is true for strongly curved driftbands, or when the
+subpulse positions of nearby pulses are correlated.
+
+The subpulses of a drift sequence are resampled with one of RESAMPLING_METHODS:
+
+    "bootstrap"       - subpulses drawn at random, with replacement
+    "block_bootstrap" - blocks of consecutive pulses drawn at random, with replacement,
+                        so that correlations between nearby pulses are kept
+    "jackknife"       - each block of consecutive pulses left out in turn
+
+and the model is refitted to each resample (starting from the fit to all of them).
+The fits are done in parallel in separate processes.
+
+Usage:
+
+    python resampling.py <json_file> [<method> [<nresamples>]]
+
+which resamples every drift sequence with a model fit, and saves the resulting
+intervals back into the session.
+'''
+
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from scipy.stats import norm
+
+import drift_analysis
+
+RESAMPLING_METHODS = ["bootstrap", "block_bootstrap", "jackknife"]
+
+def get_pulse_blocks(pulses, block_size=None):
+    '''
+    Divide subpulses into blocks of block_size consecutive pulses. If block_size is None,
+    it defaults to the cube root of the number of distinct pulses (a common rule of thumb
+    for block bootstraps), but at least 1.
+    Returns a list of arrays of subpulse indexes, one per (non-empty) block.
+    '''
+    if block_size is None:
+        block_size = max(1, int(np.ceil(len(np.unique(pulses))**(1/3))))
+
+    block_of_subpulse = np.floor((pulses - np.min(pulses))/block_size).astype(int)
+    order = np.argsort(block_of_subpulse, kind='stable')
+    _, starts = np.unique(block_of_subpulse[order], return_index=True)
+    return np.split(order, starts[1:])
+
+def make_resamples(method, pulses, nresamples=1000, block_size=None, rng=None):
+    '''
+    Returns a list of arrays of subpulse indexes, one per resample (see RESAMPLING_METHODS).
+    For the jackknife, there is one resample per block, whatever nresamples is.
+    '''
+    rng = np.random.default_rng(rng)
+    nsubpulses = len(pulses)
+
+    if method == "bootstrap":
+        return list(rng.integers(nsubpulses, size=(nresamples, nsubpulses)))
+
+    elif method == "block_bootstrap":
+        blocks = get_pulse_blocks(pulses, block_size)
+        chosen = rng.integers(len(blocks), size=(nresamples, len(blocks)))
+        return [np.concatenate([blocks[i] for i in row]) for row in chosen]
+
+    elif method == "jackknife":
+        blocks = get_pulse_blocks(pulses, 1 if block_size is None else block_size)
+        block_idxs = np.arange(len(blocks))
+        return [np.concatenate([blocks[i] for i in block_idxs if i != left_out]) for left_out in block_idxs]
+
+    else:
+        raise ValueError("Unrecognised resampling method '{}'".format(method))
+
+def fit_resamples(serialized_model, phases, pulses, driftbands, resamples):
+    '''
+    Refit the (serialized) model to each resample of the subpulses, starting each fit
+    from the model's own parameters. Returns an array of the fitted parameters, one row
+    per resample, with NaNs for any fit that fails.
+    '''
+    model_fit = drift_analysis.ModelFit()
+    model_fit.unserialize(serialized_model)
+    initial_parameters = np.array(model_fit.parameters, dtype=float)
+
+    results = np.full((len(resamples), len(initial_parameters)), np.nan)
+    for i, idxs in enumerate(resamples):
+        model_fit.parameters = initial_parameters.copy()
+        try:
+            model_fit.optimise_fit_to_subpulses(phases[idxs], pulses[idxs], driftbands[idxs], verbose=False)
+            results[i] = model_fit.parameters
+        except (RuntimeError, ValueError, np.linalg.LinAlgError):
+            pass
+
+    return results
+
+def calc_interval(full_value, samples, method, confidence=0.68):
+    '''
+    Returns the lower and upper limits of the confidence interval of each column of samples.
+    For the bootstraps, these are percentiles of the samples. For the jackknife, they are
+    full_value (the value from all the subpulses) +- the jackknife standard error, scaled
+    as for a normal distribution.
+    '''
+    if method == "jackknife":
+        n = samples.shape[0]
+        std_err = np.sqrt((n - 1)/n * np.sum((samples - np.mean(samples, axis=0))**2, axis=0))
+        z = norm.ppf(0.5 + confidence/2)
+        return full_value - z*std_err, full_value + z*std_err
+    else:
+        return np.percentile(samples, 50*(1 - confidence), axis=0), np.percentile(samples, 50*(1 + confidence), axis=0)
+
+def get_intervals(model_fit, samples, method, confidence=0.68):
+    '''
+    Summarise the resampled parameters of a model fit as the dictionary stored in
+    ModelFit.intervals: the limits of the intervals of each parameter ("lower", "upper"),
+    and of P3 in the middle of the sequence ("P3_mid"), which is often what is wanted,
+    and which is not simply related to any one parameter.
+    '''
+    valid = np.all(np.isfinite(samples), axis=1)
+    samples = samples[valid]
+    if samples.shape[0] < 2:
+        return None
+
+    lower, upper = calc_interval(np.array(model_fit.parameters, dtype=float), samples, method, confidence)
+
+    # A stand-in model with one set of parameters per resample, to get all the P3s at once
+    pmid = 0.5*(model_fit.first_pulse + model_fit.last_pulse)
+    resampled_model = drift_analysis.ModelFit()
+    resampled_model.model_name  = model_fit.model_name
+    resampled_model.parameters  = samples.T
+    resampled_model.first_pulse = model_fit.first_pulse
+    P3_lower, P3_upper = calc_interval(model_fit.calc_P3(pmid), resampled_model.calc_P3(pmid), method, confidence)
+
+    return {
+            "method":     method,
+            "nresamples": int(samples.shape[0]),
+            "nfailed":    int(np.sum(~valid)),
+            "confidence": confidence,
+            "lower":      [float(x) for x in lower],
+            "upper":      [float(x) for x in upper],
+            "P3_mid":     [float(P3_lower), float(P3_upper)],
+            }
+
+def resample_model_fits(problems, method="bootstrap", nresamples=1000, block_size=None, confidence=0.68,
+        seed=None, nprocesses=None, resamples_per_chunk=100, progress=None):
+    '''
+    Resample several model fits at once, sharing one pool of processes between them
+    (unless nprocesses is 1). problems is a list of (model_fit, phases, pulses, driftbands),
+    where the model_fits already have parameters (which are used as the starting point of
+    every refit). block_size is in pulses (see get_pulse_blocks()). progress (if given)
+    is called with the fraction of chunks done; if it raises an exception (e.g. to cancel),
+    the chunks that haven't started yet are abandoned.
+
+    Returns a list of (intervals, samples), one per problem, where intervals is as in
+    get_intervals() (or None if too few refits succeeded), and samples is the array of
+    refitted parameters (one row per resample, NaN where the refit failed).
+    '''
+    rng = np.random.default_rng(seed)
+
+    # Split every problem's resamples into chunks, each of which is one job
+    jobs = []
+    for problem_idx, (model_fit, phases, pulses, driftbands) in enumerate(problems):
+        phases, pulses, driftbands = np.asarray(phases, dtype=float), np.asarray(pulses, dtype=float), np.asarray(driftbands, dtype=float)
+        resamples = make_resamples(method, pulses, nresamples=nresamples, block_size=block_size, rng=rng)
+        for start in range(0, len(resamples), resamples_per_chunk):
+            jobs.append((problem_idx, start, (model_fit.serialize(), phases, pulses, driftbands, resamples[start:start+resamples_per_chunk])))
+
+    samples = [[] for problem in problems]
+    if nprocesses == 1:
+        for n, (problem_idx, start, args) in enumerate(jobs):
+            samples[problem_idx].append((start, fit_resamples(*args)))
+            if progress is not None:
+                progress((n + 1)/len(jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=nprocesses) as executor:
+            futures = {executor.submit(fit_resamples, *args): (problem_idx, start) for problem_idx, start, args in jobs}
+            try:
+                for n, future in enumerate(as_completed(futures)):
+                    problem_idx, start = futures[future]
+                    samples[problem_idx].append((start, future.result()))
+                    if progress is not None:
+                        progress((n + 1)/len(jobs))
+            except BaseException:
+                # (Otherwise leaving the executor would wait for all of them)
+                for future in futures:
+                    future.cancel()
+                raise
+
+    results = []
+    for (model_fit, _, _, _), chunks in zip(problems, samples):
+        problem_samples = np.concatenate([chunk for _, chunk in sorted(chunks, key=lambda c: c[0])])
+        results.append((get_intervals(model_fit, problem_samples, method, confidence), problem_samples))
+
+    return results
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print(__doc__)
+        sys.exit()
+
+    method     = sys.argv[2] if len(sys.argv) > 2 else "bootstrap"
+    nresamples = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    session = drift_analysis.DriftAnalysis()
+    session.load_json(sys.argv[1])
+    session.resample_model_fits(method=method, nresamples=nresamples)
+
+    for seq in sorted(session.model_fits.keys()):
+        if session.model_fits[seq].intervals is not None:
+            print("Sequence {}:\n{}".format(seq, session.model_fits[seq]))
+
+    session.save_json(sys.argv[1])
@@ -0,0 +1,118 @@
+import numpy as np
+import scipy.fft
+from scipy.ndimage import gaussian_filter1d, correlate
+
+# Rough cost of an FFT, per element per log2(element), relative to one
+# multiply-add of a direct convolution. Used to decide between the two.
+FFT_COST_FACTOR = 4.0
+
+def gaussian_kernel_2d(sigma_phase_bins, sigma_pulse_bins=0, shear=0, truncate=4.0):
+    '''
+    Returns a normalised 2D Gaussian kernel, with shape (2K+1, 2L+1), i.e. pulses x phase bins,
+    centred on the middle element.
+
+    shear is in phase bins per pulse bin: the kernel is elongated along lines of
+    constant (phase - shear*pulse), i.e. along a driftband with that drift rate.
+    If sigma_phase_bins is 0, the kernel is (linearly interpolated) one bin wide in phase.
+    Like scipy's gaussian_filter1d, the kernel is truncated at truncate*sigma.
+    '''
+    K = int(np.ceil(truncate*sigma_pulse_bins))
+    L = int(np.ceil(truncate*sigma_phase_bins + np.abs(shear)*K))
+
+    j = np.arange(-K, K+1)[:,np.newaxis]  # Pulse offsets
+    m = np.arange(-L, L+1)[np.newaxis,:]  # Phase offsets
+
+    if sigma_pulse_bins > 0:
+        pulse_weights = np.exp(-0.5*(j/sigma_pulse_bins)**2)
+    else:
+        pulse_weights = np.ones(j.shape)
+
+    if sigma_phase_bins > 0:
+        phase_weights = np.exp(-0.5*((m - shear*j)/sigma_phase_bins)**2)
+    else:
+        phase_weights = np.maximum(0, 1 - np.abs(m - shear*j))
+
+    kernel = pulse_weights*phase_weights
+    return kernel/np.sum(kernel)
+
+def choose_method(shape, kernel_shape, separable):
+    '''
+    Returns "direct" or "fft", whichever is (estimated to be) cheaper for smoothing
+    an array of the given shape with a kernel of the given shape
+    '''
+    npulses, nbins = shape
+    kpulses, kbins = kernel_shape
+
+    if separable:
+        direct_cost = npulses*nbins*(kpulses + kbins)
+    else:
+        direct_cost = npulses*nbins*kpulses*kbins
+
+    nfft = (npulses + kpulses - 1)*nbins
+    fft_cost = FFT_COST_FACTOR*nfft*np.log2(nfft)
+
+    if direct_cost <= fft_cost:
+        return "direct"
+    else:
+        return "fft"
+
+def fft_correlate(values, kernel):
+    '''
+    Correlate values with kernel using FFTs, treating the phase axis (axis 1) as
+    periodic and reflecting at the first and last pulses (i.e. the same boundary
+    conditions as the "direct" method in smooth_2d())
+    '''
+    npulses, nbins = values.shape
+    K = kernel.shape[0]//2
+    L = kernel.shape[1]//2
+
+    # Pad in the pulse direction so that the FFT's periodicity doesn't mix the
+    # first and last pulses. No padding is needed in phase, which really is periodic.
+    padded = np.pad(values, ((K, K), (0, 0)), mode='symmetric')
+    nfft = scipy.fft.next_fast_len(padded.shape[0], real=True)
+
+    # Lay the (flipped, since this is a correlation) kernel onto the FFT grid with its
+    # centre at the origin, wrapping around in phase if it is wider than the pulse
+    kernel_grid = np.zeros((nfft, nbins), dtype=values.dtype)
+    j = (-np.arange(-K, K+1)) % nfft
+    m = (-np.arange(-L, L+1)) % nbins
+    np.add.at(kernel_grid, (j[:,np.newaxis], m[np.newaxis,:]), kernel.astype(values.dtype))
+
+    smoothed = scipy.fft.irfft2(scipy.fft.rfft2(padded, s=(nfft, nbins)) * scipy.fft.rfft2(kernel_grid), s=(nfft, nbins))
+    return smoothed[K:K+npulses,:].astype(values.dtype)
+
+def smooth_2d(values, sigma_phase_bins, sigma_pulse_bins=0, shear=0, method="auto", truncate=4.0):
+    '''
+    Smooth a (real) pulsestack (npulses x nbins) with a 2D Gaussian kernel (see gaussian_kernel_2d()).
+    The phase axis is treated as periodic; the pulse axis is reflected at either end.
+    method is one of "direct", "fft", or "auto" (choose whichever is cheaper).
+    '''
+    if np.iscomplexobj(values):
+        raise ValueError("2D smoothing is only implemented for real-valued pulsestacks")
+
+    kernel    = gaussian_kernel_2d(sigma_phase_bins, sigma_pulse_bins=sigma_pulse_bins, shear=shear, truncate=truncate)
+    separable = (shear == 0)
+
+    if method == "auto":
+        method = choose_method(values.shape, kernel.shape, separable)
+
+    if method == "direct":
+        if separable:
+            # No shear, so it can be done as two 1D passes
+            smoothed = values
+            if sigma_phase_bins > 0:
+                smoothed = gaussian_filter1d(smoothed, sigma_phase_bins, axis=1, mode='wrap', truncate=truncate)
+            if sigma_pulse_bins > 0:
+                smoothed = gaussian_filter1d(smoothed, sigma_pulse_bins, axis=0, mode='reflect', truncate=truncate)
+            return np.array(smoothed, dtype=values.dtype)
+
+        # Pad in pulse (so that "wrap" only has an effect in phase), then throw the padding away
+        K = kernel.shape[0]//2
+        padded = np.pad(values, ((K, K), (0, 0)), mode='symmetric')
+        return correlate(padded, kernel.astype(values.dtype), mode='wrap')[K:K+values.shape[0],:]
+
+    elif method == "fft":
+        return fft_correlate(values, kernel)
+
+    else:
+        raise ValueError("Unrecognised smoothing method '{}'".format(method))
@@ -0,0 +1,132 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class Cancelled(Exception):
+    '''
+    Raised from inside a task function (via Task.check_cancelled()) to stop early
+    '''
+    pass
+
+class Task:
+    '''
+    A long-running computation to be run off the GUI thread.
+
+    function    - called (in the worker thread) as function(task), so that it can
+                  report progress with task.set_progress() and stop early with
+                  task.check_cancelled() (or both at once, by passing
+                  task.report_progress as the progress callback of a long computation)
+    on_done     - called (in the GUI thread) as on_done(result) once function returns
+    cancellable - whether the user is allowed to cancel the task. Even if cancelled,
+                  a computation that doesn't check for cancellation will run to completion,
+                  but its result will be thrown away.
+    '''
+    def __init__(self, description, function, on_done=None, cancellable=True):
+        self.description = description
+        self.function    = function
+        self.on_done     = on_done
+        self.cancellable = cancellable
+
+        self.progress    = None
+        self.future      = None
+        self.start_time  = None
+        self.cancelled   = threading.Event()
+
+    def set_progress(self, fraction):
+        self.progress = fraction
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    def check_cancelled(self):
+        if self.is_cancelled():
+            raise Cancelled()
+
+    def report_progress(self, fraction):
+        self.set_progress(fraction)
+        self.check_cancelled()
+
+    def get_status(self):
+        status = "{}...".format(self.description)
+        if self.progress is not None:
+            status += " {:.0f}%".format(100*self.progress)
+        status += " ({:.1f} s)".format(time.time() - self.start_time)
+        if self.is_cancelled():
+            status += " - cancelling"
+        elif self.cancellable:
+            status += " - esc to cancel"
+        return status
+
+class TaskRunner:
+    '''
+    Runs one Task at a time in a background thread, polling for its result with
+    a timer belonging to a Matplotlib canvas, so that the result is applied back
+    on the GUI thread.
+
+    set_status - called (in the GUI thread) with a status string while a task is
+                 running, and with None when it has finished
+    '''
+    def __init__(self, canvas, set_status, poll_interval_ms=100):
+        self.executor   = ThreadPoolExecutor(max_workers=1)
+        self.task       = None
+        self.set_status = set_status
+
+        self.timer = canvas.new_timer(interval=poll_interval_ms)
+        self.timer.add_callback(self.poll)
+
+    def is_busy(self):
+        return self.task is not None
+
+    def submit(self, task):
+        if self.is_busy():
+            print("Still busy with \"{}\". Try again when it has finished.".format(self.task.description))
+            return False
+
+        self.task = task
+        task.start_time = time.time()
+        task.future = self.executor.submit(task.function, task)
+        self.set_status(task.get_status())
+        self.timer.start()
+        return True
+
+    def cancel(self):
+        if not self.is_busy():
+            return
+
+        if not self.task.cancellable:
+            print("\"{}\" cannot be cancelled".format(self.task.description))
+            return
+
+        self.task.cancelled.set()
+        self.task.future.cancel()
+
+    def poll(self):
+        task = self.task
+        if task is None:
+            self.timer.stop()
+            return
+
+        if not task.future.done():
+            self.set_status(task.get_status())
+            return
+
+        # The task has finished (one way or another), so apply the result
+        self.timer.stop()
+        self.task = None
+        self.set_status(None)
+
+        if task.is_cancelled():
+            print("Cancelled \"{}\"".format(task.description))
+            return
+
+        try:
+            result = task.future.result()
+        except Cancelled:
+            print("Cancelled \"{}\"".format(task.description))
+            return
+        except Exception as err:
+            print("\"{}\" failed: {}".format(task.description, err))
+            return
+
+        if task.on_done is not None:
+            task.on_done(result)